@@ -0,0 +1,424 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+'''
+Headless benchmarks. Unlike profile.py this never starts the GUI.
+
+    python bench.py            # run everything
+    python bench.py readcap    # run only the named benchmarks
+    python bench.py --sizes 1000,10000,100000 --json out.json corpus-readcap expiry
+
+The corpus-* and expiry benchmarks run over synthetic alerts from
+corpus.py, at each of --sizes. --json writes every timing, and the
+memory and page sizes, so runs can be compared.
+'''
+
+import glob
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+import types
+from optparse import OptionParser
+from StringIO import StringIO
+from datetime import datetime
+import dateutil.tz
+from dateutil import parser as dateparser
+from dateutil import zoneinfo
+
+import cap
+import corpus
+import engine
+import glineenc
+import parse
+import utils
+from httpcache import HTTPCache
+from mapcache import MapCache
+from store import AlertStore
+
+CAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'caps')
+DEFAULT_SIZES = (1000,)
+
+RESULTS = list() # what report() and reportAmount() printed, for --json
+CURRENT = [None] # name of the running benchmark
+
+def capFiles():
+    return sorted(glob.glob(os.path.join(CAPS_DIR, 'alert*.cap')))
+
+def best(func, repeat=5, number=1):
+    '''
+    Best wall-clock time of one call of func over repeat runs.
+    '''
+    times = list()
+    for x in range(repeat):
+        start = time.time()
+        for y in range(number):
+            func()
+        times.append((time.time() - start) / number)
+    return min(times)
+
+def report(name, seconds, baseline=None, count=None):
+    '''
+    Prints and records one timing. count: how many items (alerts,
+    polygons) the time covers, reported as a rate.
+    '''
+    result = dict(benchmark=CURRENT[0], name=name, seconds=seconds)
+    if baseline is not None:
+        result['speedup'] = baseline / seconds
+    if count is not None:
+        result['count'] = count
+        result['perSecond'] = count / seconds
+    RESULTS.append(result)
+    if count is not None:
+        print "{0:<40} {1:10.3f} ms  {2:10.0f}/s".format(name, seconds * 1000, count / seconds)
+    elif baseline is not None:
+        print "{0:<40} {1:10.3f} ms  ({2:.2f}x)".format(name, seconds * 1000, baseline / seconds)
+    else:
+        print "{0:<40} {1:10.3f} ms".format(name, seconds * 1000)
+
+def reportAmount(name, value, unit, baseline=None):
+    '''
+    Prints and records one measurement that is not a time, such as
+    bytes/alert. As with times, smaller is better: the ratio is
+    baseline / value.
+    '''
+    result = dict(benchmark=CURRENT[0], name=name, value=value, unit=unit)
+    if baseline is not None:
+        result['ratio'] = float(baseline) / value
+    RESULTS.append(result)
+    if baseline is not None:
+        print "{0:<40} {1:10d} {2}  ({3:.2f}x)".format(name, value, unit, float(baseline) / value)
+    else:
+        print "{0:<40} {1:10d} {2}".format(name, value, unit)
+
+def benchReadCAP(number=20):
+    files = capFiles()
+    tree = best(lambda: [parse.ReadCAPTree(f) for f in files], number=number)
+    stream = best(lambda: [parse.ReadCAP(f) for f in files], number=number)
+    print "ReadCAP over {0} files in {1}".format(len(files), CAPS_DIR)
+    report('objectify tree (ReadCAPTree)', tree)
+    report('iterparse stream (ReadCAP)', stream, tree)
+
+def benchFeed(size=2000, new=20, number=10):
+    links = ['http://example.com/{0}.cap'.format(n) for n in range(size)]
+    seen = set(links[new:])
+    for name, feed in (('atom', parse._atomFeed(links)), ('rss', parse._rssFeed(links))):
+        print "{0} feed of {1} entries, {2} of them new".format(name, size, new)
+        tree = best(lambda: [e for e in parse.readFeedTree(StringIO(feed), name) if e.caplink not in seen], number=number)
+        report('objectify, then filter (readFeedTree)', tree)
+        report('etree, all entries (readFeed)', best(lambda: parse.readFeed(StringIO(feed), name), number=number), tree)
+        report('etree, new entries only', best(lambda: parse.readFeed(StringIO(feed), name, seen.__contains__), number=number), tree)
+        report('etree, newest first, stopAfter=10', best(lambda: parse.readFeed(StringIO(feed), name, seen.__contains__, 10), number=number), tree)
+
+def ring(vertices, center=(38.5, -121.5), radius=2.0):
+    polygon = list()
+    for n in range(vertices):
+        theta = 2 * math.pi * n / vertices
+        r = radius * random.uniform(0.7, 1.0)
+        polygon.append((center[0] + r * math.cos(theta), center[1] + r * math.sin(theta)))
+    polygon.append(polygon[0])
+    return polygon
+
+def benchGeo(sizes=(1000, 10000, 100000), vertices=100):
+    if utils.numpy is None:
+        print "numpy not installed, skipping geo kernels"
+        return
+    random.seed(1)
+    polygon = ring(vertices)
+    origin = (38.56513, -121.75156)
+    print "point in polygon ({0} vertices) and haversine".format(vertices)
+    for size in sizes:
+        points = [(random.uniform(35, 42), random.uniform(-125, -118)) for x in range(size)]
+        array = utils.numpy.array(points)
+        scalar = best(lambda: [utils.point_inside_polygon(x, y, polygon) for x, y in points], repeat=3)
+        vector = best(lambda: utils.points_inside_polygon(array, polygon), repeat=3)
+        report('point_inside_polygon x{0}'.format(size), scalar)
+        report('points_inside_polygon x{0}'.format(size), vector, scalar)
+        scalar = best(lambda: [utils.distance(p, origin) for p in points], repeat=3)
+        vector = best(lambda: utils.distances(array, origin), repeat=3)
+        report('distance x{0}'.format(size), scalar)
+        report('distances x{0}'.format(size), vector, scalar)
+
+def benchTimestamps(number=200):
+    stamps = list()
+    vtecs = list()
+    for f in capFiles():
+        text = open(f).read()
+        stamps.extend(unicode(x) for x in re.findall(r'<(?:\w+:)?(?:sent|effective|onset|expires)>([^<]+)<', text))
+        vtecs.extend(x for x in re.findall(r'\b\d{6}T\d{4}Z', text) if x != '000000T0000Z')
+    def fast():
+        cap._datetimes.clear()
+        return [cap.unicodeToDatetime(x) for x in stamps]
+    print "{0} CAP and {1} VTEC timestamps from {2}".format(len(stamps), len(vtecs), CAPS_DIR)
+    slow = best(lambda: [dateparser.parse(x).astimezone(zoneinfo.gettz('UTC')) for x in stamps], number=number)
+    report('dateutil parse + gettz', slow)
+    report('unicodeToDatetime (no memo)', best(fast, number=number), slow)
+    report('unicodeToDatetime (memo)', best(lambda: [cap.unicodeToDatetime(x) for x in stamps], number=number), slow)
+    slow = best(lambda: [datetime.strptime(x, "%y%m%dT%H%MZ").replace(tzinfo=dateutil.tz.gettz('UTC')) for x in vtecs], number=number)
+    report('strptime + gettz', slow)
+    report('vtecToDatetime', best(lambda: [cap.vtecToDatetime(x) for x in vtecs], number=number), slow)
+
+class Unslotted:
+    pass
+
+def unslot(obj):
+    '''
+    Rebuilds a parsed alert the way the model stored it before __slots__:
+    old-style instances with a __dict__, lists and sets.
+    '''
+    u = Unslotted()
+    for name, value in obj.__getstate__().iteritems():
+        if isinstance(value, cap.Slotted):
+            value = unslot(value)
+        elif isinstance(value, frozenset):
+            value = set(value)
+        elif name == 'polygons':
+            value = [list(p) for p in value]
+        elif name == 'geoCodes':
+            value = dict((k, list(v)) for k, v in value.iteritems())
+        elif name in ('codes', 'references', 'infos', 'resources', 'areas', 'circles'):
+            value = [unslot(x) if isinstance(x, cap.Slotted) else x for x in value]
+        setattr(u, name, value)
+    return u
+
+def deepSize(obj, seen):
+    '''
+    sys.getsizeof of obj and everything reachable from it that is not
+    already in seen. Classes and modules are not counted.
+    '''
+    if id(obj) in seen or isinstance(obj, (type, types.ClassType, types.ModuleType)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += deepSize(k, seen) + deepSize(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for x in obj:
+            size += deepSize(x, seen)
+    elif isinstance(obj, cap.Slotted):
+        for value in obj.__getstate__().itervalues():
+            size += deepSize(value, seen)
+    elif hasattr(obj, '__dict__'):
+        size += deepSize(obj.__dict__, seen)
+    return size
+
+def benchMemory():
+    alerts = [parse.ReadCAP(f) for f in capFiles()]
+    # Both models share the strings, floats and datetimes, so only the
+    # instances and containers differ.
+    before = deepSize([unslot(a) for a in alerts], set())
+    after = deepSize(alerts, set())
+    count = len(alerts)
+    print "Memory of {0} parsed sample alerts".format(count)
+    reportAmount('dict model (before __slots__)', before / count, 'bytes/alert')
+    reportAmount('slotted, frozen model', after / count, 'bytes/alert', before / count)
+
+_corpora = dict()
+
+def corpusDocuments(size):
+    '''
+    size synthetic (name, CAP bytes), generated once per run.
+    '''
+    if size not in _corpora:
+        _corpora[size] = (list(corpus.synthesize(size)), None)
+    return _corpora[size][0]
+
+def corpusAlerts(size):
+    documents, alerts = _corpora.get(size, (None, None))
+    if alerts is None:
+        documents = corpusDocuments(size)
+        alerts = [parse.StreamCAP(StringIO(data), None, name) for name, data in documents]
+        _corpora[size] = (documents, alerts)
+    return alerts
+
+def corpusPolygons(size):
+    return [polygon for alert in corpusAlerts(size) for info in alert.infos for area in info.areas for polygon in area.polygons]
+
+def repeats(size):
+    if size > 10000:
+        return 1
+    return 3
+
+def benchCorpusReadCAP(sizes=DEFAULT_SIZES):
+    for size in sizes:
+        documents = corpusDocuments(size)
+        print "ReadCAP over {0} synthetic alerts ({1:.1f} MB)".format(size, sum(len(d) for n, d in documents) / 1e6)
+        report('StreamCAP x{0}'.format(size), best(lambda: [parse.StreamCAP(StringIO(data), None, name) for name, data in documents], repeat=repeats(size)), count=size)
+
+def benchCorpusFeed(sizes=DEFAULT_SIZES):
+    for size in sizes:
+        links = ['http://alerts.example.com/cap/{0}.cap'.format(name) for name, data in corpusDocuments(size)]
+        f = tempfile.NamedTemporaryFile(suffix='.atom')
+        f.write(parse._atomFeed(links))
+        f.flush()
+        url = 'file://' + f.name
+        seen = set(links[len(links) / 100:])
+        print "feedParser over an atom feed of {0} entries, 1% of them new".format(size)
+        report('feedParser x{0}'.format(size), best(lambda: parse.feedParser(url), repeat=repeats(size)), count=size)
+        report('feedParser, new only x{0}'.format(size), best(lambda: parse.feedParser(url, None, seen.__contains__), repeat=repeats(size)), count=size)
+        f.close()
+
+def benchCorpusMatch(sizes=DEFAULT_SIZES):
+    coords = (38.56513, -121.75156)
+    for size in sizes:
+        alerts = corpusAlerts(size)
+        print "Location checks over {0} synthetic alerts".format(size)
+        report('checkUGC x{0}'.format(size), best(lambda: [a.checkUGC('CA', '06113', '017') for a in alerts], repeat=repeats(size)), count=size)
+        report('checkCoords x{0}'.format(size), best(lambda: [a.checkCoords(coords) for a in alerts], repeat=repeats(size)), count=size)
+
+def benchCorpusEncode(sizes=DEFAULT_SIZES):
+    for size in sizes:
+        polygons = corpusPolygons(size)
+        vertices = sum(len(p) for p in polygons)
+        print "{0} polygons ({1} vertices) of {2} synthetic alerts".format(len(polygons), vertices, size)
+        report('glineenc.encode_pairs x{0}'.format(len(polygons)), best(lambda: [glineenc.encode_pairs(p) for p in polygons], repeat=repeats(size)), count=len(polygons))
+
+def benchCorpusMap(sizes=DEFAULT_SIZES):
+    for size in sizes:
+        polygons = corpusPolygons(size)
+        print "{0} polygons of {1} synthetic alerts".format(len(polygons), size)
+        report('utils.mapPolygon x{0}'.format(len(polygons)), best(lambda: [utils.mapPolygon(p) for p in polygons], repeat=repeats(size)), count=len(polygons))
+
+def readMapPolygon(polygon, markerCoords='38.56513, -121.75156', areaDesc=' ', markerTitle=' '):
+    '''
+    utils.mapPolygon as it was before utils.Template, the baseline: the
+    templates read for every page, the coordinates added one at a time.
+    Only the template paths differ, made absolute. Its bugs are kept: the
+    last vertex written is a repeat of the one before, or, past 256
+    vertices where "is not" stops matching, every line ends in a comma.
+    '''
+    html = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'html')
+    p1 = open(os.path.join(html, 'poly1.html')).read().replace('ORIGIN', markerCoords).replace('MARKER_TITLE',markerTitle)
+    for x in range(len(polygon)):
+        if x is not len(polygon) - 1:
+            lat, long = polygon[x]
+            p1 +='new google.maps.LatLng(' + str(lat) + ', ' + str(long) + '),\n'
+        else:
+            p1 +='new google.maps.LatLng(' + str(lat) + ', ' + str(long) + ')\n'
+    p1 += open(os.path.join(html, 'poly2.html')).read().replace('INFOWINDOW_CONTENT',str(areaDesc).strip().replace("\n",'<br />'))
+    return p1
+
+def benchMap(alerts=20, polygons=3, vertices=1000, number=5):
+    areas = list()
+    for n in range(alerts):
+        area = cap.Area()
+        area.areaDesc = 'Synthetic area {0}'.format(n)
+        for x in range(polygons):
+            area.polygons.append(tuple(ring(vertices, center=(38.5 + x, -121.5))))
+        areas.append(area)
+    print "Map pages of {0} alerts with {1} polygons of {2} vertices".format(alerts, polygons, vertices)
+    slow = best(lambda: [readMapPolygon(p, areaDesc=a.areaDesc) for a in areas for p in a.polygons], number=number)
+    report('read templates + concatenate', slow)
+    report('utils.mapPolygon', best(lambda: [utils.mapPolygon(p, areaDesc=a.areaDesc) for a in areas for p in a.polygons], number=number), slow)
+    # Template fill only, no encoding: what alertPage draws on a miss.
+    report('utils.mapAreas, coordinates', best(lambda: [utils.mapAreas([a], encode=None) for a in areas], number=number), slow)
+    alerts = list()
+    for area in areas:
+        info = cap.Info()
+        info.areas.append(area)
+        alert = cap.Alert()
+        alert.infos.append(info)
+        alerts.append(alert)
+    # What the window waits for: alertPage of a page the worker cached, of
+    # a page evicted (maxBytes=0) with its encodings still cached, and the
+    # worker's own render() of a page never seen.
+    maps = MapCache()
+    evicted = MapCache(maxBytes=0)
+    for alert in alerts:
+        maps.render(alert)
+        evicted.render(alert)
+    report('MapCache.alertPage, cached', best(lambda: [maps.alertPage(a) for a in alerts], number=number), slow)
+    report('MapCache.alertPage, page evicted', best(lambda: [evicted.alertPage(a) for a in alerts], number=number), slow)
+    report('MapCache.render (worker thread)', best(lambda: [MapCache().render(a) for a in alerts], repeat=3))
+    pages = sum(len(utils.mapPolygon(p)) for p in areas[0].polygons)
+    reportAmount('page bytes, mapPolygon pages', pages, 'bytes/alert')
+    reportAmount('page bytes, mapAreas coordinates', len(utils.mapAreas(areas[:1], encode=None)), 'bytes/alert', pages)
+    reportAmount('page bytes, mapAreas encoded', len(utils.mapAreas(areas[:1])), 'bytes/alert', pages)
+
+def benchExpiry(sizes=DEFAULT_SIZES):
+    for size in sizes:
+        alerts = corpusAlerts(size)
+        def eject():
+            ingest = engine.IngestEngine(feeds=[], cache=HTTPCache(None), store=AlertStore(None), eventQueueSize=0)
+            # No expiry timer threads; ejectExpired is called by hand.
+            ingest.stopping.set()
+            for alert in alerts:
+                ingest.admit(alert, True)
+            start = time.time()
+            ingest.ejectExpired()
+            seconds = time.time() - start
+            assert len(ingest.active) == 0
+            return seconds
+        print "ejectExpired of {0} synthetic alerts, all expired".format(size)
+        report('ejectExpired x{0}'.format(size), min(eject() for x in range(repeats(size))), count=size)
+
+BENCHMARKS = [
+              ('readcap', benchReadCAP),
+              ('feed', benchFeed),
+              ('geo', benchGeo),
+              ('timestamps', benchTimestamps),
+              ('memory', benchMemory),
+              ('corpus-readcap', benchCorpusReadCAP),
+              ('corpus-feed', benchCorpusFeed),
+              ('corpus-match', benchCorpusMatch),
+              ('corpus-encode', benchCorpusEncode),
+              ('corpus-map', benchCorpusMap),
+              ('map', benchMap),
+              ('expiry', benchExpiry),
+              ]
+SIZED = ('corpus-readcap', 'corpus-feed', 'corpus-match', 'corpus-encode', 'corpus-map', 'expiry')
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] [benchmark...]")
+    parser.add_option('--sizes', default=','.join(str(x) for x in DEFAULT_SIZES),
+                      help="synthetic corpus sizes, comma separated [default: %default]")
+    parser.add_option('--json', help="also write the results to this file")
+    options, names = parser.parse_args(argv)
+    sizes = [int(x) for x in options.sizes.split(',')]
+    logging.basicConfig(level=logging.CRITICAL)
+    for name, func in BENCHMARKS:
+        if len(names) is 0 or name in names:
+            CURRENT[0] = name
+            if name in SIZED:
+                func(sizes)
+            else:
+                func()
+            print
+    if options.json is not None:
+        with open(options.json, 'w') as f:
+            json.dump(dict({
+                            'time': datetime.utcnow().isoformat() + 'Z',
+                            'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'cpus': multiprocessing.cpu_count(),
+                            'sizes': sizes,
+                            'results': RESULTS,
+                            }), f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
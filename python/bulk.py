@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+'''
+Bulk parsing of archived CAP files on every core, into the alert store.
+
+    python bulk.py ../caps                   # parse into the default store
+    python bulk.py -j 4 --db /tmp/a.db dir   # 4 processes, another store
+    python bulk.py --scaling --repeat 500 ../caps
+                                             # alerts/sec for 1..N processes
+'''
+
+import os
+import sys
+import glob
+import time
+import logging
+import multiprocessing
+from optparse import OptionParser
+from StringIO import StringIO
+import parse
+from store import AlertStore, DEFAULT_PATH
+
+DEFAULT_CHUNK = 64 # CAP documents per round trip to a worker process
+
+Log = logging.getLogger()
+
+def parseChunk(chunk):
+    '''
+    Runs in the worker processes: [(name, raw CAP bytes)] ->
+    [(name, alert)], alert None where the CAP could not be read. Alerts
+    come back pickled, which cap.Slotted keeps small.
+    '''
+    results = list()
+    for name, data in chunk:
+        try:
+            alert = parse.StreamCAP(StringIO(data), None, name)
+        except:
+            Log.error("Unexpected error parsing CAP {0}".format(name), exc_info=True)
+            alert = None
+        results.append((name, alert))
+    return results
+
+def chunks(items, size):
+    chunk = list()
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = list()
+    if len(chunk) > 0:
+        yield chunk
+
+class ParsePool:
+    '''
+    parse.StreamCAP on a pool of processes, so parsing is not held to one
+    core by the GIL. Raw bytes go out and alerts come back in chunks of
+    chunkSize documents, so the IPC cost is paid per chunk, not per CAP.
+    processes 1 parses in this process.
+    '''
+    def __init__(self, processes=None, chunkSize=DEFAULT_CHUNK):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.chunkSize = chunkSize
+        self.pool = None
+        if processes > 1:
+            self.pool = multiprocessing.Pool(processes)
+
+    def parse(self, documents):
+        '''
+        documents: iterable of (name, raw CAP bytes). Generator of
+        (name, alert) in completion order, alert None on failure.
+        '''
+        if self.pool is None:
+            for chunk in chunks(documents, self.chunkSize):
+                for result in parseChunk(chunk):
+                    yield result
+            return
+        for results in self.pool.imap_unordered(parseChunk, chunks(documents, self.chunkSize)):
+            for result in results:
+                yield result
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def readFiles(paths, repeat=1):
+    '''
+    (name, bytes) of every CAP file in paths (files, or directories whose
+    *.cap files are read), repeat times over.
+    '''
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.cap'))))
+        else:
+            files.append(path)
+    for n in range(repeat):
+        for name in files:
+            with open(name, 'rb') as f:
+                yield name, f.read()
+
+def bulkParse(paths, processes=None, chunkSize=DEFAULT_CHUNK, store=None, repeat=1):
+    '''
+    Parses every CAP under paths, putting them in store if given.
+    Returns (alerts parsed, failures, seconds).
+    '''
+    pool = ParsePool(processes, chunkSize)
+    parsed = 0
+    failed = 0
+    batch = list()
+    start = time.time()
+    try:
+        for name, alert in pool.parse(readFiles(paths, repeat)):
+            if alert is None:
+                failed += 1
+                continue
+            parsed += 1
+            if store is not None:
+                batch.append((alert, os.path.abspath(name)))
+                if len(batch) >= chunkSize:
+                    store.putMany(batch)
+                    batch = list()
+        if store is not None and len(batch) > 0:
+            store.putMany(batch)
+    finally:
+        pool.close()
+    return parsed, failed, time.time() - start
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] directory-or-file...")
+    parser.add_option('-j', '--processes', type='int', default=multiprocessing.cpu_count(),
+                      help="worker processes [default: %default, the number of cores]")
+    parser.add_option('--chunk', type='int', default=DEFAULT_CHUNK, help="CAPs per worker round trip [default: %default]")
+    parser.add_option('--db', default=DEFAULT_PATH, help="alert store to fill [default: %default]")
+    parser.add_option('--repeat', type='int', default=1, help="parse everything this many times, for timing")
+    parser.add_option('--scaling', action='store_true', help="only time 1..PROCESSES processes, store nothing")
+    options, paths = parser.parse_args(argv)
+    if len(paths) is 0:
+        parser.error("no CAP files or directories given")
+    logging.basicConfig(level=logging.CRITICAL)
+    cores = multiprocessing.cpu_count()
+
+    if options.scaling:
+        print "{0:>9} {1:>10} {2:>12} {3:>8}".format('processes', 'alerts', 'alerts/sec', 'speedup')
+        base = None
+        for processes in range(1, options.processes + 1):
+            parsed, failed, seconds = bulkParse(paths, processes, options.chunk, None, options.repeat)
+            rate = parsed / seconds
+            if base is None:
+                base = rate
+            print "{0:>9} {1:>10} {2:>12.1f} {3:>7.2f}x".format(processes, parsed, rate, rate / base)
+        print "({0} cores)".format(cores)
+        return
+
+    store = AlertStore(options.db)
+    parsed, failed, seconds = bulkParse(paths, options.processes, options.chunk, store, options.repeat)
+    store.close()
+    print "{0} alerts ({1} unreadable) into {2} in {3:.2f}s: {4:.1f} alerts/sec with {5} processes on {6} cores".format(
+        parsed, failed, options.db, seconds, parsed / seconds, options.processes, cores)
+
+def test_parse_pool_matches_serial():
+    caps = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'caps')
+    documents = list(readFiles([caps], repeat=3))
+    serial = dict((name, parse.ReadCAP(name)) for name, data in documents)
+    pool = ParsePool(processes=2, chunkSize=5)
+    results = list(pool.parse(documents))
+    pool.close()
+    assert len(results) == len(documents)
+    for name, alert in results:
+        assert parse._state(alert) == parse._state(serial[name])
+
+    store = AlertStore(None)
+    parsed, failed, seconds = bulkParse([caps], processes=2, chunkSize=3, store=store)
+    assert parsed == len(serial) and failed == 0
+    alerts, seen = store.load(now=0)
+    assert sorted(a.id for a in alerts) == sorted(a.id for a in serial.itervalues())
+    store.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
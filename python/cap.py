@@ -21,22 +21,148 @@
 from datetime import datetime
 from datetime import timedelta
 from dateutil import parser as dateparser
-import dateutil
 import logging 
 import base64
 import re
+import threading
 import utils
+from collections import OrderedDict
 from dateutil import zoneinfo
 
 DEFAULT_EXPIRES = timedelta(hours=24) # 24 hours
+DATETIME_MEMO_SIZE = 4096 # recently parsed timestamps kept by unicodeToDatetime
+CODE_MEMO_SIZE = 2048 # recently decoded VTEC and UGC strings
 
 Log = logging.getLogger()
 
+UTC = zoneinfo.gettz('UTC')
+
+# CAP 1.2 3.3.2: "2002-05-24T16:49:00-07:00". Fractional seconds and a
+# trailing Z are not in the spec but are seen in the wild.
+CAP_DATETIME = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(?:(Z)|([+-])(\d\d):?(\d\d))$')
+VTEC_DATETIME = re.compile(r'(\d\d)(\d\d)(\d\d)T(\d\d)(\d\d)Z$')
+
+class LRUCache:
+    '''
+    Memo holding the size most recently used entries. Safe to share
+    between the parse threads.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[key] = value
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+_datetimes = LRUCache(DATETIME_MEMO_SIZE)
+_pvtecs = LRUCache(CODE_MEMO_SIZE) # raw P-VTEC -> decoded field values
+_hvtecs = LRUCache(CODE_MEMO_SIZE) # raw H-VTEC -> decoded field values
+_ugcs = LRUCache(CODE_MEMO_SIZE) # raw UGC -> UGC.compile result
+
+def parseCAPDatetime(text):
+    '''
+    Fixed-format reader for CAP timestamps, returning a UTC datetime, or
+    None if text is not in the CAP format.
+    '''
+    m = CAP_DATETIME.match(text)
+    if m is None:
+        return None
+    year, month, day, hour, minute, second, fraction, zulu, sign, tzhour, tzminute = m.groups()
+    microsecond = 0
+    if fraction is not None:
+        microsecond = int((fraction + '00000')[0:6])
+    try:
+        dt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond)
+    except ValueError:
+        return None
+    if zulu is None:
+        offset = timedelta(hours=int(tzhour), minutes=int(tzminute))
+        if sign == '-':
+            dt += offset
+        else:
+            dt -= offset
+    return dt.replace(tzinfo=UTC)
+
 def unicodeToDatetime(text):
     #2002-05-24T16:49:00-07:00
-    return dateparser.parse(text).astimezone(zoneinfo.gettz('UTC'))
+    dt = _datetimes.get(text)
+    if dt is None:
+        dt = parseCAPDatetime(text.strip())
+        if dt is None:
+            dt = dateparser.parse(text).astimezone(UTC)
+        _datetimes.put(text, dt)
+    return dt
+
+def vtecToDatetime(text):
+    '''
+    datetime.strptime(text, "%y%m%dT%H%MZ") in UTC, without strptime.
+    '''
+    m = VTEC_DATETIME.match(text)
+    if m is None:
+        return datetime.strptime(text, "%y%m%dT%H%MZ").replace(tzinfo=UTC)
+    year, month, day, hour, minute = [int(x) for x in m.groups()]
+    # strptime's %y pivot
+    if year < 69:
+        year += 2000
+    else:
+        year += 1900
+    return datetime(year, month, day, hour, minute, tzinfo=UTC)
+
+def internText(text):
+    '''
+    Shares one copy of short byte strings (codes, geocode names and
+    values) across every alert that carries them.
+    '''
+    if type(text) is str:
+        return intern(text)
+    return text
+
+class Slotted(object):
+    '''
+    Base of the CAP model classes. Attributes live in __slots__ instead of
+    a per instance __dict__; unset slots (e.g. Resource.size) are simply
+    left out of the pickled state, so alerts pickle under any protocol and
+    stores written before the classes had slots still load.
+    '''
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = dict()
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
 
-class Alert:
+class Alert(Slotted):
         
     STATUS_ACTUAL = u'Actual' # Actionable by all targeted recipients
     STATUS_EXERCISE = u'Exercise' # Actionable only by designated exercise participants; exercise identifier should appear in <note>  
@@ -53,6 +179,9 @@ class Alert:
     SCOPE_PUBLIC = u'Public'
     SCOPE_RESTRICTED = u'Restricted'
     SCOPE_PRIVATE = u'Private'
+
+    __slots__ = ('hasError', 'codes', 'references', 'infos', 'id', 'version', 'sender', 'sent', 'status',
+                 'msgType', 'source', 'scope', 'restriction', 'addresses', 'note', 'incidents', 'url', 'title')
     
     def __init__(self):
         self.hasError = False
@@ -71,8 +200,33 @@ class Alert:
         self.addresses = None
         self.note = None
         self.incidents = None
-        
+        self.url = None
+        self.title = None
+
+    def freeze(self):
+        '''
+        Called once the alert is fully parsed: the lists become tuples,
+        the sets frozensets, and repeated codes are interned. The add*
+        methods must not be used afterwards.
+        '''
+        self.codes = tuple(internText(x) for x in self.codes)
+        self.references = tuple(self.references)
+        self.infos = tuple(self.infos)
+        for info in self.infos:
+            info.freeze()
+        self.title = self.__title()
+        return self
+
     def getTitle(self):
+        '''
+        Worked out once by freeze(), since the window asks on every redraw.
+        '''
+        title = getattr(self, 'title', None)
+        if title is None:
+            title = self.__title()
+        return title
+
+    def __title(self):
         for info in self.infos:
             if info.vtec is not None and info.vtec.hasPVTEC:
                 return str.format("{0} {1}", info.vtec.phenomena, info.vtec.significance)
@@ -122,22 +276,11 @@ class Alert:
     def checkUGC(self, state='CA', fips='06000', nws_zone='000'):
         for info in self.infos:
             for area in info.areas:
-                if 'UGC' in area.geoCodes:
-                    for ugc_string in area.geoCodes['UGC']:
-                        if UGC.matchUGC(ugc_string, state, fips, nws_zone):
-                            return True
-                if 'FIPS6' in area.geoCodes:
-                    for x in area.geoCodes['FIPS6']:
-                        if len(x) > 5:
-                            x = x[len(x)-5:len(x)]
-                            if x == fips:
-                                return True
-                if 'FIPS' in area.geoCodes:
-                    for x in area.geoCodes['FIPS']:
-                        if len(x) > 5:
-                            x = x[len(x)-5:len(x)]
-                            if x == fips:
-                                return True
+                ugc, counties = area.getCompiledGeoCodes()
+                if UGC.matchCompiled(ugc, state, fips, nws_zone):
+                    return True
+                if fips in counties['FIPS6'] or fips in counties['FIPS']:
+                    return True
         return False
 
     def checkCoords(self, coords):
@@ -367,8 +510,19 @@ class Alert:
             if not info.isExpired():
                 return False
         return True
+
+    def getExpires(self):
+        '''
+        The latest expiry of all infos, which is when the alert as a whole
+        expires. None if there are no infos.
+        '''
+        expires = None
+        for info in self.infos:
+            if info.expires is not None and (expires is None or info.expires > expires):
+                expires = info.expires
+        return expires
             
-class Info:
+class Info(Slotted):
     # In addition to the specified subelements, MAY contain one or more <resource> blocks and/or one or more <area> blocks
     CATEGORY_GEO = 'Geo'
     CATEGORY_MET = 'Met'
@@ -466,6 +620,10 @@ class Info:
     CERTAINTY_POSSIBLE = u'Possible'
     CERTAINTY_UNLIKELY = u'Unlikely'
     CERTAINTY_UNKNOWN = u'Unknown'
+
+    __slots__ = ('language', 'categories', 'responseTypes', 'eventCodes', 'parameters', 'resources', 'areas',
+                 'event', 'urgency', 'severity', 'certainty', 'audience', 'effective', 'onset', 'expires',
+                 'senderName', 'headline', 'description', 'instruction', 'web', 'contact', 'vtec')
     
     def __init__(self):
         self.language = u'en-US'
@@ -490,6 +648,16 @@ class Info:
         self.web = None
         self.contact = None
         self.vtec = None
+
+    def freeze(self):
+        self.categories = frozenset(self.categories)
+        self.responseTypes = frozenset(self.responseTypes)
+        self.eventCodes = dict((internText(k), internText(v)) for k, v in self.eventCodes.iteritems())
+        self.parameters = dict((internText(k), v) for k, v in self.parameters.iteritems())
+        self.resources = tuple(self.resources)
+        self.areas = tuple(self.areas)
+        for area in self.areas:
+            area.freeze()
         
     def setLanguage(self, language):
         if len(language) > 0:
@@ -677,7 +845,7 @@ class Info:
         self.expires = unicodeToDatetime(expires)
     
     def isExpired(self):
-        return datetime.now(zoneinfo.gettz('UTC')) > self.expires.astimezone(zoneinfo.gettz('UTC'))
+        return datetime.now(UTC) > self.expires
 
     @staticmethod
     def aboutExpires():
@@ -764,7 +932,9 @@ class Info:
     def addArea(self, area):
         self.areas.append(area)
         
-class Resource:
+class Resource(Slotted):
+    __slots__ = ('resourceDesc', 'mimeType', 'size', 'uri', 'derefUri', 'digest')
+
     def setResourceDesc(self, resourceDesc):
         if resourceDesc is not None:
             self.resourceDesc = resourceDesc.strip()
@@ -811,12 +981,20 @@ class Resource:
     def aboutDigest():
         return u'The code representing the digital digest (“hash”) computed from the resource file. Computed using SHA-1.'
     
-class Area:
+class Area(Slotted):
+    __slots__ = ('polygons', 'circles', 'geoCodes', 'areaDesc', 'compiled', 'altitude', 'ceiling')
+
     def __init__(self):
         self.polygons = list()
         self.circles = list()
         self.geoCodes = dict()
         self.areaDesc = None
+        self.compiled = None
+
+    def freeze(self):
+        self.polygons = tuple(tuple(p) for p in self.polygons)
+        self.circles = tuple(self.circles)
+        self.geoCodes = dict((internText(k), tuple(internText(x) for x in v)) for k, v in self.geoCodes.iteritems())
         
     def setAreaDesc(self, areaDesc):
         self.areaDesc = areaDesc
@@ -866,6 +1044,30 @@ class Area:
             x = list()
             x.append(value)
             self.geoCodes[key] = x
+        self.compiled = None
+
+    COUNTY_CODES = ('FIPS6', 'FIPS', 'SAME')
+
+    def getCompiledGeoCodes(self):
+        '''
+        (ugc, counties): the UGC strings merged by UGC.compile, and for each
+        of COUNTY_CODES the set of 5 digit county codes taken from values
+        longer than 5 characters. Built once and reused until the next
+        addGeoCode.
+        '''
+        if self.compiled is None:
+            ugc = dict()
+            for ugc_string in self.geoCodes.get('UGC', ()):
+                for key, (codes, ranges) in UGC.compile(ugc_string).iteritems():
+                    if key in ugc:
+                        ugc[key] = (ugc[key][0] | codes, ugc[key][1] + ranges)
+                    else:
+                        ugc[key] = (codes, ranges)
+            counties = dict()
+            for kind in Area.COUNTY_CODES:
+                counties[kind] = frozenset(x[len(x)-5:len(x)] for x in self.geoCodes.get(kind, ()) if len(x) > 5)
+            self.compiled = (ugc, counties)
+        return self.compiled
     
     @staticmethod
     def aboutGeoCode():
@@ -997,11 +1199,13 @@ class NWIS:
         
     @staticmethod
     def expandNWIS(nwis):
+        if nwis in NWIS.nwis:
+            return NWIS.nwis[nwis]
         if nwis.upper() in NWIS.nwis:
             return NWIS.nwis[nwis.upper()]
         else:
             return nwis
-class VTEC:
+class VTEC(Slotted):
     # http://www.weather.gov/om/vtec/
     PRODUCT_CLASSES = dict({'O': 'Operational Product',
                   'T': 'Test Product',
@@ -1184,6 +1388,10 @@ class VTEC:
                 Log.warning("Unknown Flood Record Status {0}".format(frs))
         return 'Unknown record status'
     
+    __slots__ = ('hasPVTEC', 'hasHVTEC', 'product_class', 'actions', 'office_id', 'phenomena', 'significance',
+                 'event_tracking_number', 'begin', 'end', 'location_id', 'flood_severity', 'immediate_cause',
+                 'flood_begin', 'flood_crest', 'flood_end', 'flood_record_status')
+
     def __init__(self, vtec=""):
         self.hasPVTEC = False
         self.hasHVTEC = False
@@ -1200,63 +1408,70 @@ class VTEC:
                 return False
         return False
     
-    def populatePVTEC(self, vtec):
+    PVTEC_FIELDS = ('product_class', 'actions', 'office_id', 'phenomena', 'significance', 'event_tracking_number', 'begin', 'end')
+    HVTEC_FIELDS = ('location_id', 'flood_severity', 'immediate_cause', 'flood_begin', 'flood_crest', 'flood_end', 'flood_record_status')
+
+    @staticmethod
+    def decodePVTEC(vtec):
+        '''
+        The values of PVTEC_FIELDS for a raw P-VTEC string.
+        '''
         vtec = vtec.strip(' /')
-        pclass, actions, self.office_id, phenomena, significance, self.event_tracking_number, begin, end = re.split('[.-]',vtec)
-        self.product_class = VTEC.getProductClass(pclass)
-        self.actions = VTEC.getActions(actions)
-        self.phenomena = VTEC.getPhenomena(phenomena)
-        self.significance = VTEC.getSignificance(significance)
-        self.begin = None
-        self.end = None
-        
+        pclass, actions, office_id, phenomena, significance, event_tracking_number, begin, end = re.split('[.-]',vtec)
+        beginTime = None
+        endTime = None
         try:
             if begin != '000000T0000Z':
-                self.begin = datetime.strptime(begin,"%y%m%dT%H%MZ").replace(tzinfo=dateutil.tz.gettz('UTC'))
+                beginTime = vtecToDatetime(begin)
         except:
             Log.error("Invalid P-VTEC Event Beginning {0}".format(begin))
-            
+
         try:
             if end != '000000T0000Z':
-                self.end = datetime.strptime(end,"%y%m%dT%H%MZ").replace(tzinfo=dateutil.tz.gettz('UTC'))
+                endTime = vtecToDatetime(end)
         except:
             Log.error("Invalid P-VTEC Event End {0}".format(end))
-        self.hasPVTEC = True
-            
-    def populateHVTEC(self, vtec):
+        return (VTEC.getProductClass(pclass), VTEC.getActions(actions), internText(office_id),
+                VTEC.getPhenomena(phenomena), VTEC.getSignificance(significance),
+                internText(event_tracking_number), beginTime, endTime)
+
+    @staticmethod
+    def decodeHVTEC(vtec):
+        '''
+        The values of HVTEC_FIELDS for a raw H-VTEC string.
+        '''
         vtec = vtec.strip(' /')
-        self.location_id = vtec[0:5]
-        self.flood_severity =  VTEC.getFloodSeverity(vtec[6])
-        self.immediate_cause =  VTEC.getImmediateCause(vtec[8:10])
-        self.flood_begin = None
-        self.flood_crest = None
-        self.flood_end = None
-        
-        try:
-            if vtec[11:23] != '000000T0000Z':
-                self.flood_begin = datetime.strptime(vtec[11:23],"%y%m%dT%H%MZ").replace(tzinfo=dateutil.tz.gettz('UTC'))
-            else:
-                self.flood_begin = None
-        except:
-            Log.error("Invalid H-VTEC Crest Begin Time {0}".format(vtec[11:23]))
-        
-        try:
-            if vtec[24:36] != '000000T0000Z':
-                self.flood_crest = datetime.strptime(vtec[24:36],"%y%m%dT%H%MZ").replace(tzinfo=dateutil.tz.gettz('UTC'))   
-            else:
-                self.flood_crest = None
-        except:
-            Log.error("Invalid H-VTEC Flood Crest Time {0}".format(vtec[24:36]))
+        times = list()
+        for text, what in ((vtec[11:23], 'Crest Begin'), (vtec[24:36], 'Flood Crest'), (vtec[37:49], 'Flood End')):
+            try:
+                if text != '000000T0000Z':
+                    times.append(vtecToDatetime(text))
+                else:
+                    times.append(None)
+            except:
+                Log.error("Invalid H-VTEC {0} Time {1}".format(what, text))
+                times.append(None)
+        return (internText(vtec[0:5]), VTEC.getFloodSeverity(vtec[6]), VTEC.getImmediateCause(vtec[8:10]),
+                times[0], times[1], times[2], VTEC.getFloodRecordStatus(vtec[50:52]))
 
-        try:
-            if vtec[37:49] != '000000T0000Z':
-                self.flood_end = datetime.strptime(vtec[37:49],"%y%m%dT%H%MZ").replace(tzinfo=dateutil.tz.gettz('UTC'))
-            else:
-                self.flood_end = None
-        except:
-            Log.error("Invalid H-VTEC Flood End Time {0}".format(vtec[37:49]))
-            
-        self.flood_record_status = VTEC.getFloodRecordStatus(vtec[50:52])
+    def populatePVTEC(self, vtec):
+        # The same string comes back with every Update of a warning, so it
+        # is decoded once and the values are shared.
+        record = _pvtecs.get(vtec)
+        if record is None:
+            record = VTEC.decodePVTEC(vtec)
+            _pvtecs.put(vtec, record)
+        for name, value in zip(VTEC.PVTEC_FIELDS, record):
+            setattr(self, name, value)
+        self.hasPVTEC = True
+
+    def populateHVTEC(self, vtec):
+        record = _hvtecs.get(vtec)
+        if record is None:
+            record = VTEC.decodeHVTEC(vtec)
+            _hvtecs.put(vtec, record)
+        for name, value in zip(VTEC.HVTEC_FIELDS, record):
+            setattr(self, name, value)
         self.hasHVTEC = True
 
     def populateVTEC(self, vtec):
@@ -1297,89 +1512,93 @@ class UGC:
                     'Z': FORMAT_ZONE
                     })
     
+    ALL = 'ALL'
+
     @staticmethod
-    def matchUGC(ugc, state, FIPS='000', nws_zone='000'):
+    def compile(ugc):
         '''
-        ugc: Full UGC string
-        state: 2 letter string, post office ugc_state abbreviation
+        Parses a full UGC string once into {(state, format): (codes, ranges)}
+        where format is 'C' or 'Z', codes is a frozenset of 3 digit strings
+        (UGC.ALL for "ALL"/"000") and ranges a tuple of inclusive (start, end)
+        ints. Pass the result to matchCompiled. The result is shared between
+        calls with the same string and must not be modified.
         '''
-        if len(FIPS) > 3:
-            FIPS = FIPS[len(FIPS)-3:len(FIPS)]
+        compiled = _ugcs.get(ugc)
+        if compiled is None:
+            compiled = UGC.__compile(ugc)
+            _ugcs.put(ugc, compiled)
+        return compiled
+
+    @staticmethod
+    def __compile(ugc):
+        compiled = dict()
         ugc_state = None
         ugc_format = None
-        if ugc is not None:
-            for segment in ugc.split('-'):
-                if segment[0:2].isalpha():
-                    ugc_state = segment[0:2]
-                    if state != ugc_state:
-                        continue
-                    if segment[3:6] is 'ALL' or segment[3:6] is '000':
-                        return True
-                    ugc_format = UGC.FORMATS[segment[2]]
-                    if len(segment) is 6:
-                        if ugc_format is UGC.FORMAT_FIPS:
-                            if segment[3:6] == FIPS:
-                                return True
-                            else:
-                                continue
-                        elif ugc_format is UGC.FORMAT_ZONE:
-                            if segment[3:6] == nws_zone:
-                                return True
-                            else:
-                                continue
-                        else:
-                            Log.error('Error parsing UGC code {0} at segment {1}'.format(ugc, segment))
-                    elif len(segment) is 10:                        
-                        start, end = segment[3:10].split('>')
-                        start = int(start)
-                        end = int(end)
-                        if ugc_format is UGC.FORMAT_FIPS:
-                            target = int(FIPS)
-                        elif ugc_format is UGC.FORMAT_ZONE:
-                            target = int(nws_zone)
-                        if target >= start and target <= end:
-                            return True
-                        else:
-                            continue
-                    else:
-                        Log.error('Error parsing UGC code {0} at segment {1}'.format(ugc, segment))
-                elif len(segment) is 3:
-                    if state != ugc_state:
-                        continue
-                    if ugc_format is UGC.FORMAT_FIPS:
-                        if segment == FIPS:
-                            return True
-                        else:
-                            continue
-                    elif ugc_format is UGC.FORMAT_ZONE:
-                        if segment == nws_zone:
-                            return True
-                        else:
-                            continue
-                    else:
-                        Log.error('Error parsing UGC code {0} at segment {1}'.format(ugc, segment))
-                elif len(segment) is 7:
-                    if state != ugc_state:
-                        continue
-                    start, end = segment.split('>')
-                    start = int(start)
-                    end = int(end)
-                    if ugc_format is UGC.FORMAT_FIPS:
-                        target = int(FIPS)
-                    elif ugc_format is UGC.FORMAT_ZONE:
-                        target = int(nws_zone)
-                    if target >= start and target <= end:
-                        return True
-                    else:
-                        continue
-                elif len(segment) is 6:
-                    #Log.debug('Found UGC datetime {0} in UGC {1}'.format(segment, ugc))
-                    continue
+        if ugc is None:
+            return compiled
+        def add(code=None, range=None):
+            if ugc_state is None or ugc_format is None:
+                return
+            codes, ranges = compiled.setdefault((ugc_state, ugc_format), (set(), list()))
+            if code is not None:
+                codes.add(code)
+            if range is not None:
+                ranges.append(range)
+        for segment in ugc.split('-'):
+            if segment[0:2].isalpha():
+                ugc_state = segment[0:2]
+                if segment[2:3] in UGC.FORMATS:
+                    ugc_format = segment[2]
                 else:
-                    if len(segment) > 0:
-                        Log.error('Unexpected UGC segment {0} in {1}'.format(segment, ugc))
+                    Log.error('Error parsing UGC code {0} at segment {1}'.format(ugc, segment))
+                    ugc_format = None
                     continue
+                if segment[3:6] == 'ALL' or segment[3:6] == '000':
+                    add(UGC.ALL)
+                elif len(segment) is 6:
+                    add(segment[3:6])
+                elif len(segment) is 10:
+                    start, end = segment[3:10].split('>')
+                    add(range=(int(start), int(end)))
+                else:
+                    Log.error('Error parsing UGC code {0} at segment {1}'.format(ugc, segment))
+            elif len(segment) is 3:
+                add(segment)
+            elif len(segment) is 7:
+                start, end = segment.split('>')
+                add(range=(int(start), int(end)))
+            elif len(segment) is 6:
+                #Log.debug('Found UGC datetime {0} in UGC {1}'.format(segment, ugc))
+                continue
+            else:
+                if len(segment) > 0:
+                    Log.error('Unexpected UGC segment {0} in {1}'.format(segment, ugc))
+                continue
+        return dict((key, (frozenset(codes), tuple(ranges))) for key, (codes, ranges) in compiled.iteritems())
+
+    @staticmethod
+    def matchCompiled(compiled, state, FIPS='000', nws_zone='000'):
+        if len(FIPS) > 3:
+            FIPS = FIPS[len(FIPS)-3:len(FIPS)]
+        for ugc_format, target in (('C', FIPS), ('Z', nws_zone)):
+            if (state, ugc_format) in compiled:
+                codes, ranges = compiled[(state, ugc_format)]
+                if UGC.ALL in codes or target in codes:
+                    return True
+                if len(ranges) > 0:
+                    target = int(target)
+                    for start, end in ranges:
+                        if target >= start and target <= end:
+                            return True
         return False
+
+    @staticmethod
+    def matchUGC(ugc, state, FIPS='000', nws_zone='000'):
+        '''
+        ugc: Full UGC string
+        state: 2 letter string, post office ugc_state abbreviation
+        '''
+        return UGC.matchCompiled(UGC.compile(ugc), state, FIPS, nws_zone)
                         
 class WFO:
     WEBSITES = dict({
@@ -1523,3 +1742,60 @@ class WFO:
                      # 'RIW'
                      #==========================================================
                      })
+
+def test_unicodeToDatetime_matches_dateutil():
+    import random
+    random.seed(11)
+    texts = [u'2002-05-24T16:49:00-07:00', u'2011-03-20T04:00:00Z', u' 2011-12-31T23:30:00+05:30 ',
+             u'2011-03-20T04:00:00.25-08:00', u'2011-03-20T04:00:00+0100', u'20 Mar 2011 04:00:00 -0800']
+    for n in range(500):
+        texts.append(u'{0:04d}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}{6}{7:02d}:{8:02d}'.format(
+            random.randint(1990, 2030), random.randint(1, 12), random.randint(1, 28),
+            random.randint(0, 23), random.randint(0, 59), random.randint(0, 59),
+            random.choice('+-'), random.randint(0, 14), random.choice((0, 30, 45))))
+    for text in texts:
+        expected = dateparser.parse(text).astimezone(UTC)
+        if 'T' in text:
+            assert parseCAPDatetime(text.strip()) == expected
+        assert unicodeToDatetime(text) == expected
+        assert unicodeToDatetime(text) is unicodeToDatetime(text)
+
+def test_vtecToDatetime_matches_strptime():
+    for text in ('110320T1600Z', '991231T2359Z', '680101T0000Z', '690101T0000Z'):
+        assert vtecToDatetime(text) == datetime.strptime(text, "%y%m%dT%H%MZ").replace(tzinfo=UTC)
+    try:
+        vtecToDatetime('111320T1600Z')
+        assert False
+    except ValueError:
+        pass
+
+def test_vtec_memo():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+
+    pvtec = '/O.EXT.KSTO.HW.W.0002.110320T1600Z-110321T1800Z/'
+    hvtec = '/00000.N.ER.110320T1600Z.000000T0000Z.110321T1800Z.NO/'
+    first = VTEC(pvtec + hvtec)
+    second = VTEC(pvtec + hvtec)
+    # Decoded once, the values are shared, and they match a fresh decode.
+    assert second.begin is first.begin and second.flood_end is first.flood_end
+    for fields, record in ((VTEC.PVTEC_FIELDS, VTEC.decodePVTEC(pvtec)), (VTEC.HVTEC_FIELDS, VTEC.decodeHVTEC(hvtec.strip('/')))):
+        assert tuple(getattr(second, name) for name in fields) == record
+    assert first.actions == 'Event Extended (Time)' and first.flood_crest is None
+    assert first.end == datetime(2011, 3, 21, 18, tzinfo=UTC)
+    # Each VTEC can still be combined with another without touching the rest.
+    first.combine(VTEC('/O.NEW.KSTO.HW.A.0003.110320T1600Z-110321T1200Z/'))
+    assert second.significance == 'Warning'
+
+    assert UGC.compile('CAZ017-018>020-201500-') is UGC.compile('CAZ017-018>020-201500-')
+    alert = Alert()
+    info = Info()
+    info.eventCodes['SAME'] = 'hww'
+    alert.addInfo(info)
+    assert alert.getTitle() == 'High Wind Warning'
+    alert.freeze()
+    assert alert.title == 'High Wind Warning' and alert.getTitle() is alert.title
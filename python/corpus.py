@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+'''
+Synthetic CAP corpora scaled up from the sample alerts in caps/, for
+benchmarks and load tests.
+
+    python corpus.py DIR 10000    # write 10000 alerts to DIR/synthetic-*.cap
+'''
+
+import os
+import sys
+import copy
+import glob
+import math
+import random
+from datetime import datetime, timedelta
+from lxml import etree
+
+CAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'caps')
+
+# Each synthetic alert picks one of each at random.
+INFO_COUNTS = (1, 1, 1, 2, 3)
+POLYGON_SIZES = (0, 5, 16, 60, 250, 1000) # vertices, 0 for no polygon
+UGC_LENGTHS = (1, 3, 8, 20, 60) # zones
+VTEC_CHANCE = 0.5
+OFFICES = ('KSTO', 'KMTR', 'KHNX', 'KREV', 'KEKA', 'KLOX')
+PHENOMENA = ('HW', 'WS', 'FF', 'FL', 'SV', 'TO', 'WI', 'FG')
+SIGNIFICANCES = ('W', 'A', 'Y', 'S')
+START = datetime(2011, 10, 3, 12)
+
+def _local(element):
+    return etree.QName(element).localname
+
+def _children(element, name):
+    return [child for child in element if isinstance(child.tag, basestring) and _local(child) == name]
+
+def _element(parent, name, text=None):
+    namespace = etree.QName(parent).namespace
+    if namespace is not None:
+        name = '{%s}%s' % (namespace, name)
+    child = etree.SubElement(parent, name)
+    child.text = text
+    return child
+
+def templates(directory=CAPS_DIR):
+    '''
+    (name, root element) of each caps/alert*.cap.
+    '''
+    return [(os.path.basename(f), etree.parse(f).getroot()) for f in sorted(glob.glob(os.path.join(directory, 'alert*.cap')))]
+
+def timestamp(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S-00:00')
+
+def polygon(rng, vertices):
+    center = (rng.uniform(33.0, 41.5), rng.uniform(-123.5, -115.0))
+    radius = rng.uniform(0.05, 1.5)
+    points = list()
+    for n in range(vertices):
+        theta = 2 * math.pi * n / vertices
+        r = radius * rng.uniform(0.6, 1.0)
+        points.append((center[0] + r * math.cos(theta), center[1] + r * math.sin(theta)))
+    points.append(points[0])
+    return ' '.join('{0:.5f},{1:.5f}'.format(x, y) for x, y in points)
+
+def ugc(rng, zones):
+    '''
+    A UGC string of about zones zones, some of them as ranges.
+    '''
+    segments = list()
+    state = None
+    count = 0
+    while count < zones:
+        if state is None or rng.random() < 0.1:
+            state = rng.choice(('CA', 'NV', 'OR'))
+            prefix = state + rng.choice('CZ')
+        else:
+            prefix = ''
+        start = rng.randint(1, 990)
+        if rng.random() < 0.3:
+            width = rng.randint(1, 8)
+            segments.append('{0}{1:03d}>{2:03d}'.format(prefix, start, start + width))
+            count += width + 1
+        else:
+            segments.append('{0}{1:03d}'.format(prefix, start))
+            count += 1
+    segments.append('{0:02d}{1:02d}00'.format(rng.randint(1, 28), rng.randint(0, 23)))
+    return '-'.join(segments) + '-'
+
+def vtec(rng, n, begin, end):
+    return '/O.{0}.{1}.{2}.{3}.{4:04d}.{5}-{6}/'.format(rng.choice(('NEW', 'CON', 'EXT', 'CAN')), rng.choice(OFFICES),
+                                                       rng.choice(PHENOMENA), rng.choice(SIGNIFICANCES), n % 10000,
+                                                       begin.strftime('%y%m%dT%H%MZ'), end.strftime('%y%m%dT%H%MZ'))
+
+def varyInfo(info, rng, n, sent):
+    expires = sent + timedelta(hours=rng.randint(1, 48))
+    found = _children(info, 'expires')
+    if len(found) > 0:
+        found[0].text = timestamp(expires)
+    else:
+        _element(info, 'expires', timestamp(expires))
+    for parameter in _children(info, 'parameter'):
+        names = _children(parameter, 'valueName')
+        if len(names) > 0 and names[0].text is not None and names[0].text.strip() == 'VTEC':
+            info.remove(parameter)
+    if rng.random() < VTEC_CHANCE:
+        parameter = _element(info, 'parameter')
+        _element(parameter, 'valueName', 'VTEC')
+        _element(parameter, 'value', vtec(rng, n, sent, expires))
+
+    areas = _children(info, 'area')
+    if len(areas) is 0:
+        areas = [_element(info, 'area')]
+        _element(areas[0], 'areaDesc', 'Synthetic area {0}'.format(n))
+    for area in areas:
+        for old in _children(area, 'polygon') + _children(area, 'geocode'):
+            area.remove(old)
+        vertices = rng.choice(POLYGON_SIZES)
+        if vertices > 0:
+            _element(area, 'polygon', polygon(rng, vertices))
+        geocode = _element(area, 'geocode')
+        _element(geocode, 'valueName', 'UGC')
+        _element(geocode, 'value', ugc(rng, rng.choice(UGC_LENGTHS)))
+
+def synthesize(count, seed=0, directory=CAPS_DIR):
+    '''
+    Generator of count (name, CAP bytes), cycling through the sample
+    alerts with a fresh identifier, sent and expiry times, and randomly
+    chosen info counts, polygon sizes, UGC lengths and VTEC. The same
+    seed always gives the same corpus.
+    '''
+    rng = random.Random(seed)
+    sources = templates(directory)
+    for n in xrange(count):
+        source, root = sources[n % len(sources)]
+        alert = copy.deepcopy(root)
+        sent = START + timedelta(seconds=n * 7)
+        for name, text in (('identifier', 'SYNTHETIC-{0:06d}'.format(n)), ('sent', timestamp(sent))):
+            found = _children(alert, name)
+            if len(found) > 0:
+                found[0].text = text
+        infos = _children(alert, 'info')
+        if len(infos) > 0:
+            for info in infos[1:]:
+                alert.remove(info)
+            for x in range(rng.choice(INFO_COUNTS) - 1):
+                infos[0].addnext(copy.deepcopy(infos[0]))
+            for info in _children(alert, 'info'):
+                varyInfo(info, rng, n, sent)
+        yield 'synthetic-{0:06d}-{1}'.format(n, source), etree.tostring(alert, xml_declaration=True, encoding='UTF-8')
+
+def writeCorpus(directory, count, seed=0):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    names = list()
+    for name, data in synthesize(count, seed):
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        names.append(path)
+    return names
+
+def test_synthesize():
+    from StringIO import StringIO
+    import parse
+    documents = list(synthesize(40, seed=5))
+    assert documents == list(synthesize(40, seed=5))
+    infos = set()
+    polygons = set()
+    vtecs = 0
+    for name, data in documents:
+        alert = parse.StreamCAP(StringIO(data), None, name)
+        assert alert.id == 'SYNTHETIC-' + name[10:16]
+        assert len(alert.infos) in INFO_COUNTS
+        infos.add(len(alert.infos))
+        for info in alert.infos:
+            assert info.expires > alert.sent
+            if info.vtec is not None and info.vtec.hasPVTEC:
+                vtecs += 1
+            for area in info.areas:
+                assert len(area.geoCodes['UGC']) == 1
+                polygons.add(sum(len(p) for p in area.polygons))
+    # The knobs really vary.
+    assert len(infos) > 1 and len(polygons) > 3 and 0 < vtecs
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print __doc__
+        sys.exit(1)
+    print "Wrote {0} alerts to {1}".format(len(writeCorpus(sys.argv[1], int(sys.argv[2]))), sys.argv[1])
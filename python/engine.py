@@ -0,0 +1,451 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+'''
+Headless ingestion: feed polling, CAP fetching and parsing, location
+filtering and expiry. Nothing in here imports gtk or pynotify; the tray
+is just one consumer of IngestEngine.events.
+
+Run it on its own to log alerts on a server:
+    python engine.py [--stats-port 9464] [--stats-file stats.json]
+'''
+
+import sys
+import time
+import logging
+import threading
+import Queue
+import parse
+import fetch
+import metrics
+from pipeline import Pipeline
+from httpcache import HTTPCache
+from spatial import AlertIndex
+from geocode import GeocodeIndex
+from store import AlertStore, SEEN_HORIZON, epoch
+from seen import SeenSet
+from expiry import ExpiryScheduler
+from events import EventIndex
+from feeds import FeedScheduler
+
+LATLONG_COORDS = (38.56513,-121.75156)
+STATECODE = 'CA'
+FIPSCODE = '06113'
+UGCCODE = '017'
+
+POLL_INTERVAL = 60*10 # seconds, for feeds given without their own
+FETCH_WORKERS = 8
+PARSE_WORKERS = 2
+EVENT_QUEUE_SIZE = 1000 # events the GUI may fall behind by before ingestion waits for it
+STATS_PORT = None # serve metrics on http://127.0.0.1:STATS_PORT/metrics, None for off
+STATS_FILE = None # or dump them to this file every metrics.DUMP_INTERVAL
+
+# A feed is a url, (url, seconds between polls), or (url, seconds,
+# stopAfter) for a feed that lists its newest entries first: reading it
+# stops after stopAfter already seen entries in a row.
+DEFAULT_FEEDS = [
+#                 ('http://www.usgs.gov/hazard_alert/alerts/landslides.rss', 60*60),
+#                 ('http://alerts.weather.gov/cap/us.php?x=0', 60),
+#                 ('http://alerts.weather.gov/cap/ca.php?x=0', 60*2),
+                 ('http://edis.oes.ca.gov/index.atom', POLL_INTERVAL),
+#                 ('http://earthquake.usgs.gov/eqcenter/recenteqsww/catalogs/caprss7days5.xml', 60*60),
+                 ]
+
+EVENT_ALERT = 'alert'     # (EVENT_ALERT, alert, isInitial, its events.Event, the Events merged into it)
+EVENT_EXPIRED = 'expired' # (EVENT_EXPIRED, alert)
+EVENT_SUPERSEDED = 'superseded' # (EVENT_SUPERSEDED, alert, the alert that replaced it)
+EVENT_POLLED = 'polled'   # (EVENT_POLLED, feed url)
+
+Log = logging.getLogger()
+
+class IngestEngine:
+    '''
+    Polls the feeds on its own thread, each on its own schedule (see
+    feeds.FeedScheduler), and puts finished work on the events queue. If
+    wakeup is given it is called after every put, which is how a GUI
+    schedules draining the queue on its own main loop.
+
+    The entries of each poll go through a pipeline.Pipeline:
+
+        dedup -> fetch -> parse -> filter -> dispatch
+
+    Its queues are bounded and so is the events queue (eventQueueSize,
+    0 for no limit), so during a burst ingestion slows down to what the
+    consumer of the events can take.
+    '''
+    def __init__(self, feeds=DEFAULT_FEEDS, coords=LATLONG_COORDS, state=STATECODE, fips=FIPSCODE, zone=UGCCODE,
+                 interval=POLL_INTERVAL, cache=None, store=None, wakeup=None, eventQueueSize=EVENT_QUEUE_SIZE,
+                 statsPort=STATS_PORT, statsFile=STATS_FILE, maps=None):
+        self.mycoords = coords
+        self.state = state
+        self.fips = fips
+        self.zone = zone
+        if cache is None:
+            cache = HTTPCache()
+        self.cache = cache
+        self.feeds = FeedScheduler(reader=self.readFeed)
+        self.stopAfter = dict() # feed url -> stopAfter
+        for feed in feeds:
+            if isinstance(feed, basestring):
+                feed = (feed, interval)
+            self.feeds.add(feed[0], feed[1])
+            if len(feed) > 2:
+                self.stopAfter[feed[0]] = feed[2]
+        self.pipeline = Pipeline()
+        self.pipeline.add('dedup', self.dedup)
+        self.pipeline.add('fetch', self.fetchCAP, FETCH_WORKERS)
+        self.pipeline.add('parse', self.parseCAP, PARSE_WORKERS)
+        self.pipeline.add('filter', self.filterAlert)
+        self.pipeline.add('dispatch', self.dispatch)
+        self.hosts = fetch.HostLimits() # requests in flight per server
+        if store is None:
+            store = AlertStore()
+        self.store = store
+        self.wakeup = wakeup
+        self.maps = maps # a mapcache.MapCache to prerender admitted alerts' maps into, if any
+        self.events = Queue.Queue(eventQueueSize)
+        self.expiry = ExpiryScheduler()
+        self.expiryTimer = None
+        self.expiryArmed = None # when expiryTimer fires, seconds since the epoch
+        self.index = AlertIndex()
+        self.geocodes = GeocodeIndex()
+        self.active = dict() # alert.id -> alert
+        self.eventIndex = EventIndex()
+        self.seen = SeenSet()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        if statsPort is not None:
+            metrics.serve(statsPort)
+        if statsFile is not None:
+            metrics.dump(statsFile)
+
+    def start(self):
+        self.pipeline.start()
+        self.thread = threading.Thread(target=self.run, name='IngestEngine')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.feeds.close()
+        self.pipeline.stop()
+        with self.lock:
+            if self.expiryTimer is not None:
+                self.expiryTimer.cancel()
+
+    def pollNow(self):
+        self.feeds.pollNow()
+
+    def run(self):
+        try:
+            # After a warm restart the first poll only finds new alerts,
+            # so those are worth a notification.
+            cold = not self.restore()
+        except:
+            Log.error("Unable to restore alerts from {0}".format(self.store.path), exc_info=True)
+            cold = True
+        self.store.startCompactor()
+        while not self.stopping.is_set():
+            self.feeds.dispatch()
+            timeout = None
+            when = self.feeds.nextPoll()
+            if when is not None:
+                timeout = max(0, when - time.time())
+            result = self.feeds.wait(timeout)
+            if result is None or self.stopping.is_set():
+                continue
+            schedule, entries = result
+            if entries is None:
+                continue
+            # On a cold start the first good poll of a feed only shows
+            # what is already out there; don't notify for it. Blocks while
+            # the pipeline is backed up.
+            self.pipeline.put((schedule, entries, cold and schedule.polls - schedule.errors == 1))
+
+    def emit(self, *event):
+        self.events.put(event)
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def restore(self):
+        '''
+        Loads the stored alerts and seen links. Returns True if there was
+        anything to load.
+        '''
+        alerts, seen = self.store.load()
+        self.seen.update(seen)
+        for alert in sorted(alerts):
+            self.admit(alert, True)
+        Log.info("Restored {0} alerts and {1} seen links from {2}".format(len(alerts), len(seen), self.store.path))
+        return len(alerts) > 0 or len(seen) > 0
+
+    def admit(self, alert, isInitial):
+        with self.lock:
+            event, superseded, absorbed = self.eventIndex.add(alert)
+            for old in superseded:
+                self.index.remove(old)
+                self.geocodes.remove(old)
+                self.active.pop(old.id, None)
+                self.expiry.remove(old)
+            stale = alert not in self.eventIndex
+            if not stale:
+                self.index.insert(alert)
+                self.geocodes.add(alert)
+                self.active[alert.id] = alert
+                expires = self.expiry.add(alert)
+        if stale:
+            Log.info("CAP {0} was already superseded.".format(alert.id))
+            self.store.delete(alert)
+            return
+        metrics.count('alerts_admitted_total')
+        if self.maps is not None:
+            self.maps.precompute(alert)
+        for old in superseded:
+            Log.info("CAP {0} is superseded by {1}.".format(old.id, alert.id))
+            metrics.count('alerts_superseded_total')
+            self.store.delete(old)
+            self.emit(EVENT_SUPERSEDED, old, alert)
+        self.emit(EVENT_ALERT, alert, isInitial, event, absorbed)
+        if expires is not None and (self.expiryArmed is None or expires < self.expiryArmed):
+            self.armExpiry()
+
+    def getAlerts(self):
+        with self.lock:
+            return sorted(self.active.itervalues())
+
+    def alertsAt(self, coords):
+        '''
+        Active alerts whose polygons or circles cover coords (lat, long).
+        '''
+        with self.lock:
+            return self.index.query(coords)
+
+    def alertsAtMany(self, points):
+        with self.lock:
+            return self.index.queryMany(points)
+
+    def getEvent(self, alert):
+        '''
+        The events.Event alert is filed under, None once it has gone.
+        '''
+        with self.lock:
+            return self.eventIndex.getEvent(alert)
+
+    def alertsInZone(self, zone):
+        '''
+        Active alerts for a UGC zone or county such as 'CAZ017'.
+        '''
+        with self.lock:
+            return [self.active[x] for x in self.geocodes.lookupZone(zone)]
+
+    def alertsInCounty(self, fips):
+        '''
+        Active alerts for a 5 digit FIPS county such as '06113'.
+        '''
+        with self.lock:
+            return [self.active[x] for x in self.geocodes.lookupCounty(fips)]
+
+    def checkEntry(self, entry):
+        return entry.checkFips(self.fips) or entry.checkCoords(self.mycoords) or True
+
+    def checkAlert(self, alert):
+        with metrics.timer('alert_check_ugc_seconds'):
+            if alert.checkUGC(self.state, self.fips, self.zone):
+                return True
+        with metrics.timer('alert_check_coords_seconds'):
+            if alert.checkCoords(self.mycoords):
+                return True
+        return alert.checkArea('FIPS6', '000000') or True
+
+    def feedMetrics(self):
+        '''
+        Per feed polls, errors, latency and entry counts; see
+        feeds.FeedSchedule.metrics.
+        '''
+        return self.feeds.metrics()
+
+    def readFeed(self, url):
+        '''
+        Only entries not seen before are built, so a poll costs about as
+        much as the number of new entries. feed_poll_seconds is the whole
+        poll; parse.fetchFeed times its fetch and its parse apart.
+        '''
+        with metrics.timer('feed_poll_seconds', feed=url):
+            try:
+                entries = parse.fetchFeed(url, self.cache, self.seen.__contains__, self.stopAfter.get(url))
+            except:
+                metrics.count('feed_errors_total', feed=url)
+                raise
+        metrics.count('feed_entries_total', len(entries), feed=url)
+        return entries
+
+    def dedup(self, item):
+        '''
+        Pipeline stage: the entries of one feed poll that are new and
+        pass checkEntry, as (entry, isInitial).
+        '''
+        schedule, entries, isInitial = item
+        entries = filter(lambda entry: entry.caplink not in self.seen, entries)
+        Log.info("Polled {0} in {1:.2f}s: {2} entries, {3} new.".format(schedule.url, schedule.lastLatency, schedule.lastEntries, len(entries)))
+        metrics.count('feed_new_entries_total', len(entries), feed=schedule.url)
+
+        expires = int(time.time()) + SEEN_HORIZON
+        self.store.markSeen([entry.caplink for entry in entries], expires)
+        self.seen.age()
+        wanted = list()
+        for newEntry in entries:
+            self.seen.add(newEntry.caplink, expires)
+            if self.checkEntry(newEntry):
+                Log.info("New alert from feed {0}: {1}".format(newEntry.fromFeed, newEntry.summary))
+                wanted.append((newEntry, isInitial))
+
+        Log.info("HTTP cache: {requests} requests, {hits} hits, {misses} misses, {notModified} not modified, {bytesSaved} bytes saved".format(**self.cache.stats))
+        try:
+            self.cache.save()
+        except:
+            Log.warning("Unable to save HTTP cache {0}".format(self.cache.path), exc_info=True)
+        self.emit(EVENT_POLLED, schedule.url)
+        return wanted
+
+    def fetchCAP(self, item):
+        '''
+        Pipeline stage: (entry, isInitial, response, alert), alert being
+        the previous parse when the server says the CAP is unchanged.
+        '''
+        entry, isInitial = item
+        with self.hosts.limit(entry):
+            with metrics.timer('cap_fetch_seconds', feed=entry.fromFeed):
+                try:
+                    response = self.cache.open(entry.caplink)
+                except ValueError:
+                    Log.warning("Input '{0}' not a valid url type. Assuming it is a filename.".format(entry.caplink))
+                    return [(entry, isInitial, entry.caplink, None)]
+                except:
+                    Log.error("Unexpected error fetching CAP {0}".format(entry.caplink), exc_info=False)
+                    metrics.count('cap_fetch_errors_total', feed=entry.fromFeed)
+                    return []
+        alert = None
+        if response.notModified:
+            metrics.count('cap_not_modified_total', feed=entry.fromFeed)
+            alert = self.cache.cached(entry.caplink)
+        return [(entry, isInitial, response, alert)]
+
+    def parseCAP(self, item):
+        '''
+        Pipeline stage: (entry, isInitial, alert).
+        '''
+        entry, isInitial, response, alert = item
+        if alert is None:
+            with metrics.timer('cap_parse_seconds', feed=entry.fromFeed):
+                if isinstance(response, basestring):
+                    alert = parse.StreamCAP(response)
+                else:
+                    alert = parse.StreamCAP(response, response.geturl(), entry.caplink)
+                    self.cache.remember(entry.caplink, alert)
+        if alert is None:
+            metrics.count('cap_parse_errors_total', feed=entry.fromFeed)
+            return []
+        return [(entry, isInitial, alert)]
+
+    def filterAlert(self, item):
+        entry, isInitial, alert = item
+        if not self.checkAlert(alert):
+            return []
+        if alert.isExpired():
+            Log.info("... but it is already expired.")
+            metrics.count('alerts_already_expired_total', feed=entry.fromFeed)
+            return []
+        return [item]
+
+    def dispatch(self, item):
+        '''
+        Pipeline stage: stores the alert and emits it. Blocks while the
+        events queue is full.
+        '''
+        entry, isInitial, alert = item
+        self.store.put(alert, entry.caplink)
+        self.seen.add(entry.caplink, epoch(alert.getExpires()))
+        self.admit(alert, isInitial)
+        return []
+
+    def ejectExpired(self):
+        '''
+        Drops exactly the alerts that expired since the last call, then
+        arms the timer for the next expiry.
+        '''
+        with self.lock:
+            expired = self.expiry.popExpired()
+            for cap in expired:
+                Log.info("CAP {0} has expired.".format(cap))
+                self.index.remove(cap)
+                self.geocodes.remove(cap)
+                self.active.pop(cap.id, None)
+                self.eventIndex.remove(cap)
+        metrics.count('alerts_expired_total', len(expired))
+        for cap in expired:
+            self.emit(EVENT_EXPIRED, cap)
+        self.armExpiry()
+
+    def armExpiry(self):
+        '''
+        (Re)starts the single timer that calls ejectExpired at the next
+        expiry.
+        '''
+        with self.lock:
+            if self.expiryTimer is not None:
+                self.expiryTimer.cancel()
+                self.expiryTimer = None
+            self.expiryArmed = self.expiry.nextExpiry()
+            if self.expiryArmed is None or self.stopping.is_set():
+                return
+            # Expiry times are whole seconds, so wait for the next one.
+            delay = max(0, self.expiryArmed + 1 - time.time())
+            self.expiryTimer = threading.Timer(delay, self.ejectExpired)
+            self.expiryTimer.daemon = True
+            self.expiryTimer.start()
+
+def main(argv):
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('--stats-port', type='int', default=STATS_PORT, help="serve metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_option('--stats-file', default=STATS_FILE, help="dump metrics to this file (JSON if it ends in .json)")
+    options, args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+    engine = IngestEngine(statsPort=options.stats_port, statsFile=options.stats_file)
+    engine.start()
+    try:
+        while True:
+            # A timeout keeps the main thread responsive to Ctrl-C.
+            try:
+                event = engine.events.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if event[0] is EVENT_ALERT:
+                Log.info("ALERT {0}: {1}".format(event[1].id, event[1].getTitle()))
+            elif event[0] is EVENT_EXPIRED:
+                Log.info("EXPIRED {0}".format(event[1].id))
+            elif event[0] is EVENT_SUPERSEDED:
+                Log.info("SUPERSEDED {0} by {1}".format(event[1].id, event[2].id))
+    except KeyboardInterrupt:
+        engine.stop()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
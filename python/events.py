@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import re
+import logging
+import cap
+
+INCIDENT = re.compile(r'"[^"]*"|\S+')
+SUPERSEDING = (cap.Alert.MSGTYPE_UPDATE, cap.Alert.MSGTYPE_CANCEL)
+ENDING = (cap.VTEC.ACTIONS['CAN'], cap.VTEC.ACTIONS['EXP'])
+
+Log = logging.getLogger()
+
+class Event:
+    '''
+    One real world event: the live alerts that share a P-VTEC event, an
+    incident or a chain of references.
+    '''
+    def __init__(self):
+        self.keys = set()
+        self.alerts = dict() # alert.id -> alert, superseded ones excluded
+
+    def __len__(self):
+        return len(self.alerts)
+
+    def getAlerts(self):
+        return sorted(self.alerts.itervalues())
+
+    def getCurrent(self):
+        '''
+        The latest alert, which gives the effective state of the event.
+        '''
+        if len(self.alerts) is 0:
+            return None
+        return max(self.alerts.itervalues())
+
+    def isCancelled(self):
+        '''
+        True if the latest alert cancels the event, either as a CAP Cancel
+        or with only CAN/EXP VTEC actions.
+        '''
+        current = self.getCurrent()
+        if current is None:
+            return False
+        if current.msgType == cap.Alert.MSGTYPE_CANCEL:
+            return True
+        actions = [info.vtec.actions for info in current.infos if info.vtec is not None and info.vtec.hasPVTEC]
+        return len(actions) > 0 and all(action in ENDING for action in actions)
+
+class EventIndex:
+    '''
+    Groups alerts into Events through dicts keyed on
+
+        ('vtec', office_id, phenomena, significance, event_tracking_number)
+        ('incident', incident)
+        ('ref', identifier)   the alert's own id and each of its references
+
+    so threading an alert is a few dict hits however many events are known
+    (Alert.match compares against every one). Two events an alert links
+    together are merged, the smaller into the larger.
+
+    An Update or Cancel supersedes the alerts it references: they are
+    dropped, and so is a referenced alert that only turns up later. The
+    VTEC keys only group; an event's segments for different zones go out
+    as separate alerts that are all live at once.
+    '''
+    def __init__(self):
+        self.events = dict() # key -> Event
+        self.eventOf = dict() # alert.id -> Event
+        self.supersededBy = dict() # alert.id -> id of the live alert that superseded it
+        self.supersedes = dict() # live alert.id -> ids it keeps in supersededBy
+
+    def __len__(self):
+        return len(self.eventOf)
+
+    def __contains__(self, alert):
+        return alert.id in self.eventOf
+
+    @staticmethod
+    def alertKeys(alert):
+        keys = set([('ref', alert.id)])
+        for reference in alert.references:
+            keys.add(('ref', reference))
+        if alert.incidents is not None:
+            for incident in INCIDENT.findall(alert.incidents):
+                keys.add(('incident', incident.strip('"')))
+        for info in alert.infos:
+            vtec = info.vtec
+            if vtec is not None and vtec.hasPVTEC:
+                keys.add(('vtec', vtec.office_id, vtec.phenomena, vtec.significance, vtec.event_tracking_number))
+        return keys
+
+    def getEvent(self, alert):
+        return self.eventOf.get(alert.id)
+
+    def __merge(self, events):
+        events.sort(key=len, reverse=True)
+        event = events[0]
+        for other in events[1:]:
+            for key in other.keys:
+                self.events[key] = event
+            event.keys |= other.keys
+            for id, alert in other.alerts.iteritems():
+                self.eventOf[id] = event
+                event.alerts[id] = alert
+        return event
+
+    def add(self, alert):
+        '''
+        Files alert under its event. Returns (event, superseded, absorbed):
+        the alerts dropped because of it (alert itself if something already
+        superseded it) and the events merged into event.
+        '''
+        if alert.id in self.eventOf:
+            self.remove(alert)
+        if alert.id in self.supersededBy:
+            # Arrived after the alert that replaced it.
+            return self.eventOf[self.supersededBy[alert.id]], [alert], []
+        keys = EventIndex.alertKeys(alert)
+        events = list()
+        for key in keys:
+            event = self.events.get(key)
+            if event is not None and event not in events:
+                events.append(event)
+        if len(events) is 0:
+            event = Event()
+        else:
+            event = self.__merge(events)
+        for key in keys:
+            self.events[key] = event
+        event.keys |= keys
+
+        event.alerts[alert.id] = alert
+        self.eventOf[alert.id] = event
+        superseded = list()
+        if alert.msgType in SUPERSEDING:
+            ids = set(alert.references)
+            for reference in alert.references:
+                old = event.alerts.get(reference)
+                if old is not None:
+                    self.__drop(old)
+                    superseded.append(old)
+                ids |= self.supersedes.pop(reference, set())
+            for id in ids:
+                self.supersededBy[id] = alert.id
+            self.supersedes[alert.id] = ids
+        return event, superseded, events[1:]
+
+    def __drop(self, alert):
+        event = self.eventOf.pop(alert.id)
+        del event.alerts[alert.id]
+        return event
+
+    def remove(self, alert):
+        '''
+        Forgets alert, e.g. once it has expired. Its event goes once it has
+        no alerts left.
+        '''
+        if alert.id not in self.eventOf:
+            return False
+        event = self.__drop(alert)
+        for id in self.supersedes.pop(alert.id, ()):
+            if self.supersededBy.get(id) == alert.id:
+                del self.supersededBy[id]
+        if len(event.alerts) is 0:
+            for key in event.keys:
+                if self.events.get(key) is event:
+                    del self.events[key]
+        return True
+
+def test_supersession():
+    from datetime import datetime, timedelta
+    from dateutil import zoneinfo
+    start = datetime(2011, 3, 20, tzinfo=zoneinfo.gettz('UTC'))
+    def alert(id, minutes, msgType=cap.Alert.MSGTYPE_ALERT, references=(), vtec=None, incidents=None):
+        a = cap.Alert()
+        a.setId(id)
+        a.sent = start + timedelta(minutes=minutes)
+        a.msgType = msgType
+        a.references = list(references)
+        a.incidents = incidents
+        i = cap.Info()
+        if vtec is not None:
+            i.vtec = cap.VTEC(vtec)
+        a.addInfo(i)
+        return a
+
+    index = EventIndex()
+    warning = '/O.NEW.KSTO.HW.W.0002.110320T1600Z-110321T1200Z/'
+    a = alert('a', 0, vtec=warning)
+    event, superseded, absorbed = index.add(a)
+    assert superseded == [] and absorbed == [] and event.getCurrent() is a
+    # Another zone's segment of the same event: grouped, not superseded.
+    b = alert('b', 0, vtec=warning)
+    assert index.add(b)[:2] == (event, [])
+    c = alert('c', 10, cap.Alert.MSGTYPE_UPDATE, ['a'], '/O.EXT.KSTO.HW.W.0002.110320T1600Z-110321T1800Z/')
+    assert index.add(c)[:2] == (event, [a])
+    assert event.getAlerts() == [b, c] and event.getCurrent() is c and not event.isCancelled()
+    assert a not in index and b in index and c in index
+    d = alert('d', 20, cap.Alert.MSGTYPE_CANCEL, ['c', 'b'], '/O.CAN.KSTO.HW.W.0002.110320T1600Z-110321T1800Z/')
+    assert index.add(d)[:2] == (event, [c, b])
+    assert event.getAlerts() == [d] and event.isCancelled()
+    # Anything in the chain that turns up late is dropped straight away.
+    assert index.add(alert('c', 10, cap.Alert.MSGTYPE_UPDATE, ['a']))[1][0].id == 'c'
+    assert index.add(alert('a', 0))[1][0].id == 'a'
+    assert len(index) == 1
+
+    # An incident and a reference link two events; they are merged.
+    e = alert('e', 0, incidents='KSTO.WS.A.0006')
+    f = alert('f', 5, vtec='/O.NEW.KSTO.WS.W.0003.110320T1600Z-110321T1200Z/')
+    e1, f1 = index.add(e)[0], index.add(f)[0]
+    assert e1 is not f1
+    g = alert('g', 10, cap.Alert.MSGTYPE_ACK, ['e'], '/O.NEW.KSTO.WS.W.0003.110320T1600Z-110321T1200Z/')
+    event, superseded, absorbed = index.add(g)
+    assert superseded == [] and len(absorbed) == 1 and set([e1, f1]) == set([event] + absorbed)
+    assert event.getAlerts() == [e, f, g] and index.getEvent(e) is index.getEvent(f) is event
+
+    # Expiring everything leaves nothing behind.
+    for x in [d, e, f, g]:
+        assert index.remove(x)
+    assert not index.remove(d)
+    assert len(index) == 0 and index.events == {} and index.supersededBy == {} and index.supersedes == {}
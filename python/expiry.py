@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import heapq
+import time
+import logging
+from store import epoch
+
+Log = logging.getLogger()
+
+class ExpiryScheduler:
+    '''
+    Min-heap of alerts keyed on alert.getExpires() (as seconds since the
+    epoch), so popExpired() touches only the alerts that are actually
+    due. Alerts without an expiry are never scheduled.
+
+    remove() and re-adding an alert with the same id leave a stale heap
+    entry behind; stale entries are skipped when they surface and the
+    heap is rebuilt once they outnumber the live ones.
+    '''
+    def __init__(self):
+        self.heap = list() # (expires, seq, alert.id)
+        self.entries = dict() # alert.id -> (expires, seq, alert)
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, alert):
+        return alert.id in self.entries
+
+    def add(self, alert):
+        '''
+        Schedules alert, replacing any alert with the same id. Returns its
+        expiry, or None if it has none.
+        '''
+        self.entries.pop(alert.id, None)
+        expires = epoch(alert.getExpires())
+        if expires is None:
+            return None
+        self.seq += 1
+        self.entries[alert.id] = (expires, self.seq, alert)
+        heapq.heappush(self.heap, (expires, self.seq, alert.id))
+        self.__compact()
+        return expires
+
+    def remove(self, alert):
+        return self.entries.pop(alert.id, None) is not None
+
+    def __live(self, item):
+        entry = self.entries.get(item[2])
+        return entry is not None and entry[1] == item[1]
+
+    def __compact(self):
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [item for item in self.heap if self.__live(item)]
+            heapq.heapify(self.heap)
+
+    def nextExpiry(self):
+        '''
+        Seconds since the epoch of the earliest scheduled expiry, or None.
+        '''
+        while len(self.heap) > 0 and not self.__live(self.heap[0]):
+            heapq.heappop(self.heap)
+        if len(self.heap) > 0:
+            return self.heap[0][0]
+        return None
+
+    def popExpired(self, now=None):
+        '''
+        Unschedules and returns, earliest first, the alerts that expired
+        at or before now.
+        '''
+        if now is None:
+            now = time.time()
+        expired = list()
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            item = heapq.heappop(self.heap)
+            if self.__live(item):
+                expired.append(self.entries.pop(item[2])[2])
+        return expired
+
+def test_pop_expired():
+    import random
+    from datetime import datetime, timedelta
+    from dateutil import zoneinfo
+    import cap
+    random.seed(3)
+    start = datetime(2011, 3, 20, tzinfo=zoneinfo.gettz('UTC'))
+    alerts = list()
+    for n in range(300):
+        a = cap.Alert()
+        a.setId('alert%d' % n)
+        for x in range(random.randint(0, 3)):
+            i = cap.Info()
+            i.expires = start + timedelta(minutes=random.randint(0, 600))
+            a.addInfo(i)
+        alerts.append(a)
+
+    scheduler = ExpiryScheduler()
+    for a in alerts:
+        scheduler.add(a)
+    assert len(scheduler) == len([a for a in alerts if len(a.infos) > 0])
+    removed = set(a.id for a in alerts[::7])
+    for a in alerts[::7]:
+        scheduler.remove(a)
+    # Re-adding replaces, it does not duplicate.
+    for a in alerts[1::7]:
+        scheduler.add(a)
+
+    seen = set()
+    for minutes in range(0, 660, 30):
+        now = epoch(start + timedelta(minutes=minutes))
+        due = scheduler.popExpired(now)
+        expected = set(a.id for a in alerts if a.id not in removed and a.id not in seen
+                       and a.getExpires() is not None and epoch(a.getExpires()) <= now)
+        assert set(a.id for a in due) == expected
+        assert len(due) == len(expected)
+        assert [epoch(a.getExpires()) for a in due] == sorted(epoch(a.getExpires()) for a in due)
+        seen |= expected
+        next = scheduler.nextExpiry()
+        assert next is None or next > now
+    assert len(scheduler) == 0 and scheduler.nextExpiry() is None
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import time
+import heapq
+import random
+import logging
+import threading
+import Queue
+import parse
+
+DEFAULT_INTERVAL = 60*10 # seconds
+MAX_BACKOFF = 60*60 # seconds
+DEFAULT_WORKERS = 4
+
+Log = logging.getLogger()
+
+class FeedSchedule:
+    '''
+    One feed: how often to poll it, when it is next due, and what its
+    polls have cost so far.
+    '''
+    def __init__(self, url, interval=DEFAULT_INTERVAL):
+        self.url = url
+        self.interval = interval
+        self.nextPoll = 0
+        self.failures = 0 # consecutive, drives the backoff
+        self.polls = 0
+        self.errors = 0
+        self.lastLatency = None
+        self.totalLatency = 0.0
+        self.lastEntries = None
+        self.totalEntries = 0
+        self.lastPoll = None
+        self.lastError = None
+
+    def succeeded(self, now, latency, entries):
+        self.polls += 1
+        self.failures = 0
+        self.lastPoll = now
+        self.lastLatency = latency
+        self.totalLatency += latency
+        self.lastEntries = entries
+        self.totalEntries += entries
+        self.nextPoll = now + self.interval
+
+    def failed(self, now, latency, error):
+        '''
+        Backs off exponentially from interval up to MAX_BACKOFF, with
+        jitter so feeds on a shared server do not retry in step.
+        '''
+        self.polls += 1
+        self.errors += 1
+        self.failures += 1
+        self.lastPoll = now
+        self.lastLatency = latency
+        self.totalLatency += latency
+        self.lastError = error
+        delay = min(self.interval * 2 ** min(self.failures, 16), max(MAX_BACKOFF, self.interval))
+        self.nextPoll = now + delay * random.uniform(0.5, 1.0)
+
+    def metrics(self):
+        meanLatency = None
+        if self.polls > 0:
+            meanLatency = self.totalLatency / self.polls
+        return dict({
+                     'interval': self.interval,
+                     'nextPoll': self.nextPoll,
+                     'polls': self.polls,
+                     'errors': self.errors,
+                     'failures': self.failures,
+                     'lastLatency': self.lastLatency,
+                     'meanLatency': meanLatency,
+                     'lastEntries': self.lastEntries,
+                     'totalEntries': self.totalEntries,
+                     'lastError': self.lastError,
+                     })
+
+class FeedScheduler:
+    '''
+    Polls each feed on its own schedule, several at a time on worker
+    threads. dispatch() starts every feed that is due and not already
+    being fetched; wait() hands back finished polls one at a time, so a
+    slow feed never holds up the others.
+
+    reader(url) returns the list of parse.Entry of a feed and raises on
+    failure (see parse.fetchFeed).
+    '''
+    def __init__(self, feeds=(), reader=parse.fetchFeed, workers=DEFAULT_WORKERS):
+        self.reader = reader
+        self.workers = workers
+        self.schedules = dict() # url -> FeedSchedule
+        self.heap = list() # (nextPoll, url)
+        self.inflight = set()
+        self.tasks = Queue.Queue()
+        self.results = Queue.Queue()
+        self.threads = list()
+        self.lock = threading.Lock()
+        for feed in feeds:
+            if isinstance(feed, basestring):
+                self.add(feed)
+            else:
+                self.add(*feed)
+
+    def add(self, url, interval=DEFAULT_INTERVAL):
+        with self.lock:
+            schedule = FeedSchedule(url, interval)
+            self.schedules[url] = schedule
+            heapq.heappush(self.heap, (schedule.nextPoll, url))
+
+    def remove(self, url):
+        with self.lock:
+            return self.schedules.pop(url, None) is not None
+
+    def __start(self):
+        while len(self.threads) < self.workers:
+            t = threading.Thread(target=self.__work, name='FeedScheduler-%d' % len(self.threads))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def __work(self):
+        while True:
+            url = self.tasks.get()
+            if url is None:
+                return
+            start = time.time()
+            try:
+                entries = self.reader(url)
+                error = None
+            except Exception, e:
+                Log.warning("Unable to poll feed {0}: {1}".format(url, e))
+                entries = None
+                error = str(e)
+            self.results.put((url, entries, error, time.time() - start))
+
+    def nextPoll(self):
+        '''
+        When the next idle feed is due, or None if every feed is in flight.
+        '''
+        with self.lock:
+            while len(self.heap) > 0:
+                when, url = self.heap[0]
+                schedule = self.schedules.get(url)
+                if schedule is None or schedule.nextPoll != when or url in self.inflight:
+                    heapq.heappop(self.heap)
+                    continue
+                return when
+            return None
+
+    def dispatch(self, now=None):
+        '''
+        Starts every due feed. Returns how many were started.
+        '''
+        if now is None:
+            now = time.time()
+        started = 0
+        with self.lock:
+            self.__start()
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                when, url = heapq.heappop(self.heap)
+                schedule = self.schedules.get(url)
+                if schedule is None or schedule.nextPoll != when or url in self.inflight:
+                    continue
+                self.inflight.add(url)
+                self.tasks.put(url)
+                started += 1
+        return started
+
+    def wait(self, timeout=None):
+        '''
+        (schedule, entries) for the next finished poll, entries None if it
+        failed. None if nothing finished within timeout or wakeup() was
+        called.
+        '''
+        try:
+            result = self.results.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+        if result is None:
+            return None
+        url, entries, error, latency = result
+        now = time.time()
+        with self.lock:
+            self.inflight.discard(url)
+            schedule = self.schedules.get(url)
+            if schedule is None:
+                return None
+            if error is None:
+                schedule.succeeded(now, latency, len(entries))
+            else:
+                schedule.failed(now, latency, error)
+            heapq.heappush(self.heap, (schedule.nextPoll, url))
+        return schedule, entries
+
+    def wakeup(self):
+        '''
+        Makes a blocked wait() return None.
+        '''
+        self.results.put(None)
+
+    def pollNow(self):
+        '''
+        Makes every idle feed due immediately.
+        '''
+        with self.lock:
+            for url, schedule in self.schedules.iteritems():
+                if url not in self.inflight:
+                    schedule.nextPoll = 0
+                    heapq.heappush(self.heap, (0, url))
+        self.wakeup()
+
+    def metrics(self):
+        '''
+        url -> FeedSchedule.metrics()
+        '''
+        with self.lock:
+            return dict((url, schedule.metrics()) for url, schedule in self.schedules.iteritems())
+
+    def close(self):
+        with self.lock:
+            for t in self.threads:
+                self.tasks.put(None)
+            self.threads = list()
+        self.wakeup()
+
+def test_feed_scheduler():
+    polled = list()
+    lock = threading.Lock()
+    def reader(url):
+        with lock:
+            polled.append(url)
+        if url == 'slow':
+            time.sleep(0.3)
+        if url == 'broken':
+            raise IOError('connection refused')
+        return [url]
+
+    scheduler = FeedScheduler([('fast', 0.05), ('slow', 0.05), ('broken', 0.05)], reader=reader, workers=3)
+    # The slow feed must not keep the fast one from being polled again.
+    start = time.time()
+    results = list()
+    while time.time() - start < 0.25:
+        scheduler.dispatch()
+        result = scheduler.wait(0.01)
+        if result is not None:
+            results.append(result)
+    scheduler.close()
+
+    fast = [entries for schedule, entries in results if schedule.url == 'fast']
+    assert len(fast) >= 3 and fast[0] == ['fast']
+    assert not any(schedule.url == 'slow' for schedule, entries in results)
+    assert polled.count('slow') == 1
+    broken = [entries for schedule, entries in results if schedule.url == 'broken']
+    # Backed off after the first error instead of retrying every 50ms.
+    assert 1 <= len(broken) <= 3 and broken[0] is None
+    metrics = scheduler.metrics()
+    assert metrics['broken']['errors'] == len(broken) and metrics['broken']['failures'] == len(broken)
+    assert metrics['fast']['polls'] == len(fast) and metrics['fast']['totalEntries'] == len(fast)
+    assert metrics['fast']['errors'] == 0 and metrics['fast']['meanLatency'] < 0.05
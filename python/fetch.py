@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import threading
+import urlparse
+
+DEFAULT_PER_HOST = 4
+
+def host(entry):
+    '''
+    The server an entry's CAP is fetched from.
+    '''
+    return urlparse.urlparse(entry.caplink or '').netloc
+
+class HostLimits:
+    '''
+    A semaphore per server, so the pipeline's fetch workers have at most
+    perHost requests in flight against any one of them.
+
+        with limits.limit(entry):
+            response = cache.open(entry.caplink)
+    '''
+    def __init__(self, perHost=DEFAULT_PER_HOST):
+        self.perHost = perHost
+        self.hosts = dict() # host -> semaphore
+        self.lock = threading.Lock()
+
+    def limit(self, entry):
+        key = host(entry)
+        with self.lock:
+            if key not in self.hosts:
+                self.hosts[key] = threading.BoundedSemaphore(self.perHost)
+            return self.hosts[key]
+
+def test_host_limits():
+    import time
+    import parse
+    active = dict()
+    peak = dict()
+    lock = threading.Lock()
+    limits = HostLimits(perHost=2)
+    def fetch(entry):
+        with limits.limit(entry):
+            key = host(entry)
+            with lock:
+                active[key] = active.get(key, 0) + 1
+                peak[key] = max(peak.get(key, 0), active[key])
+            time.sleep(0.01)
+            with lock:
+                active[key] -= 1
+
+    threads = list()
+    for name in ('a.example', 'b.example'):
+        for x in range(10):
+            e = parse.Entry()
+            e.addCapLink('http://{0}/{1}.cap'.format(name, x))
+            threads.append(threading.Thread(target=fetch, args=(e,)))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert peak == dict({'a.example': 2, 'b.example': 2})
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import logging
+import cap
+
+Log = logging.getLogger()
+
+class GeocodeIndex:
+    '''
+    Inverted index from geocodes to alert ids, built from the compiled
+    geocodes of every cap.Area (see Area.getCompiledGeoCodes). Keys are
+
+        ('UGC', state, format, code)  format 'C' or 'Z', code 3 digits
+        ('UGC', state, UGC.ALL)       "ALL"/"000" for the whole state
+        (kind, county)                kind one of Area.COUNTY_CODES,
+                                      county the 5 digit FIPS code
+
+    UGC ranges are expanded when the alert is added, so every lookup is a
+    handful of dict hits.
+    '''
+    def __init__(self):
+        self.postings = dict() # key -> set of alert ids
+        self.keys = dict() # alert id -> keys it was added under
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, alert):
+        return alert.id in self.keys
+
+    @staticmethod
+    def alertKeys(alert):
+        keys = set()
+        for info in alert.infos:
+            for area in info.areas:
+                ugc, counties = area.getCompiledGeoCodes()
+                for (state, ugc_format), (codes, ranges) in ugc.iteritems():
+                    for code in codes:
+                        if code == cap.UGC.ALL:
+                            keys.add(('UGC', state, cap.UGC.ALL))
+                        else:
+                            keys.add(('UGC', state, ugc_format, code))
+                    for start, end in ranges:
+                        for code in xrange(start, end + 1):
+                            keys.add(('UGC', state, ugc_format, '%03d' % code))
+                for kind, codes in counties.iteritems():
+                    for code in codes:
+                        keys.add((kind, code))
+        return keys
+
+    def add(self, alert):
+        if alert.id in self.keys:
+            self.remove(alert)
+        keys = GeocodeIndex.alertKeys(alert)
+        for key in keys:
+            if key in self.postings:
+                self.postings[key].add(alert.id)
+            else:
+                self.postings[key] = set([alert.id])
+        self.keys[alert.id] = keys
+
+    def remove(self, alert):
+        keys = self.keys.pop(alert.id, None)
+        if keys is None:
+            return False
+        for key in keys:
+            ids = self.postings[key]
+            ids.discard(alert.id)
+            if len(ids) is 0:
+                del self.postings[key]
+        return True
+
+    def __ids(self, *keys):
+        ids = set()
+        for key in keys:
+            if key in self.postings:
+                ids |= self.postings[key]
+        return ids
+
+    def lookupZone(self, zone):
+        '''
+        Ids of alerts covering a UGC zone or county like 'CAZ017' or 'CAC113'.
+        '''
+        state, ugc_format, code = zone[0:2], zone[2], zone[3:6]
+        return self.__ids(('UGC', state, ugc_format, code), ('UGC', state, cap.UGC.ALL))
+
+    def lookupCounty(self, fips):
+        '''
+        Ids of alerts carrying the 5 digit county fips (e.g. '06113') in
+        any of their FIPS6, FIPS or SAME geocodes.
+        '''
+        return self.__ids(*[(kind, fips) for kind in cap.Area.COUNTY_CODES])
+
+    def match(self, state='CA', fips='06000', nws_zone='000'):
+        '''
+        Ids of exactly the alerts for which alert.checkUGC(state, fips,
+        nws_zone) is True.
+        '''
+        return self.__ids(('UGC', state, 'C', fips[len(fips)-3:len(fips)]),
+                          ('UGC', state, 'Z', nws_zone),
+                          ('UGC', state, cap.UGC.ALL),
+                          ('FIPS6', fips),
+                          ('FIPS', fips))
+
+def test_index_matches_checkUGC():
+    import random
+    random.seed(7)
+    def ugc():
+        segments = list()
+        for x in range(random.randint(1, 4)):
+            state = random.choice(['CA', 'NV'])
+            segments.append(state + random.choice('CZ') + '%03d' % random.randint(0, 20))
+            for y in range(random.randint(0, 3)):
+                start = random.randint(0, 20)
+                if random.random() < 0.5:
+                    segments.append('%03d' % start)
+                else:
+                    segments.append('%03d>%03d' % (start, start + random.randint(0, 5)))
+        if random.random() < 0.1:
+            segments.append('CAZALL')
+        segments.append('191200')
+        return '-'.join(segments) + '-'
+
+    alerts = list()
+    index = GeocodeIndex()
+    for n in range(200):
+        a = cap.Alert()
+        a.setId('alert%d' % n)
+        i = cap.Info()
+        area = cap.Area()
+        area.addGeoCode('UGC', ugc())
+        area.addGeoCode('FIPS6', '006%03d' % random.randint(0, 20))
+        i.addArea(area)
+        a.addInfo(i)
+        alerts.append(a)
+        index.add(a)
+
+    for state in ('CA', 'NV', 'OR'):
+        for code in range(0, 30):
+            fips = '06%03d' % code
+            zone = '%03d' % (29 - code)
+            expected = set(a.id for a in alerts if a.checkUGC(state, fips, zone))
+            assert index.match(state, fips, zone) == expected
+    for a in alerts[:100]:
+        index.remove(a)
+    assert len(index) == 100
+    expected = set(a.id for a in alerts[100:] if a.checkUGC('CA', '06005', '010'))
+    assert index.match('CA', '06005', '010') == expected
+    expected = set(a.id for a in alerts[100:] if a.checkArea('FIPS6', '006005'))
+    assert index.lookupCounty('06005') == expected
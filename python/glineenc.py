@@ -22,6 +22,10 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 import math
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 threshold = .00001
@@ -30,7 +34,11 @@ zoom_factor = 32
 zoom_level_breaks = []
 for i in range(num_levels):
     zoom_level_breaks.append(threshold * (zoom_factor ** (num_levels - i - 1)))
-    
+
+# encode_pairs hands polygons this long to encode_pairs_array; below it
+# numpy's per-call overhead costs more than the loops it saves.
+array_min_points = 128
+
 
 def encode_pairs(points):
     """Encode a set of lat/long points.
@@ -52,6 +60,12 @@ def encode_pairs(points):
         ('_p~iF~ps|U_c_\\\\fhde@~lqNwxq`@', 'BBB')
 
     """
+    if numpy is not None and len(points) >= array_min_points:
+        return encode_pairs_array(points)
+    return encode_pairs_loop(points)
+
+def encode_pairs_loop(points):
+    """encode_pairs a point at a time, without numpy."""
     encoded_points = []
     encoded_levels = []
     
@@ -109,17 +123,13 @@ def encode_signed(n):
     return encode_unsigned(tmp)
 
 def encode_unsigned(n):
-    tmp = []
+    chars = []
     # while there are more than 5 bits left (that aren't all 0)...
     while n >= 32:  # 32 == 0xf0 == 100000
-        tmp.append(n & 31)  # 31 == 0x1f == 11111
+        chars.append(chr(((n & 31) | 0x20) + 63))  # 31 == 0x1f == 11111
         n = n >> 5
-    tmp = [(c | 0x20) for c in tmp]
-    tmp.append(n)
-    tmp = [(i + 63) for i in tmp]
-    tmp = [chr(i) for i in tmp]
-    tmp = ''.join(tmp)
-    return tmp    
+    chars.append(chr(n + 63))
+    return ''.join(chars)
 
 def douglas_peucker_distances(points):
     distances = [None] * len(points)
@@ -181,6 +191,101 @@ def compute_level(distance):
         level += 1
     return level
 
+def encode_pairs_array(points):
+    """encode_pairs, byte for byte, with the Douglas-Peucker distances
+    and the encoding done on numpy arrays.  Needs numpy."""
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    distances = douglas_peucker_distances_array(points)
+    keep = ~numpy.isnan(distances)
+    ints = (points[keep] * 1e5).astype(numpy.int64)
+    deltas = numpy.diff(ints, axis=0)
+    deltas = numpy.vstack((ints[:1], deltas))
+    encoded_points_str = encode_signed_array(deltas.ravel())
+    breaks = numpy.array(zoom_level_breaks)
+    levels = (distances[keep][:, None] < breaks[None, :]).sum(axis=1)
+    encoded_levels_str = (num_levels - levels - 1 + 63).astype(numpy.uint8).tostring()
+    return encoded_points_str, encoded_levels_str
+
+def encode_signed_array(deltas):
+    """The concatenated encode_signed of every int in ``deltas``, in one
+    pass over all of them.  Needs numpy."""
+    values = numpy.asarray(deltas, dtype=numpy.int64) << 1
+    values = numpy.where(values < 0, ~values, values)
+    if len(values) == 0:
+        return ''
+    # 5 bit chunks, least significant first; every value has at least one.
+    width = max(1, (int(values.max()).bit_length() + 4) // 5)
+    shifts = numpy.arange(width, dtype=numpy.int64) * 5
+    chunks = (values[:, None] >> shifts[None, :]) & 31
+    nonzero = chunks != 0
+    lengths = numpy.where(nonzero.any(axis=1), width - nonzero[:, ::-1].argmax(axis=1), 1)
+    used = numpy.arange(width)[None, :] < lengths[:, None]
+    more = numpy.arange(width)[None, :] < (lengths - 1)[:, None]
+    chars = chunks + 63 + numpy.where(more, 0x20, 0)
+    return chars[used].astype(numpy.uint8).tostring()
+
+def douglas_peucker_distances_array(points):
+    """douglas_peucker_distances of an (n, 2) array, NaN for None.
+
+    Rather than one segment off the stack at a time, every pending
+    segment is split in the same round, so there are as many numpy
+    passes as levels of recursion, not one per point kept.  Needs
+    numpy."""
+    n = len(points)
+    distances = numpy.empty(n)
+    distances.fill(numpy.nan)
+    distances[0] = threshold * (zoom_factor ** num_levels)
+    distances[-1] = distances[0]
+
+    if n < 3:
+        return distances
+
+    a = numpy.array([0])
+    b = numpy.array([n - 1])
+    while len(a) > 0:
+        # The interior points of each segment, segment by segment.
+        counts = b - a - 1
+        starts = numpy.cumsum(counts) - counts
+        segment = numpy.repeat(numpy.arange(len(a)), counts)
+        i = numpy.arange(counts.sum()) - starts[segment] + a[segment] + 1
+        dist = segment_distances(points[i], points[a[segment]], points[b[segment]])
+        # The first farthest point of each, as the loop's strict > picks.
+        max_dist = numpy.maximum.reduceat(dist, starts)
+        first = numpy.where(dist == max_dist[segment], numpy.arange(len(dist)), len(dist))
+        max_i = i[numpy.minimum.reduceat(first, starts)]
+        split = max_dist > threshold
+        a, max_i, b = a[split], max_i[split], b[split]
+        distances[max_i] = max_dist[split]
+        a, b = numpy.concatenate((a, max_i)), numpy.concatenate((max_i, b))
+        keep = b - a > 1
+        a, b = a[keep], b[keep]
+
+    return distances
+
+def segment_distances(points, A, B):
+    """distance of each of ``points`` from the line from the same row of
+    ``A`` to that of ``B``, with the same arithmetic and so the same
+    floats.  Needs numpy."""
+    # x ** 2 on an array squares, where a float's ** 2 goes through the C
+    # pow(), which rounds differently now and then; numpy.power is pow().
+    square = lambda v: numpy.power(v, 2.0)
+    x, y = points[:, 0], points[:, 1]
+    Ax, Ay, Bx, By = A[:, 0], A[:, 1], B[:, 0], B[:, 1]
+    to_a = numpy.sqrt(square(x - Ax) + square(y - Ay))
+    to_b = numpy.sqrt(square(x - Bx) + square(y - By))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        u = (
+            (((x - Ax) * (Bx - Ax)) +
+             ((y - Ay) * (By - Ay))) /
+            (square(Bx - Ax) + square(By - Ay))
+        )
+        to_line = numpy.sqrt(
+            square((x - Ax) - (u * (Bx - Ax))) +
+            square((y - Ay) - (u * (By - Ay)))
+        )
+        same = (Ax == Bx) & (Ay == By)
+        return numpy.where(same | (u >= 1), to_b, numpy.where(u <= 0, to_a, to_line))
+
 def test_encode_negative():
     f = -179.9832104
     assert encode_lat_or_long(f, 0)[0] == '`~oia@'
@@ -213,4 +318,37 @@ def test_encode_pairs():
         (37.4619, -122.1819),
     )
     expected_encoding = 'yzocFzynhVq}@n}@o}@nzD', 'B@B'
-    assert encode_pairs(pairs) == expected_encoding    
+    assert encode_pairs(pairs) == expected_encoding
+
+def test_encode_array():
+    if numpy is None:
+        return
+    import random
+    cases = [
+        ((38.5, -120.2),),
+        ((38.5, -120.2), (40.7, -120.95), (43.252, -126.453), (40.7, -120.95)),
+        ((37.4419, -122.1419), (37.4519, -122.1519), (37.4619, -122.1819)),
+        ((-179.9832104, 179.9832104), (0.0, 0.0), (0.000001, -0.000001), (-90.0, 90.0)),
+    ]
+    rng = random.Random(3)
+    for n in (3, 10, 50, 400, 2000):
+        walk = [(rng.uniform(30, 45), rng.uniform(-125, -110))]
+        for i in range(n - 1):
+            walk.append((walk[-1][0] + rng.gauss(0, 0.01), walk[-1][1] + rng.gauss(0, 0.01)))
+        walk.append(walk[0])
+        cases.append(tuple(walk))
+    # Closed rings like county outlines, at and past array_min_points.
+    for n in (array_min_points, 250, 1000, 5000):
+        center = (rng.uniform(33.0, 41.5), rng.uniform(-123.5, -115.0))
+        ring = [(round(center[0] + rng.uniform(0.6, 1.0) * math.cos(2 * math.pi * i / n), 5),
+                 round(center[1] + rng.uniform(0.6, 1.0) * math.sin(2 * math.pi * i / n), 5)) for i in range(n)]
+        cases.append(tuple(ring + ring[:1]))
+    for pairs in cases:
+        expected = douglas_peucker_distances(pairs)
+        distances = douglas_peucker_distances_array(numpy.array(pairs))
+        assert expected == [None if numpy.isnan(d) else d for d in distances]
+        points, levels = encode_pairs_loop(pairs)
+        assert encode_pairs_array(pairs) == (points, levels)
+        assert encode_pairs(pairs)[1] == levels
+        deltas = [int(x * 1e5) for pair in pairs for x in pair]
+        assert encode_signed_array(deltas) == ''.join(encode_signed(d) for d in deltas)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import os
+import cPickle
+import logging
+import threading
+import urllib2
+from collections import OrderedDict
+from StringIO import StringIO
+
+DEFAULT_PATH = os.path.expanduser('~/.cache/capviewer/http.cache')
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+Log = logging.getLogger()
+
+class CachedResponse(StringIO):
+    '''
+    File-like body handed to parsers, with geturl() like urllib2 responses.
+    notModified is True when the server answered 304 and the body came
+    from the cache.
+    '''
+    def __init__(self, body, url, notModified):
+        StringIO.__init__(self, body)
+        self.url = url
+        self.notModified = notModified
+
+    def geturl(self):
+        return self.url
+
+class HTTPCache:
+    '''
+    Conditional GET cache. For every url it remembers the ETag and
+    Last-Modified validators together with the body, and sends
+    If-None-Match / If-Modified-Since on the next request. Entries are
+    kept in least-recently-used order and evicted once the bodies add up
+    to more than maxBytes. save() writes the cache to path.
+
+    stats counts requests, hits (a validator was sent), misses (nothing
+    cached), notModified (the server answered 304) and the bytes fetched
+    and saved.
+    '''
+    def __init__(self, path=DEFAULT_PATH, maxBytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.entries = OrderedDict() # url -> (etag, lastModified, finalUrl, body)
+        self.memo = dict() # url -> result of the last parse of the cached body
+        self.lock = threading.Lock()
+        self.stats = dict({
+                           'requests': 0,
+                           'hits': 0,
+                           'misses': 0,
+                           'notModified': 0,
+                           'bytesFetched': 0,
+                           'bytesSaved': 0,
+                           })
+        if path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                entries = cPickle.load(f)
+        except IOError:
+            return
+        except:
+            Log.warning("Discarding unreadable HTTP cache {0}".format(self.path), exc_info=True)
+            return
+        with self.lock:
+            self.entries = entries
+            self.size = sum(len(x[3]) for x in entries.itervalues())
+            self.__evict()
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            data = cPickle.dumps(self.entries, cPickle.HIGHEST_PROTOCOL)
+        directory = os.path.dirname(self.path)
+        if len(directory) > 0 and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, self.path)
+
+    def __count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def __evict(self):
+        while self.size > self.maxBytes and len(self.entries) > 0:
+            url, entry = self.entries.popitem(last=False)
+            self.size -= len(entry[3])
+            self.memo.pop(url, None)
+
+    def __store(self, url, entry):
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old is not None:
+                self.size -= len(old[3])
+            if old is None or old[3] != entry[3]:
+                self.memo.pop(url, None)
+            self.entries[url] = entry
+            self.size += len(entry[3])
+            self.__evict()
+
+    def open(self, url):
+        '''
+        Fetches url and returns a CachedResponse. Errors are raised the
+        same way urllib2.urlopen raises them.
+        '''
+        request = urllib2.Request(url)
+        with self.lock:
+            entry = self.entries.get(url)
+            self.stats['requests'] += 1
+            if entry is None:
+                self.stats['misses'] += 1
+            else:
+                self.stats['hits'] += 1
+                if entry[0] is not None:
+                    request.add_header('If-None-Match', entry[0])
+                if entry[1] is not None:
+                    request.add_header('If-Modified-Since', entry[1])
+
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if e.code == 304 and entry is not None:
+                self.__count('notModified')
+                self.__count('bytesSaved', len(entry[3]))
+                self.__store(url, entry)
+                return CachedResponse(entry[3], entry[2], True)
+            raise
+
+        body = response.read()
+        self.__count('bytesFetched', len(body))
+        headers = response.info()
+        etag = headers.getheader('ETag')
+        lastModified = headers.getheader('Last-Modified')
+        if etag is not None or lastModified is not None:
+            self.__store(url, (etag, lastModified, response.geturl(), body))
+        return CachedResponse(body, response.geturl(), False)
+
+    def fetch(self, url, parser):
+        '''
+        Returns parser(response). When the server answers 304 the result
+        of the previous parse is returned without parsing again.
+        '''
+        response = self.open(url)
+        if response.notModified:
+            result = self.cached(url)
+            if result is not None:
+                return result
+        result = parser(response)
+        self.remember(url, result)
+        return result
+
+    def cached(self, url):
+        '''
+        The result remember()ed for the body cached for url, or None.
+        '''
+        with self.lock:
+            return self.memo.get(url)
+
+    def remember(self, url, result):
+        '''
+        Keeps the parse result of the body just open()ed for url, for as
+        long as that body stays cached.
+        '''
+        if result is not None:
+            with self.lock:
+                if url in self.entries:
+                    self.memo[url] = result
+
+def test_conditional_get():
+    import BaseHTTPServer
+    import shutil
+    import tempfile
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        bodies = dict({'/feed': 'feed body', '/big': 'x' * 100})
+        def do_GET(self):
+            body = Handler.bodies[self.path]
+            etag = '"%x"' % hash(body)
+            if self.headers.getheader('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    base = 'http://127.0.0.1:%d' % server.server_port
+    directory = tempfile.mkdtemp()
+    parsed = list()
+    def parser(response):
+        parsed.append(response.read())
+        return parsed[-1]
+    try:
+        cache = HTTPCache(os.path.join(directory, 'cache'), maxBytes=50)
+        assert cache.fetch(base + '/feed', parser) == 'feed body'
+        assert cache.fetch(base + '/feed', parser) == 'feed body'
+        assert len(parsed) == 1
+        assert cache.stats['misses'] == 1 and cache.stats['hits'] == 1 and cache.stats['notModified'] == 1
+        assert cache.stats['bytesSaved'] == len('feed body')
+
+        # A restart keeps the validators and body but not the parsed result.
+        cache.save()
+        cache = HTTPCache(os.path.join(directory, 'cache'), maxBytes=50)
+        response = cache.open(base + '/feed')
+        assert response.notModified and response.read() == 'feed body'
+
+        # Bodies past maxBytes push the least recently used entry out.
+        Handler.bodies['/feed'] = 'changed'
+        assert cache.fetch(base + '/feed', parser) == 'changed'
+        cache.open(base + '/big')
+        assert base + '/big' not in cache.entries
+        assert cache.size <= 50
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
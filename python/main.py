@@ -19,6 +19,7 @@
 #    If not, see <http://www.gnu.org/licenses/>.
 #===============================================================================
 
+import gobject
 import gtk
 import tray
 import logging
@@ -31,6 +32,7 @@ Log.addHandler(ch)
 Log.setLevel(logging.DEBUG)
 
 def main():
+    gobject.threads_init()
     t = tray.CAPTray()
     gtk.main()
 
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import logging
+import threading
+import Queue
+from collections import OrderedDict
+import glineenc
+import metrics
+import utils
+from cap import LRUCache
+
+PAGE_CACHE_BYTES = 4 * 1024 * 1024 # alert map pages, by len(html)
+ENCODING_CACHE_SIZE = 1024 # polygon encodings
+PRECOMPUTE_QUEUE_SIZE = 1000 # alerts waiting for the worker; more are skipped
+
+Log = logging.getLogger()
+
+class PageCache:
+    '''
+    Map pages in least-recently-used order, evicted once they add up to
+    more than maxBytes: one alert's page grows with its areas, so a count
+    would not bound the memory they take.
+    '''
+    def __init__(self, maxBytes=PAGE_CACHE_BYTES):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            html = self.entries.pop(key, None)
+            if html is not None:
+                self.entries[key] = html
+            return html
+
+    def put(self, key, html):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = html
+            self.size += len(html)
+            while self.size > self.maxBytes and len(self.entries) > 0:
+                key, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+class MapCache:
+    '''
+    The map page of every alert (utils.mapAreas of all the areas of all
+    its infos), and the Douglas-Peucker simplified, polyline encoded form
+    of every polygon (glineenc.encode_pairs) that the pages are drawn
+    from, computed once and kept in LRUs.
+
+    Both are keyed on content: frozen polygons are tuples, so an Update
+    repeating the same county outlines finds the page rendered for the
+    alert before it, and a county in several alerts is encoded once.
+
+    precompute() hands an alert to a background worker when it is
+    ingested, so by the time it is selected in the window its page is
+    ready.
+    '''
+    def __init__(self, maxBytes=PAGE_CACHE_BYTES, encodings=ENCODING_CACHE_SIZE, queueSize=PRECOMPUTE_QUEUE_SIZE):
+        self.encodings = LRUCache(encodings) # polygon -> (points, levels)
+        self.pages = PageCache(maxBytes) # tuple of utils.areaKey -> html
+        self.queue = Queue.Queue(queueSize)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def __key(shape):
+        # Polygons not yet frozen are lists.
+        if isinstance(shape, list):
+            return tuple(tuple(point) for point in shape)
+        return shape
+
+    @staticmethod
+    def alertAreas(alert):
+        return [area for info in alert.infos for area in info.areas]
+
+    def encoding(self, polygon):
+        '''
+        glineenc.encode_pairs(polygon): (encoded points, encoded levels).
+        '''
+        key = MapCache.__key(polygon)
+        encoded = self.encodings.get(key)
+        if encoded is None:
+            with metrics.timer('map_encode_seconds'):
+                encoded = glineenc.encode_pairs(key)
+            self.encodings.put(key, encoded)
+        return encoded
+
+    def hasMap(self, alert):
+        '''
+        True if alert has any polygon or circle to draw.
+        '''
+        return any(len(area.polygons) > 0 or len(area.circles) > 0 for area in MapCache.alertAreas(alert))
+
+    def cachedEncoding(self, polygon):
+        '''
+        encoding(polygon) if it has been computed, else None.
+        '''
+        return self.encodings.get(MapCache.__key(polygon))
+
+    def alertPage(self, alert):
+        '''
+        utils.mapAreas of every area of alert, for the window: never
+        simplifies or encodes on the calling thread. On a miss the page is
+        drawn from the encodings already cached and the rest of the
+        polygons as coordinates, and the alert is queued for the worker
+        to render and cache its encoded page.
+        '''
+        areas = MapCache.alertAreas(alert)
+        key = tuple(utils.areaKey(area) for area in areas)
+        html = self.pages.get(key)
+        if html is None:
+            metrics.count('map_page_misses_total')
+            missing = list()
+            def encode(polygon):
+                encoded = self.cachedEncoding(polygon)
+                if encoded is None:
+                    missing.append(polygon)
+                return encoded
+            html = utils.mapAreas(areas, encode=encode)
+            if len(missing) is 0:
+                self.pages.put(key, html)
+            else:
+                self.precompute(alert)
+        return html
+
+    def render(self, alert):
+        '''
+        Fills the cache for alert, encoding its polygons.
+        '''
+        if not self.hasMap(alert):
+            return
+        areas = MapCache.alertAreas(alert)
+        key = tuple(utils.areaKey(area) for area in areas)
+        if self.pages.get(key) is None:
+            with metrics.timer('map_render_seconds'):
+                html = utils.mapAreas(areas, encode=self.encoding)
+            self.pages.put(key, html)
+
+    def __start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__work, name='MapCache')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def __work(self):
+        while True:
+            alert = self.queue.get()
+            try:
+                self.render(alert)
+            except:
+                Log.warning("Unable to prerender the maps of CAP {0}".format(alert.id), exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    def precompute(self, alert):
+        '''
+        Queues alert for render() on the worker thread. Never blocks: when
+        the worker is that far behind, alertPage draws the page unencoded
+        and queues it again.
+        '''
+        self.__start()
+        try:
+            self.queue.put_nowait(alert)
+        except Queue.Full:
+            metrics.count('map_precompute_skipped_total')
+
+    def join(self):
+        '''
+        Waits until every queued alert has been rendered.
+        '''
+        self.queue.join()
+
+def test_precompute():
+    import os
+    import parse
+    caps = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'caps')
+    alerts = [parse.ReadCAP(os.path.join(caps, name)) for name in sorted(os.listdir(caps))]
+    maps = MapCache()
+    for alert in alerts:
+        maps.precompute(alert)
+    maps.join()
+    pages = set()
+    for alert in alerts:
+        if not maps.hasMap(alert):
+            continue
+        html = maps.alertPage(alert)
+        assert html == utils.mapAreas(MapCache.alertAreas(alert))
+        # Served from the cache, not rendered again.
+        assert maps.alertPage(alert) is html
+        pages.add(html)
+        for area in MapCache.alertAreas(alert):
+            for polygon in area.polygons:
+                assert maps.encoding(list(polygon)) == glineenc.encode_pairs(polygon)
+    # Alerts drawing the same areas share a page.
+    assert len(pages) > 0 and len(maps.pages) == len(pages)
+
+    # Pages past maxBytes push the least recently used out.
+    assert len(pages) > 2
+    small = MapCache(maxBytes=2 * max(len(html) for html in pages))
+    for alert in alerts:
+        small.render(alert)
+    assert 0 < len(small.pages) <= 2 and small.pages.size <= small.pages.maxBytes
+    assert small.pages.size == sum(len(html) for html in small.pages.entries.itervalues())
+
+    # Not prerendered: drawn unencoded without encoding anything, not
+    # cached, and queued for the worker.
+    alert = [a for a in alerts if any(len(area.polygons) > 0 for area in MapCache.alertAreas(a))][0]
+    areas = MapCache.alertAreas(alert)
+    cold = MapCache()
+    assert cold.alertPage(alert) == utils.mapAreas(areas, encode=None)
+    assert len(cold.pages) == 0
+    cold.join()
+    assert len(cold.encodings) > 0
+    assert cold.alertPage(alert) == utils.mapAreas(areas)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+'''
+Counters and latency histograms for the hot paths. Off until enable() is
+called; while off, count() and timer() return straight away.
+
+    with metrics.timer('cap_parse_seconds', feed=url):
+        alert = parse.StreamCAP(...)
+    metrics.count('alerts_total', feed=url)
+
+Read them back with prometheus() (Prometheus text format), snapshot()
+(JSON-able), serve() (a local HTTP endpoint) or dump() (a file rewritten
+periodically).
+'''
+
+import os
+import json
+import time
+import logging
+import threading
+import BaseHTTPServer
+
+# Upper bounds in seconds, Prometheus style; the last bucket is +Inf.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DUMP_INTERVAL = 60 # seconds
+
+Log = logging.getLogger()
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        n = 0
+        while n < len(BUCKETS) and seconds > BUCKETS[n]:
+            n += 1
+        self.buckets[n] += 1
+        self.count += 1
+        self.sum += seconds
+
+class Registry:
+    '''
+    Counters and histograms, each keyed by name and a sorted tuple of
+    (label, value) pairs.
+    '''
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+        self.lock = threading.Lock()
+
+    def count(self, name, n, labels):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, seconds, labels):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+class Timer:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        registry.observe(self.name, time.time() - self.start, self.labels)
+        return False
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+registry = Registry()
+enabled = False
+_null = NullTimer()
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def count(name, n=1, **labels):
+    if enabled:
+        registry.count(name, n, tuple(sorted(labels.iteritems())))
+
+def observe(name, seconds, **labels):
+    if enabled:
+        registry.observe(name, seconds, tuple(sorted(labels.iteritems())))
+
+def timer(name, **labels):
+    '''
+    Context manager adding the time spent in its block to histogram name.
+    '''
+    if enabled:
+        return Timer(name, tuple(sorted(labels.iteritems())))
+    return _null
+
+def _labelText(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if len(labels) is 0:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+def prometheus():
+    '''
+    Everything recorded, in the Prometheus text exposition format.
+    '''
+    lines = list()
+    with registry.lock:
+        counters = sorted(registry.counters.iteritems())
+        histograms = sorted((key, (list(h.buckets), h.count, h.sum)) for key, h in registry.histograms.iteritems())
+    last = None
+    for (name, labels), value in counters:
+        if name != last:
+            lines.append('# TYPE {0} counter'.format(name))
+            last = name
+        lines.append('{0}{1} {2}'.format(name, _labelText(labels), value))
+    for (name, labels), (buckets, total, seconds) in histograms:
+        if name != last:
+            lines.append('# TYPE {0} histogram'.format(name))
+            last = name
+        cumulative = 0
+        for bound, n in zip(BUCKETS + ('+Inf',), buckets):
+            cumulative += n
+            lines.append('{0}_bucket{1} {2}'.format(name, _labelText(labels, (('le', bound),)), cumulative))
+        lines.append('{0}_sum{1} {2!r}'.format(name, _labelText(labels), seconds))
+        lines.append('{0}_count{1} {2}'.format(name, _labelText(labels), total))
+    return '\n'.join(lines) + '\n'
+
+def snapshot():
+    '''
+    Everything recorded as {'counters': [...], 'histograms': [...]}, each
+    entry carrying its name and labels.
+    '''
+    with registry.lock:
+        counters = [dict(name=name, labels=dict(labels), value=value) for (name, labels), value in sorted(registry.counters.iteritems())]
+        histograms = [dict(name=name, labels=dict(labels), count=h.count, sum=h.sum,
+                           buckets=zip(BUCKETS + ('+Inf',), h.buckets)) for (name, labels), h in sorted(registry.histograms.iteritems())]
+    return dict(counters=counters, histograms=histograms)
+
+class StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = prometheus()
+            contentType = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(snapshot(), indent=1)
+            contentType = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        Log.debug("Stats request: " + format % args)
+
+def serve(port, host='127.0.0.1'):
+    '''
+    Enables the metrics and serves /metrics and /metrics.json on a daemon
+    thread. Returns the server; shutdown() stops it.
+    '''
+    enable()
+    server = BaseHTTPServer.HTTPServer((host, port), StatsHandler)
+    t = threading.Thread(target=server.serve_forever, name='MetricsServer')
+    t.daemon = True
+    t.start()
+    Log.info("Serving metrics on http://{0}:{1}/metrics".format(host, server.server_port))
+    return server
+
+def dump(path, interval=DUMP_INTERVAL):
+    '''
+    Enables the metrics and rewrites path every interval seconds, as JSON
+    if it ends in .json and in the Prometheus format otherwise.
+    '''
+    enable()
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                if path.endswith('.json'):
+                    text = json.dumps(snapshot(), indent=1)
+                else:
+                    text = prometheus()
+                with open(path + '.tmp', 'w') as f:
+                    f.write(text)
+                os.rename(path + '.tmp', path)
+            except:
+                Log.warning("Unable to dump metrics to {0}".format(path), exc_info=True)
+    t = threading.Thread(target=run, name='MetricsDump')
+    t.daemon = True
+    t.start()
+    return t
+
+def test_metrics():
+    import urllib2
+    registry.clear()
+    disable()
+    count('polls_total', feed='a')
+    with timer('parse_seconds', feed='a'):
+        pass
+    assert registry.counters == {} and registry.histograms == {}
+    assert timer('parse_seconds') is _null
+
+    server = serve(0)
+    try:
+        count('polls_total', feed='a')
+        count('polls_total', 2, feed='a')
+        count('polls_total', feed='b"')
+        for seconds in (0.0005, 0.003, 0.003, 100):
+            observe('parse_seconds', seconds, feed='a')
+        with timer('parse_seconds', feed='b'):
+            pass
+        text = urllib2.urlopen('http://127.0.0.1:{0}/metrics'.format(server.server_port)).read()
+        assert text == prometheus()
+        lines = text.splitlines()
+        assert '# TYPE polls_total counter' in lines and 'polls_total{feed="a"} 3' in lines and 'polls_total{feed="b\\""} 1' in lines
+        assert 'parse_seconds_bucket{feed="a",le="0.001"} 1' in lines
+        assert 'parse_seconds_bucket{feed="a",le="0.005"} 3' in lines
+        assert 'parse_seconds_bucket{feed="a",le="30.0"} 3' in lines
+        assert 'parse_seconds_bucket{feed="a",le="+Inf"} 4' in lines and 'parse_seconds_count{feed="a"} 4' in lines
+        data = json.loads(urllib2.urlopen('http://127.0.0.1:{0}/metrics.json'.format(server.server_port)).read())
+        assert data['counters'][0] == dict(name='polls_total', labels=dict(feed='a'), value=3)
+        assert [h['count'] for h in data['histograms']] == [4, 1]
+    finally:
+        server.shutdown()
+        disable()
+        registry.clear()
@@ -18,13 +18,13 @@
 #    If not, see <http://www.gnu.org/licenses/>.
 #===============================================================================
 
-import pygtk
-pygtk.require('2.0')
 import urllib2
 from lxml import objectify
+from StringIO import StringIO
 import logging 
 import utils
 import cap
+import metrics
 from lxml import etree
 
 MAX_ALERT_DISTANCE = 1000 # km.
@@ -81,21 +81,156 @@ class Entry:
     def addPoly(self, poly):
         self.polygon = poly
     
-def feedParser(file):
-    entries = list()
+CAP11_NS = '{urn:oasis:names:tc:emergency:cap:1.1}'
+INDEX_NS = '{http://www.alerting.net/namespace/index_1.0}'
+GEO_NS = '{http://www.w3.org/2003/01/geo/wgs84_pos#}'
+
+def feedParser(file, cache=None, isSeen=None, stopAfter=None):
+    '''
+    cache: optional httpcache.HTTPCache. When the feed has not changed
+    since the last poll the previous entries are returned unparsed.
+    isSeen, stopAfter: see readFeed.
+    '''
     try:
-        feed = urllib2.urlopen(file)
+        return fetchFeed(file, cache, isSeen, stopAfter)
     except:
         Log.error("Unexpected error fetching feed {0}.".format(file), exc_info=True)
+        return list()
+
+def fetchFeed(file, cache=None, isSeen=None, stopAfter=None):
+    '''
+    feedParser, except that a feed which cannot be fetched or is not XML
+    raises instead of giving an empty list. The round trip and the parse
+    are timed apart, as feed_fetch_seconds and feed_parse_seconds.
+    '''
+    with metrics.timer('feed_fetch_seconds', feed=file):
+        if cache is not None:
+            feed = cache.open(file)
+        else:
+            feed = StringIO(urllib2.urlopen(file).read())
+    if cache is not None and feed.notModified:
+        entries = cache.cached(file)
+        if entries is not None:
+            return entries
+    with metrics.timer('feed_parse_seconds', feed=file):
+        entries = readFeed(feed, file, isSeen, stopAfter)
+    if cache is not None:
+        cache.remember(file, entries)
+    return entries
+
+def _namespace(tag):
+    if tag.startswith('{'):
+        return tag[:tag.index('}') + 1]
+    return ''
+
+def _child(elem, tag):
+    child = elem.find(tag)
+    if child is None:
+        raise AttributeError("no such child: {0}".format(tag))
+    return child
+
+def _atomEntry(entry, ns, file):
+    e = Entry()
+    e.fromFeed = str(file)
+    id = entry.find(ns + 'id')
+    if id is not None:
+        e.addCapLink(id.text)
+    summary = entry.find(ns + 'summary')
+    if summary is None:
+        summary = entry.find(ns + 'title')
+    if summary is not None:
+        e.addSummary(summary.text.strip())
+    for geocode in entry.findall(CAP11_NS + 'geocode'):
+        for child in geocode.getchildren():
+            if child.tag.endswith('valueName'):
+                if child.text == 'FIPS6':
+                    e.addFips(child.getnext().text)
+                else:
+                    Log.warning("Unparsed geoCode of type %s" % child.text)
+    for latLonBox in entry.findall(INDEX_NS + 'latLonBox'):
+        c1, c2 = latLonBox.text.split(' ')
+        c1x, c1y = c1.split(',')
+        c2x, c2y = c2.split(',')
+        c1x = float(c1x)
+        c1y = float(c1y)
+        c2x = float(c2x)
+        c2y = float(c2y)
+        poly = list()
+        poly.append((c1x, c1y))
+        poly.append((c1x, c2y))
+        poly.append((c2x, c2y))
+        poly.append((c2x, c1y))
+        poly.append((c1x, c1y))
+        e.addPoly(poly)
+    return e
+
+def _rssItem(item, ns, file):
+    e = Entry()
+    e.addCapLink(_child(item, ns + 'link').text)
+    title = _child(item, ns + 'title').text
+    e.addSummary(title)
+    lat = item.find(GEO_NS + 'lat')
+    long = item.find(GEO_NS + 'long')
+    if lat is None or long is None:
+        Log.warning("Feed {0} has entry '{1}' with no geographical focus. Skipping the entry.".format(file, title))
+        return None
+    e.addCoords((float(lat.text), float(long.text)))
+    return e
+
+def readFeed(feed, file, isSeen=None, stopAfter=None):
+    '''
+    Entries of an Atom (EDIS, NWS) or RSS (USGS) feed.
+    isSeen: optional predicate on an entry's cap link. Entries it accepts
+    are skipped before an Entry is built for them, which is where the
+    time goes; lxml's own parse of the document is cheap next to it.
+    stopAfter: stop after this many seen entries in a row, for feeds that
+    list the newest entries first.
+    '''
+    entries = list()
+    root = etree.parse(feed).getroot()
+    ns = _namespace(root.tag)
+    channel = root.find(ns + 'channel')
+    if root.find(ns + 'entry') is not None:
+        items = root.iterchildren(ns + 'entry')
+        linkTag = ns + 'id'
+        build = _atomEntry
+    elif channel is not None:
+        # USGS Earthquake feed
+        items = channel.iterchildren(ns + 'item')
+        linkTag = ns + 'link'
+        build = _rssItem
+    else:
+        Log.warning("Unable to find valid root element of feed {0}. Skipping this feed.".format(file))
         return entries
-    
+
+    run = 0
     try:
-        tree = objectify.parse(feed)
+        for item in items:
+            link = item.find(linkTag)
+            if isSeen is not None and link is not None and isSeen(link.text):
+                run += 1
+                if stopAfter is not None and run >= stopAfter:
+                    break
+                continue
+            run = 0
+            e = build(item, ns, file)
+            if e is not None:
+                entries.append(e)
+        return entries
+    except AttributeError:
+        Log.error("Feed {0} missing expected field.".format(file), exc_info=True)
+        return entries
     except:
-        Log.error("Unexpected error parsing feed {0}.".format(file), exc_info=True)
+        Log.error("Unexpected error parsing feed {0}".format(file), exc_info=True)
         return entries
 
-    
+def readFeedTree(feed, file):
+    '''
+    The objectify feed reader readFeed replaced, kept as its reference.
+    '''
+    entries = list()
+    tree = objectify.parse(feed)
+
     try:
         root = tree.getroot()
         if hasattr(root, 'entry'):
@@ -157,22 +292,260 @@ def feedParser(file):
         Log.error("Unexpected error parsing feed {0}".format(file), exc_info=True)
         return entries
     
-def ReadCAP(file):
-    alert = cap.Alert()
-    
-
+def openCAP(file):
+    '''
+    Returns (stream, url) for a CAP url or filename, or None if it could
+    not be fetched.
+    '''
     try:
         feed = urllib2.urlopen(file)
-        alert.url = feed.geturl()
+        return feed, feed.geturl()
     except ValueError:
         Log.warning("Input '{0}' not a valid url type. Assuming it is a filename.".format(file))
-        feed = file
-        alert.url = None
-        
+        return file, None
     except:
         Log.error("Unexpected error fetching CAP {0}".format(file), exc_info=False)
         return None
 
+def ReadCAP(file, cache=None):
+    '''
+    cache: optional httpcache.HTTPCache. A CAP the server reports as
+    unchanged is returned from the cache without parsing it again.
+    '''
+    if cache is not None:
+        try:
+            return cache.fetch(file, lambda feed: StreamCAP(feed, feed.geturl(), file))
+        except ValueError:
+            pass
+        except:
+            Log.error("Unexpected error fetching CAP {0}".format(file), exc_info=False)
+            return None
+    opened = openCAP(file)
+    if opened is None:
+        return None
+    feed, url = opened
+    return StreamCAP(feed, url, file)
+
+def _field(elem, ns):
+    '''
+    Flattens a finished element into {None: text, childName: [fields, ...]}.
+    Only children in the namespace ns are kept, like objectify lookups.
+    '''
+    fields = {None: elem.text}
+    for child in elem:
+        tag = child.tag
+        if not isinstance(tag, basestring) or not tag.startswith(ns):
+            continue
+        name = tag[len(ns):]
+        if '}' in name:
+            continue
+        if name in fields:
+            fields[name].append(_field(child, ns))
+        else:
+            fields[name] = [_field(child, ns)]
+    return fields
+
+def _text(fields, name):
+    try:
+        return fields[name][0][None]
+    except KeyError:
+        raise AttributeError("no such child: {0}".format(name))
+
+def _required(fields, name):
+    try:
+        return fields[name]
+    except KeyError:
+        raise AttributeError("no such child: {0}".format(name))
+
+def StreamCAP(source, url=None, name=None):
+    '''
+    Single pass CAP reader built on iterparse. Each child of <alert> is
+    flattened as soon as it is closed and then cleared, so the document
+    tree is never held in memory. The result is identical to ReadCAPTree.
+    source: filename or file-like object
+    '''
+    if name is None:
+        name = source
+    alert = cap.Alert()
+    alert.url = url
+    top = dict()
+    root = None
+    ns = ''
+    depth = 0
+    try:
+        for event, elem in etree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if root is None:
+                    root = elem
+                    if root.tag.startswith('{'):
+                        ns = root.tag[:root.tag.index('}') + 1]
+                continue
+            if depth == 2:
+                tag = elem.tag
+                if isinstance(tag, basestring) and tag.startswith(ns) and '}' not in tag[len(ns):]:
+                    tag = tag[len(ns):]
+                    if tag in top:
+                        top[tag].append(_field(elem, ns))
+                    else:
+                        top[tag] = [_field(elem, ns)]
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del root[0]
+            depth -= 1
+    except etree.XMLSyntaxError:
+        Log.error("Syntax error parsing CAP {0} Discarding...".format(name), exc_info=False)
+        return None
+
+    try:
+        assert root.tag.endswith('alert')
+        alert.setId(_text(top, 'identifier'))
+        alert.setSender(_text(top, 'sender'))
+        alert.setSent(_text(top, 'sent'))
+        alert.setStatus(_text(top, 'status'))
+        alert.setMsgType(_text(top, 'msgType'))
+    
+        if 'source' in top:
+            alert.setSource(_text(top, 'source'))
+            Log.debug("Got alert.source %s" % _text(top, 'source'))
+        alert.setScope(_text(top, 'scope'))
+        if 'restriction' in top:
+            alert.setRestriction(_text(top, 'restriction'))
+            Log.debug("Got alert.restriction %s" % _text(top, 'restriction'))
+        if 'addresses' in top:
+            alert.setAddresses(_text(top, 'addresses'))
+            Log.debug("Got alert.addresses %s" % _text(top, 'addresses'))
+        for x in top.get('code', ()):
+            alert.addCode(x[None])
+        if 'references' in top:
+            alert.setReferences(_text(top, 'references'))
+        if 'incidents' in top:
+            alert.setIncidents(_text(top, 'incidents'))
+        if 'note' in top:
+            alert.setNote(_text(top, 'note'))
+
+        for info in _required(top, 'info'):
+            alert.addInfo(_buildInfo(alert, info, _text(top, 'sent')))
+        return alert.freeze()
+    except AttributeError:
+        Log.error("CAP {0} missing required field.".format(name), exc_info=True)
+        return None
+    except:
+        Log.error("Unexpected error parsing CAP {0}".format(name), exc_info=True)
+        return None
+
+def _buildInfo(alert, info, sent):
+    i = cap.Info()
+    if 'language' in info:
+        i.setLanguage(_text(info, 'language'))
+    for category in _required(info, 'category'):
+        i.addCategory(category[None])
+    i.setEvent(_text(info, 'event'))
+    for x in info.get('responseType', ()):
+        i.addResponseType(x[None])
+    i.setUrgency(_text(info, 'urgency'))
+    i.setSeverity(_text(info, 'severity'))
+    i.setCertainty(_text(info, 'certainty'))
+    if 'audience' in info:
+        i.setAudience(_text(info, 'audience'))
+    for x in info.get('eventCode', ()):
+        i.addEventCode(_text(x, 'valueName'), _text(x, 'value'))
+    if 'effective' in info:
+        i.setEffective(_text(info, 'effective'))
+    else:
+        i.setEffective(sent)
+    if 'onset' in info:
+        i.setOnset(_text(info, 'onset'))
+    if 'expires' in info:
+        i.setExpires(_text(info, 'expires'))
+    else:
+        i.setDefaultExpires()
+        Log.info("No expiration for CAP %s. Assuming 24 hours." % alert.id)
+    if 'senderName' in info:
+        i.setSenderName(_text(info, 'senderName'))
+    if 'headline' in info:
+        i.setHeadline(_text(info, 'headline'))
+    if 'description' in info:
+        i.setDescription(_text(info, 'description'))
+    if 'instruction' in info:
+        i.setInstruction(_text(info, 'instruction'))
+    if 'web' in info:
+        i.setWeb(_text(info, 'web'))
+    if 'contract' in info:
+        i.setContact(_text(info, 'contract'))
+    for parameter in info.get('parameter', ()):
+        if 'valueName' in parameter:
+            valueName = _text(parameter, 'valueName')
+            if valueName is not None:
+                if valueName.count('VTEC'):
+                    i.setVTEC(_text(parameter, 'value'))
+                else:
+                    i.addParameter(valueName, _text(parameter, 'value'))
+        else:
+            # is this a USGS feed?
+            text = parameter[None]
+            if text.count('=') is 1:
+                valueName, value = text.split('=')
+                if valueName.count('VTEC'):
+                    i.setVTEC(value)
+                else:
+                    i.addParameter(valueName, value)
+            else:
+                Log.error("Error parsing parameter {0}".format(text))
+    for resource in info.get('resource', ()):
+        res = cap.Resource()
+        res.setResourceDesc(_text(resource, 'resourceDesc'))
+        res.setMimeType(_text(resource, 'mimeType'))
+        if 'size' in resource:
+            res.setSize(_text(resource, 'size'))
+        if 'uri' in resource:
+            res.setUri(_text(resource, 'uri'))
+        if 'derefUri' in resource:
+            res.setDerefUri(_text(resource, 'derefUri'))
+        if 'digest' in resource:
+            res.setDigest(_text(resource, 'digest'))
+        i.addResource(res)
+
+    for area in info.get('area', ()):
+        a = cap.Area()
+        vtec = cap.VTEC()
+        areaDesc = _text(area, 'areaDesc')
+
+        try:
+            if not vtec.populateVTEC(areaDesc):
+                vtec.populateVTEC(areaDesc)
+            else:
+                if i.vtec is None:
+                    i.vtec = vtec
+                else:
+                    if vtec.hasHVTEC and not i.vtec.hasHVTEC:
+                        i.vtec.combine(vtec)
+        except ValueError:
+            a.setAreaDesc(areaDesc)
+
+        for polygon in area.get('polygon', ()):
+            a.addPolygon(polygon[None])
+        for circle in area.get('circle', ()):
+            a.addCircle(circle[None])
+        for geocode in area.get('geocode', ()):
+            a.addGeoCode(_text(geocode, 'valueName'), _text(geocode, 'value'))
+        if 'altitude' in area:
+            a.setAltitude(_text(area, 'altitude'))
+        if 'ceiling' in area:
+            a.setCeiling(_text(area, 'ceiling'))
+        i.addArea(a)
+    return i
+
+def ReadCAPTree(file):
+    '''
+    Reference reader that builds the whole objectify tree. Kept so the
+    streaming reader can be checked against it (see bench.py).
+    '''
+    alert = cap.Alert()
+    opened = openCAP(file)
+    if opened is None:
+        return None
+    feed, alert.url = opened
     
     try:
         parser = objectify.makeparser()
@@ -317,10 +690,97 @@ def ReadCAP(file):
                         a.setCeiling(area.ceiling.text)
                     i.addArea(a)
             alert.addInfo(i)
-        return alert
+        return alert.freeze()
     except AttributeError:
         Log.error("CAP {0} missing required field.".format(file), exc_info=True)
         return None
     except:
         Log.error("Unexpected error parsing CAP {0}".format(file), exc_info=True)
         return None
+
+def _state(obj):
+    if isinstance(obj, (list, tuple)):
+        return [_state(x) for x in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted(_state(x) for x in obj)
+    if isinstance(obj, dict):
+        return dict((k, _state(v)) for k, v in obj.items())
+    if isinstance(obj, cap.Slotted):
+        return (obj.__class__.__name__, _state(obj.__getstate__()))
+    if hasattr(obj, '__dict__'):
+        return (obj.__class__.__name__, _state(obj.__dict__))
+    return obj
+
+def test_stream_matches_tree():
+    import glob
+    import os
+    caps = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'caps')
+    for file in sorted(glob.glob(os.path.join(caps, 'alert*.cap'))):
+        tree = ReadCAPTree(file)
+        stream = ReadCAP(file)
+        assert tree is not None and stream is not None
+        assert _state(tree) == _state(stream)
+
+def _atomFeed(links):
+    '''
+    A synthetic EDIS style Atom feed with one entry per link.
+    '''
+    entries = list()
+    for n, link in enumerate(links):
+        entries.append(u"""<entry><id>{0}</id><title>Alert {1}</title><summary> Summary {1} </summary>
+<cap:geocode><valueName>FIPS6</valueName><value>006{2:03d} 006113</value></cap:geocode>
+<ind:latLonBox>{3},-121.5 {4},-120.5</ind:latLonBox></entry>""".format(link, n, n % 100, 38 + n % 3, 39 + n % 3))
+    return (u"""<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:cap="urn:oasis:names:tc:emergency:cap:1.1"
+xmlns:ind="http://www.alerting.net/namespace/index_1.0"><title>Synthetic</title>
+""" + u'\n'.join(entries) + u"</feed>").encode('utf-8')
+
+def _rssFeed(links):
+    '''
+    A synthetic USGS style RSS feed with one item per link.
+    '''
+    items = list()
+    for n, link in enumerate(links):
+        geo = u''
+        if n % 5:
+            geo = u'<geo:lat>{0}</geo:lat><geo:long>-121.{1}</geo:long>'.format(30 + n % 10, n)
+        items.append(u'<item><title>M {0}</title><link>{1}</link>{2}</item>'.format(n, link, geo))
+    return (u"""<?xml version="1.0"?>
+<rss version="2.0" xmlns:geo="http://www.w3.org/2003/01/geo/wgs84_pos#"><channel><title>Synthetic</title>
+""" + u'\n'.join(items) + u"</channel></rss>").encode('utf-8')
+
+def test_readFeed_matches_tree():
+    links = ['http://example.com/{0}.cap'.format(n) for n in range(50)]
+    for feed in (_atomFeed(links), _rssFeed(links)):
+        tree = readFeedTree(StringIO(feed), 'synthetic')
+        stream = readFeed(StringIO(feed), 'synthetic')
+        assert len(tree) > 0
+        assert _state(stream) == _state(tree)
+
+        seen = set(links[10:])
+        new = readFeed(StringIO(feed), 'synthetic', seen.__contains__)
+        assert _state(new) == _state([e for e in tree if e.caplink not in seen])
+        # Newest first: stop at the first run of 3 seen entries.
+        seen = set(links[10:13] + links[20:])
+        new = readFeed(StringIO(feed), 'synthetic', seen.__contains__, stopAfter=3)
+        assert _state(new) == _state([e for e in tree if e.caplink in links[:10]])
+
+def test_fetchFeed_timers():
+    import tempfile
+    from httpcache import HTTPCache
+    links = ['http://example.com/{0}.cap'.format(n) for n in range(20)]
+    f = tempfile.NamedTemporaryFile(suffix='.atom')
+    f.write(_atomFeed(links))
+    f.flush()
+    url = 'file://' + f.name
+    metrics.registry.clear()
+    metrics.enable()
+    try:
+        for cache in (None, HTTPCache(None)):
+            assert len(fetchFeed(url, cache)) == len(links)
+        for name in ('feed_fetch_seconds', 'feed_parse_seconds'):
+            assert metrics.registry.histograms[(name, (('feed', url),))].count == 2
+    finally:
+        metrics.disable()
+        metrics.registry.clear()
+        f.close()
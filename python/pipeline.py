@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import logging
+import threading
+import Queue
+
+DEFAULT_QUEUE_SIZE = 64
+POLL = 0.1 # seconds between checks for stop() while blocked
+
+Log = logging.getLogger()
+
+class Stage:
+    def __init__(self, name, func, workers, maxsize):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = Queue.Queue(maxsize)
+        self.next = None
+        self.processed = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+class Pipeline:
+    '''
+    Chain of stages, each with its own worker threads, joined by bounded
+    queues. A stage's func(item) returns the items to hand to the next
+    stage (an empty list drops the item).
+
+    put() blocks while the first queue is full, and every stage blocks
+    while the queue after it is full, so a burst backs up to whoever is
+    feeding the pipeline instead of piling up in memory. At most about
+    the sum of the queue sizes and worker counts is in flight.
+    '''
+    def __init__(self):
+        self.stages = list()
+        self.threads = list()
+        self.stopping = threading.Event()
+
+    def add(self, name, func, workers=1, maxsize=DEFAULT_QUEUE_SIZE):
+        stage = Stage(name, func, workers, maxsize)
+        if len(self.stages) > 0:
+            self.stages[-1].next = stage
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        for stage in self.stages:
+            for n in range(stage.workers):
+                t = threading.Thread(target=self.__work, args=(stage,), name='Pipeline-{0}-{1}'.format(stage.name, n))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def __put(self, queue, item):
+        while not self.stopping.is_set():
+            try:
+                queue.put(item, timeout=POLL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def put(self, item):
+        '''
+        Feeds item to the first stage, blocking while it is backed up.
+        False if the pipeline was stopped first.
+        '''
+        return self.__put(self.stages[0].queue, item)
+
+    def __work(self, stage):
+        while not self.stopping.is_set():
+            try:
+                item = stage.queue.get(timeout=POLL)
+            except Queue.Empty:
+                continue
+            try:
+                try:
+                    outputs = stage.func(item)
+                except:
+                    Log.error("Unexpected error in pipeline stage {0}".format(stage.name), exc_info=True)
+                    with stage.lock:
+                        stage.errors += 1
+                    continue
+                with stage.lock:
+                    stage.processed += 1
+                if stage.next is not None:
+                    for output in outputs:
+                        if not self.__put(stage.next.queue, output):
+                            break
+            finally:
+                stage.queue.task_done()
+
+    def join(self):
+        '''
+        Waits until everything put so far has gone through every stage.
+        '''
+        for stage in self.stages:
+            stage.queue.join()
+
+    def stop(self):
+        self.stopping.set()
+
+    def stats(self):
+        '''
+        [(name, queued, processed, errors)] for each stage.
+        '''
+        return [(s.name, s.queue.qsize(), s.processed, s.errors) for s in self.stages]
+
+def test_backpressure():
+    import time
+    lock = threading.Lock()
+    state = dict(inflight=0, peak=0, sunk=0)
+    def fanout(n):
+        if n % 100 == 99:
+            raise ValueError(n)
+        return [n, -n]
+    def slow(n):
+        time.sleep(0.0001)
+        return [n]
+    def sink(n):
+        with lock:
+            state['inflight'] -= 1
+            state['sunk'] += 1
+        return []
+
+    pipeline = Pipeline()
+    pipeline.add('fanout', fanout, maxsize=8)
+    pipeline.add('slow', slow, workers=4, maxsize=8)
+    pipeline.add('sink', sink, maxsize=8)
+    pipeline.start()
+    for n in range(3000):
+        with lock:
+            # Both outputs of n count as in flight from the moment it is put.
+            state['inflight'] += 2
+            state['peak'] = max(state['peak'], state['inflight'])
+        assert pipeline.put(n)
+        if n % 100 == 99:
+            with lock:
+                state['inflight'] -= 2
+    pipeline.join()
+    pipeline.stop()
+    # 3 queues of 8 and 6 workers, each of which can hold 2 outputs.
+    assert state['peak'] <= 2 * (3 * 8 + 6) + 2
+    assert state['sunk'] == 2 * (3000 - 30)
+    assert [(s[0], s[2], s[3]) for s in pipeline.stats()] == [('fanout', 2970, 30), ('slow', 5940, 0), ('sink', 5940, 0)]
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import time
+import heapq
+import logging
+import threading
+from store import SEEN_HORIZON
+
+DEFAULT_CAPACITY = 500000 # links
+
+Log = logging.getLogger()
+
+class SeenSet:
+    '''
+    The feed links already handled, each remembered until its expiry
+    (by default SEEN_HORIZON from when it was added) and then forgotten.
+    Membership is exact: a link is in the set from add() until age() is
+    called after its expiry.
+
+    capacity is a hard ceiling on memory. Past it the links closest to
+    expiring are dropped early, with a warning, since they are the least
+    likely to show up in a feed again.
+
+    The expiries match the seen table of store.AlertStore, which is what
+    makes the set survive restarts (see update()). Lookups need no lock;
+    changes are serialized.
+    '''
+    def __init__(self, horizon=SEEN_HORIZON, capacity=DEFAULT_CAPACITY):
+        self.horizon = horizon
+        self.capacity = capacity
+        self.expires = dict() # link -> expiry, seconds since the epoch
+        self.heap = list() # (expiry, link), may hold stale expiries
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.expires)
+
+    def __contains__(self, link):
+        return link in self.expires
+
+    def __iter__(self):
+        return iter(self.expires)
+
+    def add(self, link, expires=None):
+        if expires is None:
+            expires = int(time.time()) + self.horizon
+        with self.lock:
+            if self.expires.get(link) == expires:
+                return
+            self.expires[link] = expires
+            heapq.heappush(self.heap, (expires, link))
+            if len(self.expires) > self.capacity:
+                self.__evict()
+            elif len(self.heap) > 2 * len(self.expires) + 1024:
+                self.__compact()
+
+    def update(self, links):
+        '''
+        links: {link: expiry}, as returned by AlertStore.load, or any
+        iterable of links to remember for the default horizon.
+        '''
+        if isinstance(links, dict):
+            for link, expires in links.iteritems():
+                self.add(link, expires)
+        else:
+            for link in links:
+                self.add(link)
+
+    def __live(self, item):
+        return self.expires.get(item[1]) == item[0]
+
+    def __compact(self):
+        self.heap = [item for item in self.heap if self.__live(item)]
+        heapq.heapify(self.heap)
+
+    def __evict(self):
+        if self.evicted == 0:
+            Log.warning("More than {0} seen links, forgetting the oldest early.".format(self.capacity))
+        while len(self.expires) > self.capacity:
+            item = heapq.heappop(self.heap)
+            if self.__live(item):
+                del self.expires[item[1]]
+                self.evicted += 1
+
+    def age(self, now=None):
+        '''
+        Forgets the links that expired at or before now. Returns how many.
+        '''
+        if now is None:
+            now = time.time()
+        count = 0
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                item = heapq.heappop(self.heap)
+                if self.__live(item):
+                    del self.expires[item[1]]
+                    count += 1
+        return count
+
+def test_million_links():
+    import sys
+    horizon = 50000
+    capacity = 60000
+    seen = SeenSet(horizon, capacity)
+    peak = 0
+    for n in xrange(1000000):
+        link = 'http://alerts.example.com/cap/{0:07d}.cap'.format(n)
+        seen.add(link, n + horizon)
+        if n % 1000 == 0:
+            seen.age(n)
+            size = sys.getsizeof(seen.expires) + sys.getsizeof(seen.heap)
+            peak = max(peak, size)
+        # Re-adding (feeds repeat their entries every poll) must not grow it.
+        if n % 10 == 0:
+            seen.add(link, n + horizon)
+    assert len(seen) <= capacity and len(seen.heap) <= 2 * capacity + 1024
+    assert seen.evicted == 0
+    # Everything inside the window is still seen, nothing older is.
+    for n in range(1000000 - horizon + 1000, 1000000, 97):
+        assert 'http://alerts.example.com/cap/{0:07d}.cap'.format(n) in seen
+    for n in range(0, 1000000 - horizon - 1000, 997):
+        assert 'http://alerts.example.com/cap/{0:07d}.cap'.format(n) not in seen
+    # The containers and the link strings of a full window: a few MB.
+    perLink = sys.getsizeof('http://alerts.example.com/cap/0000000.cap') + sys.getsizeof(0) + sys.getsizeof((0, ''))
+    assert peak + capacity * perLink < 32 * 1024 * 1024
+
+    # Past capacity the earliest expiries go first.
+    seen = SeenSet(horizon, 100)
+    for n in range(150):
+        seen.add(n, 1000 - n)
+    assert len(seen) == 100 and seen.evicted == 50
+    assert all(n in seen for n in range(100)) and not any(n in seen for n in range(100, 150))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import math
+import logging
+import utils
+
+CELL_SIZE = 1.0 # degrees
+EARTH_RADIUS = 6371 # km, same sphere as utils.distance
+
+Log = logging.getLogger()
+
+def polygonBounds(polygon):
+    lats = [p[0] for p in polygon]
+    longs = [p[1] for p in polygon]
+    return min(lats), min(longs), max(lats), max(longs)
+
+def circleBounds(circle):
+    '''
+    A box that is sure to hold the circle, so the exact distance test
+    only ever rejects.
+    '''
+    lat, long, radius = circle
+    dlat = math.degrees(radius / float(EARTH_RADIUS)) * 1.01
+    top = min(abs(lat) + dlat, 90.0)
+    if top >= 89.0:
+        return lat - dlat, -180.0, lat + dlat, 180.0
+    dlong = min(dlat / math.cos(math.radians(top)), 180.0)
+    return lat - dlat, long - dlong, lat + dlat, long + dlong
+
+class AlertIndex:
+    '''
+    Uniform grid over the bounding boxes of the polygons and circles of
+    indexed alerts. A point query only looks at the shapes registered in
+    the point's cell, and runs the exact test from cap.Alert.checkCoords
+    on those whose bounding box holds the point.
+
+    Alerts are keyed on alert.id, so insert() of a new alert with the
+    same id replaces the old one.
+    '''
+    def __init__(self, cellSize=CELL_SIZE):
+        self.cellSize = float(cellSize)
+        self.cells = dict() # (row, col) -> list of shapes
+        self.alerts = dict() # alert.id -> (alert, shapes)
+
+    def __len__(self):
+        return len(self.alerts)
+
+    def __contains__(self, alert):
+        return alert.id in self.alerts
+
+    def __cell(self, lat, long):
+        return int(math.floor(lat / self.cellSize)), int(math.floor(long / self.cellSize))
+
+    def __cellsFor(self, bounds):
+        r0, c0 = self.__cell(bounds[0], bounds[1])
+        r1, c1 = self.__cell(bounds[2], bounds[3])
+        for r in xrange(r0, r1 + 1):
+            for c in xrange(c0, c1 + 1):
+                yield r, c
+
+    def insert(self, alert):
+        if alert.id in self.alerts:
+            self.remove(alert)
+        shapes = list()
+        for info in alert.infos:
+            for area in info.areas:
+                for circle in area.circles:
+                    shapes.append((alert.id, circleBounds(circle), None, circle))
+                for polygon in area.polygons:
+                    if len(polygon) > 0:
+                        shapes.append((alert.id, polygonBounds(polygon), polygon, None))
+        for shape in shapes:
+            for key in self.__cellsFor(shape[1]):
+                if key in self.cells:
+                    self.cells[key].append(shape)
+                else:
+                    self.cells[key] = [shape]
+        self.alerts[alert.id] = (alert, shapes)
+
+    def remove(self, alert):
+        if alert.id not in self.alerts:
+            return False
+        alert, shapes = self.alerts.pop(alert.id)
+        for shape in shapes:
+            for key in self.__cellsFor(shape[1]):
+                cell = self.cells[key]
+                cell.remove(shape)
+                if len(cell) is 0:
+                    del self.cells[key]
+        return True
+
+    @staticmethod
+    def covers(shape, coords):
+        bounds = shape[1]
+        x, y = coords
+        if x < bounds[0] or x > bounds[2] or y < bounds[1] or y > bounds[3]:
+            return False
+        if shape[2] is not None:
+            return utils.point_inside_polygon(x, y, shape[2])
+        lat, long, radius = shape[3]
+        return utils.distance((lat, long), coords) < radius
+
+    def query(self, coords):
+        '''
+        Alerts with a polygon or circle covering coords (lat, long).
+        '''
+        found = list()
+        ids = set()
+        for shape in self.cells.get(self.__cell(*coords), ()):
+            if shape[0] not in ids and AlertIndex.covers(shape, coords):
+                ids.add(shape[0])
+                found.append(self.alerts[shape[0]][0])
+        return found
+
+    def queryMany(self, points):
+        '''
+        query() for every point, in order. Points are bucketed by cell
+        first so each cell's shape list is fetched once.
+        '''
+        buckets = dict()
+        for n, coords in enumerate(points):
+            buckets.setdefault(self.__cell(*coords), []).append(n)
+        results = [None] * len(points)
+        for key, members in buckets.iteritems():
+            shapes = self.cells.get(key, ())
+            for n in members:
+                coords = points[n]
+                found = list()
+                ids = set()
+                for shape in shapes:
+                    if shape[0] not in ids and AlertIndex.covers(shape, coords):
+                        ids.add(shape[0])
+                        found.append(self.alerts[shape[0]][0])
+                results[n] = found
+        return results
+
+def test_index_matches_checkCoords():
+    import random
+    import cap
+    alerts = list()
+    for n in range(40):
+        a = cap.Alert()
+        a.setId('alert%d' % n)
+        i = cap.Info()
+        area = cap.Area()
+        lat = random.uniform(30, 45)
+        long = random.uniform(-125, -110)
+        if n % 2:
+            area.addCircle('{0},{1} {2}'.format(lat, long, random.uniform(5, 300)))
+        else:
+            area.addPolygon(' '.join('{0},{1}'.format(lat + random.uniform(-3, 3), long + random.uniform(-3, 3)) for x in range(6)))
+        i.addArea(area)
+        a.addInfo(i)
+        alerts.append(a)
+
+    index = AlertIndex()
+    for a in alerts:
+        index.insert(a)
+    points = [(random.uniform(28, 47), random.uniform(-128, -107)) for x in range(500)]
+    batch = index.queryMany(points)
+    for coords, found in zip(points, batch):
+        expected = set(a.id for a in alerts if a.checkCoords(coords))
+        assert set(a.id for a in index.query(coords)) == expected
+        assert set(a.id for a in found) == expected
+
+    for a in alerts[::2]:
+        assert index.remove(a)
+    assert len(index) == 20
+    for coords in points:
+        expected = set(a.id for a in alerts[1::2] if a.checkCoords(coords))
+        assert set(a.id for a in index.query(coords)) == expected
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2011 Andrew G. Potter
+#    This file is part of the GNOME Common Alerting Protocol Viewer.
+#
+#    GNOME Common Alerting Protocol Viewer is free software: you can
+#    redistribute it and/or modify it under the terms of the GNU General
+#    Public License as published by the Free Software Foundation, either
+#    version 3 of the License, or (at your option) any later version.
+#
+#    GNOME Common Alerting Protocol Viewer is distributed in the hope
+#    that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#    implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#    PURPOSE.  See the    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Common Alerting Protocol Viewer.
+#    If not, see <http://www.gnu.org/licenses/>.
+#===============================================================================
+
+import os
+import time
+import calendar
+import cPickle
+import sqlite3
+import logging
+import threading
+
+DEFAULT_PATH = os.path.expanduser('~/.cache/capviewer/alerts.db')
+SEEN_HORIZON = 60*60*24*7 # seconds a seen link without a stored alert is remembered
+COMPACT_INTERVAL = 60*60 # seconds
+
+Log = logging.getLogger()
+
+def epoch(dt):
+    if dt is None:
+        return None
+    return calendar.timegm(dt.utctimetuple())
+
+class AlertStore:
+    '''
+    SQLite file holding the parsed alerts (pickled) and the feed links
+    that have been seen, each with the time it can be forgotten. load()
+    rebuilds the engine's state at startup without touching the network.
+    path None keeps everything in memory.
+    '''
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        if path is None:
+            path = ':memory:'
+        else:
+            directory = os.path.dirname(path)
+            if len(directory) > 0 and not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS alerts (id TEXT PRIMARY KEY, link TEXT, expires INTEGER, data BLOB)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS alerts_expires ON alerts (expires)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS seen (link TEXT PRIMARY KEY, expires INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS seen_expires ON seen (expires)')
+        self.db.commit()
+        self.compactor = None
+        self.stopping = threading.Event()
+
+    def close(self):
+        self.stopping.set()
+        with self.lock:
+            self.db.close()
+
+    def put(self, alert, link=None):
+        self.putMany([(alert, link)])
+
+    def putMany(self, alerts):
+        '''
+        alerts: [(alert, link)], written in a single transaction.
+        '''
+        rows = list()
+        for alert, link in alerts:
+            data = sqlite3.Binary(cPickle.dumps(alert, cPickle.HIGHEST_PROTOCOL))
+            rows.append((alert.id, link, epoch(alert.getExpires()), data))
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO alerts VALUES (?, ?, ?, ?)', rows)
+            self.db.executemany('INSERT OR REPLACE INTO seen VALUES (?, ?)', ((row[1], row[2]) for row in rows if row[1] is not None))
+            self.db.commit()
+
+    def markSeen(self, links, expires=None):
+        '''
+        Remembers links, by default for SEEN_HORIZON. A link whose alert
+        is put() later gets the alert's expiry instead.
+        '''
+        if expires is None:
+            expires = int(time.time()) + SEEN_HORIZON
+        with self.lock:
+            self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)', ((link, expires) for link in links))
+            self.db.commit()
+
+    def delete(self, alert):
+        with self.lock:
+            self.db.execute('DELETE FROM alerts WHERE id = ?', (alert.id,))
+            self.db.commit()
+
+    def load(self, now=None):
+        '''
+        (alerts, seen): the unexpired alerts, and {link: expiry} of the
+        seen links.
+        '''
+        if now is None:
+            now = int(time.time())
+        alerts = list()
+        with self.lock:
+            rows = self.db.execute('SELECT id, data FROM alerts WHERE expires IS NULL OR expires > ?', (now,)).fetchall()
+            seen = dict(self.db.execute('SELECT link, expires FROM seen'))
+        for id, data in rows:
+            try:
+                alerts.append(cPickle.loads(str(data)))
+            except:
+                Log.warning("Dropping unreadable stored alert {0}".format(id), exc_info=True)
+        return alerts, seen
+
+    def compact(self, now=None):
+        '''
+        Deletes expired alerts and seen links. Returns how many rows went.
+        '''
+        if now is None:
+            now = int(time.time())
+        with self.lock:
+            alerts = self.db.execute('DELETE FROM alerts WHERE expires <= ?', (now,)).rowcount
+            seen = self.db.execute('DELETE FROM seen WHERE expires <= ?', (now,)).rowcount
+            self.db.commit()
+        if alerts > 0 or seen > 0:
+            Log.info("Compacted alert store: {0} alerts, {1} seen links".format(alerts, seen))
+        return alerts + seen
+
+    def startCompactor(self, interval=COMPACT_INTERVAL):
+        def run():
+            while not self.stopping.wait(interval):
+                try:
+                    self.compact()
+                except:
+                    Log.error("Unexpected error compacting alert store.", exc_info=True)
+        self.compactor = threading.Thread(target=run, name='AlertStore-compact')
+        self.compactor.daemon = True
+        self.compactor.start()
+
+def test_store_round_trip():
+    import glob
+    import shutil
+    import tempfile
+    import parse
+    directory = tempfile.mkdtemp()
+    try:
+        store = AlertStore(os.path.join(directory, 'alerts.db'))
+        caps = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'caps')
+        alerts = [parse.ReadCAP(f) for f in sorted(glob.glob(os.path.join(caps, 'alert*.cap')))]
+        for n, alert in enumerate(alerts):
+            store.put(alert, 'http://example.com/%d.cap' % n)
+        store.markSeen(['http://example.com/filtered.cap'])
+        store.close()
+
+        store = AlertStore(os.path.join(directory, 'alerts.db'))
+        loaded, seen = store.load(now=0)
+        assert sorted(a.id for a in loaded) == sorted(a.id for a in alerts)
+        assert parse._state(sorted(loaded)) == parse._state(sorted(alerts))
+        assert len(seen) == len(alerts) + 1
+
+        # The sample caps all expired years ago.
+        assert store.load()[0] == []
+        store.compact()
+        loaded, seen = store.load(now=0)
+        assert loaded == [] and seen.keys() == ['http://example.com/filtered.cap']
+        store.close()
+    finally:
+        shutil.rmtree(directory)
@@ -22,37 +22,29 @@ import gobject
 import gtk
 import pygtk
 pygtk.require("2.0")
-import heapq
+import Queue
 
 import pynotify
 import logging
-import parse
 import cap
+import engine
+import metrics
+from mapcache import MapCache
 from window import Window
 
 
-Log = logging.getLogger()
+DRAIN_BATCH = 50 # engine events handled per trip through the main loop
 
+Log = logging.getLogger()
 
-LATLONG_COORDS = (38.56513,-121.75156)
-STATECODE = 'CA'
-FIPSCODE = '06113'
-UGCCODE = '017'
 
 class CAPTray:
 
     def __init__(self):
-        self.caps = []
-        self.rssfeeds = set()
-        self.seen = set()
         self.windows = list()
-
-#        self.rssfeeds.add('http://www.usgs.gov/hazard_alert/alerts/landslides.rss')
-
-#        self.rssfeeds.add('http://alerts.weather.gov/cap/ca.php?x=0')
-        self.rssfeeds.add('http://edis.oes.ca.gov/index.atom')
-#        self.rssfeeds.add('http://earthquake.usgs.gov/eqcenter/recenteqsww/catalogs/caprss7days5.xml')
-        self.mycoords = LATLONG_COORDS
+        self.draining = False
+        self.maps = MapCache()
+        self.engine = engine.IngestEngine(wakeup=self.wakeup, maps=self.maps)
         
         self.statusIcon = gtk.StatusIcon()
         self.statusIcon.set_from_stock(gtk.STOCK_DIALOG_WARNING)
@@ -72,7 +64,6 @@ class CAPTray:
         self.statusIcon.connect('popup-menu', self.popup_menu_cb, self.menu)
         self.statusIcon.set_visible(1)
 
-        gobject.timeout_add_seconds(60*10, self.rssTimer_cb)
         gobject.timeout_add(100, self.startup_cb)
     
 	self.execute_cb(None, None, None)
@@ -81,82 +72,80 @@ class CAPTray:
         window = Window(self)
         self.windows.append(window)
         
-        localcaps = list(self.caps)
-        for i in range(len(localcaps)):
-            window.acceptCap(heapq.heappop(localcaps))
+        for alert in self.engine.getAlerts():
+            window.acceptCap(alert)
     
     def window_quit_cb(self, window):
         self.windows.remove(window)
     
     def quit_cb(self, widget, data=None):
+        self.engine.stop()
         gtk.main_quit()
 
     def startup_cb(self):
-        self.rssTimer_cb(True)
+        self.engine.start()
         return False
     
-    def rssTimer_cb(self, isInitial=False):
-        Log.info("Hitting up RSS Feeds.")
-        entries = list()
-        for rssfeed in self.rssfeeds:
-            entries.extend(filter(lambda entry: entry.caplink not in self.seen, parse.feedParser(rssfeed)))
-        
-        for newEntry in entries:
-            self.seen.add(newEntry.caplink)
-            if newEntry.checkFips(FIPSCODE) or newEntry.checkCoords(LATLONG_COORDS) or True:
-                Log.info("New alert from feed {0}: {1}".format(newEntry.fromFeed, newEntry.summary))
-                alert = parse.ReadCAP(newEntry.caplink)
-                if alert is None:
-                    continue
-                
-                if alert.checkUGC(STATECODE, FIPSCODE, UGCCODE) or alert.checkCoords(LATLONG_COORDS) or alert.checkArea('FIPS6', '000000') or True:
-                    if not alert.isExpired():
-                        heapq.heappush(self.caps,alert)
-                        for window in self.windows:
-                            window.acceptCap(alert)
-                            
-                        if not isInitial:
-                            if len(alert.infos) is 0:
-                                Log.debug("Alert %s had no info." % alert.id)
-                                continue
-                            if alert.infos[0].description is None:
-                                alert.infos[0].description = "NO DESCRIPTION"
-                            if not pynotify.is_initted():
-                                pynotify.init("GNOME Common Alerting Protocol Viewer")
-                            n = pynotify.Notification(alert.getTitle(), "<a href='{0}'>Link</a>\n{1}".format(alert.url, alert.infos[0].description[0:120]))
-                            n.set_urgency(pynotify.URGENCY_NORMAL)
-                            n.set_category("device")
-                        
-                            if alert.infos[0].severity is cap.Info.SEVERITY_MODERATE:
-                                i = gtk.STOCK_DIALOG_WARNING
-                            elif alert.infos[0].severity is cap.Info.SEVERITY_MINOR:
-                                i = gtk.STOCK_DIALOG_INFO
-                            elif alert.infos[0].severity is cap.Info.SEVERITY_SEVERE or alert.infos[0].severity is cap.Info.SEVERITY_EXTREME:
-                                i = gtk.STOCK_DIALOG_ERROR
-                            else:
-                                i = gtk.STOCK_DIALOG_QUESTION
-                            helper = gtk.Button()
-                            icon = helper.render_icon(i, gtk.ICON_SIZE_DIALOG)
-                            n.set_icon_from_pixbuf(icon)
-                            
-                            n.show()
-                    else:
-                        Log.info("... but it is already expired.")
-        Log.info("Done checking RSS feeds.")
-        self.ejectExpired()
-#        self.caps['Testing 1'] = parse.ReadCAP('../alert.cap')
-#        self.caps['Testing 2'] = parse.ReadCAP('../alert2.cap')
-#        self.caps['Testing 3'] = parse.ReadCAP('../alert3.cap')
-#        self.caps['Testing 4'] = parse.ReadCAP('../alert4.cap')
+    def rssTimer_cb(self, *args):
+        self.engine.pollNow()
         return True
-    
-    def ejectExpired(self):
-        for cap in self.caps:
-            if cap.isExpired():
-                Log.info("CAP {0} has expired.".format(cap))
-                self.caps.remove(cap)
-        heapq.heapify(self.caps)
 
+    def wakeup(self):
+        # Called from the engine thread. Only schedule one drain at a time.
+        if not self.draining:
+            self.draining = True
+            gobject.idle_add(self.drain_cb)
+
+    def drain_cb(self):
+        # A burst is handled a batch at a time so the main loop keeps
+        # redrawing; the engine waits while its events queue is full.
+        self.draining = False
+        for x in range(DRAIN_BATCH):
+            try:
+                event = self.engine.events.get_nowait()
+            except Queue.Empty:
+                return False
+            if event[0] is engine.EVENT_ALERT:
+                alert, isInitial, alertEvent, absorbed = event[1:]
+                for window in self.windows:
+                    window.acceptCap(alert, alertEvent, absorbed)
+                if not isInitial:
+                    self.notify(alert)
+            elif event[0] in (engine.EVENT_EXPIRED, engine.EVENT_SUPERSEDED):
+                for window in self.windows:
+                    window.removeCap(event[1])
+        return True
+
+    def notify(self, alert):
+        with metrics.timer('notify_seconds'):
+            self.__notify(alert)
+
+    def __notify(self, alert):
+        if len(alert.infos) is 0:
+            Log.debug("Alert %s had no info." % alert.id)
+            return
+        if alert.infos[0].description is None:
+            alert.infos[0].description = "NO DESCRIPTION"
+        if not pynotify.is_initted():
+            pynotify.init("GNOME Common Alerting Protocol Viewer")
+        n = pynotify.Notification(alert.getTitle(), "<a href='{0}'>Link</a>\n{1}".format(alert.url, alert.infos[0].description[0:120]))
+        n.set_urgency(pynotify.URGENCY_NORMAL)
+        n.set_category("device")
+    
+        if alert.infos[0].severity is cap.Info.SEVERITY_MODERATE:
+            i = gtk.STOCK_DIALOG_WARNING
+        elif alert.infos[0].severity is cap.Info.SEVERITY_MINOR:
+            i = gtk.STOCK_DIALOG_INFO
+        elif alert.infos[0].severity is cap.Info.SEVERITY_SEVERE or alert.infos[0].severity is cap.Info.SEVERITY_EXTREME:
+            i = gtk.STOCK_DIALOG_ERROR
+        else:
+            i = gtk.STOCK_DIALOG_QUESTION
+        helper = gtk.Button()
+        icon = helper.render_icon(i, gtk.ICON_SIZE_DIALOG)
+        n.set_icon_from_pixbuf(icon)
+        
+        n.show()
+    
     def popup_menu_cb(self, widget, button, time, data=None):
         if button == 3:
             if data:
@@ -18,10 +18,23 @@
 #    If not, see <http://www.gnu.org/licenses/>.
 #===============================================================================
 
+import os
+import re
+import cgi
 import math
 import logging
+import glineenc
+try:
+    import numpy
+except ImportError:
+    numpy = None
 Log = logging.getLogger()
 
+# Largest (points x edges) boolean matrix built at once by the array kernels.
+CHUNK_ELEMENTS = 1 << 20
+HTML_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'html')
+MARKER_COORDS = '38.56513, -121.75156'
+
 def point_inside_polygon(x,y,poly):
     '''
     Credit: http://www.ariel.com.au/a/python-point-int-poly.html
@@ -45,25 +58,93 @@ def point_inside_polygon(x,y,poly):
     return inside
 
 
-def mapPolygon(polygon, markerCoords='38.56513, -121.75156', areaDesc=' ', markerTitle=' '):
-    p1 = open('html/poly1.html').read().replace('ORIGIN', markerCoords).replace('MARKER_TITLE',markerTitle)
-    for x in range(len(polygon)):
-        if x is not len(polygon) - 1:
-            lat, long = polygon[x]
-            p1 +='new google.maps.LatLng(' + str(lat) + ', ' + str(long) + '),\n'
-        else:
-            p1 +='new google.maps.LatLng(' + str(lat) + ', ' + str(long) + ')\n'
-    p1 += open('html/poly2.html').read().replace('INFOWINDOW_CONTENT',str(areaDesc).strip().replace("\n",'<br />'))
-    return p1
+class Template:
+    '''
+    A map page split at its placeholders once, so rendering it is a
+    single join of the pieces and the values.
+    '''
+    def __init__(self, text, placeholders):
+        pattern = re.compile('(' + '|'.join(re.escape(p) for p in placeholders) + ')')
+        self.pieces = pattern.split(text)
+        # Every other piece is a placeholder: (index, name).
+        self.slots = [(n, self.pieces[n]) for n in range(1, len(self.pieces), 2)]
+
+    def render(self, values):
+        pieces = list(self.pieces)
+        for n, name in self.slots:
+            pieces[n] = values[name]
+        return ''.join(pieces)
+
+def readTemplate(name):
+    with open(os.path.join(HTML_DIR, name)) as f:
+        return f.read()
 
+# poly1.html ends where the coordinates go and poly2.html carries on.
+POLYGON_PAGE = Template(readTemplate('poly1.html') + 'COORDINATES' + readTemplate('poly2.html'),
+                        ('ORIGIN', 'MARKER_TITLE', 'COORDINATES', 'INFOWINDOW_CONTENT'))
+CIRCLE_PAGE = Template(readTemplate('circle1.html'), ('ORIGIN', 'MARKER_TITLE', 'CENTER', 'RADIUSMETERS', 'INFOWINDOW_CONTENT'))
+AREAS_PAGE = Template(readTemplate('areas.html'), ('ORIGIN', 'MARKER_TITLE', 'SHAPES'))
 
-def mapCircle(circle, markerCoords='38.56513,-121.75156', areaDesc=' ', markerTitle=' '):
+def jsText(text):
+    '''
+    text as HTML inside a quoted JavaScript string of a map page, newlines
+    as <br />.
+    '''
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    text = cgi.escape(str(text).strip()).replace('\\', '\\\\').replace("'", "\\'").replace('"', '\\"')
+    return text.replace('\r', '').replace('\n', '<br />')
+
+def mapPolygon(polygon, markerCoords=MARKER_COORDS, areaDesc=' ', markerTitle=' '):
+    coordinates = ',\n'.join(['new google.maps.LatLng(%s, %s)' % (lat, long) for lat, long in polygon])
+    return POLYGON_PAGE.render(dict(ORIGIN=markerCoords, MARKER_TITLE=jsText(markerTitle),
+                                    COORDINATES=coordinates + '\n', INFOWINDOW_CONTENT=jsText(areaDesc)))
+
+def mapCircle(circle, markerCoords=MARKER_COORDS, areaDesc=' ', markerTitle=' '):
     x, y, radius = circle
     radius = radius * 1000 # meters
-    p1 =  open('html/circle1.html').read().replace('ORIGIN', markerCoords).replace('RADIUSMETERS', str(radius)).replace('CENTER', str(x) + ', ' + str(y).replace('MARKER_TITLE',markerTitle))
-    p1.replace('INFOWINDOW_CONTENT',areaDesc.strip().replace("\n",'<br /'))
-    
-    return p1
+    return CIRCLE_PAGE.render(dict(ORIGIN=markerCoords, MARKER_TITLE=jsText(markerTitle), CENTER='%s, %s' % (x, y),
+                                   RADIUSMETERS=str(radius), INFOWINDOW_CONTENT=jsText(areaDesc)))
+
+def areaKey(area):
+    '''
+    The content of a cap.Area as drawn on a map: (areaDesc, polygons,
+    circles), hashable.
+    '''
+    return (getattr(area, 'areaDesc', None) or ' ', tuple(tuple(polygon) for polygon in area.polygons), tuple(area.circles))
+
+def mapAreas(areas, markerCoords=MARKER_COORDS, markerTitle=' ', encode=glineenc.encode_pairs):
+    '''
+    One map page of every polygon and circle of areas (cap.Area), each
+    area a layer that can be hidden and that shows its areaDesc when
+    clicked, zoomed to fit them all. Areas repeated, as by the infos of
+    an alert in several languages, are drawn once.
+
+    Polygons go in polyline encoded, as encode(polygon) gives them, and
+    are decoded by the page; a few bytes a vertex rather than two floats
+    written out. Those encode is None for, or returns None for, are
+    written out as coordinates: a template fill with no simplifying or
+    encoding to pay for.
+    '''
+    shapes = list()
+    seen = set()
+    for area in areas:
+        key = areaKey(area)
+        if key in seen or (len(area.polygons) is 0 and len(area.circles) is 0):
+            continue
+        seen.add(key)
+        content = jsText(key[0])
+        shapes.append("    addLayer('" + content + "');\n")
+        for polygon in area.polygons:
+            encoded = encode(polygon) if encode is not None else None
+            if encoded is None:
+                shapes.append("    addPath([" + ', '.join(['[%s, %s]' % (lat, long) for lat, long in polygon]) + "], '" + content + "');\n")
+            else:
+                # Encoded points are '?' to '~', of which only \ needs escaping.
+                shapes.append("    addPolygon('" + encoded[0].replace('\\', '\\\\') + "', '" + content + "');\n")
+        for x, y, radius in area.circles:
+            shapes.append("    addCircle(%s, %s, %s, '%s');\n" % (x, y, radius * 1000, content))
+    return AREAS_PAGE.render(dict(ORIGIN=markerCoords, MARKER_TITLE=jsText(markerTitle), SHAPES=''.join(shapes)))
 
 def distance(origin, destination):
     '''
@@ -82,3 +163,143 @@ def distance(origin, destination):
     d = radius * c
 
     return d
+
+
+def points_inside_polygon(points, poly):
+    '''
+    Array version of point_inside_polygon. points is an (N,2) array of
+    (x, y) and the result is a boolean mask with the same answer the
+    scalar crossing test gives for each point, boundaries included.
+    Needs numpy.
+    '''
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    poly = numpy.asarray(poly, dtype=numpy.float64).reshape(-1, 2)
+    if len(poly) is 0:
+        raise IndexError('empty polygon') # same as point_inside_polygon
+    # The scalar loop starts with the degenerate edge poly[0]->poly[0],
+    # which can never cross, then walks poly[k]->poly[k+1] and closes
+    # the ring with poly[n-1]->poly[0].
+    p1 = poly
+    p2 = numpy.roll(poly, -1, axis=0)
+    p1x, p1y = p1[:, 0], p1[:, 1]
+    p2x, p2y = p2[:, 0], p2[:, 1]
+    miny = numpy.minimum(p1y, p2y)
+    maxy = numpy.maximum(p1y, p2y)
+    maxx = numpy.maximum(p1x, p2x)
+    vertical = p1x == p2x
+    dx = p2x - p1x
+    dy = p2y - p1y
+
+    inside = numpy.zeros(len(points), dtype=bool)
+    step = max(1, CHUNK_ELEMENTS // max(1, len(poly)))
+    for start in xrange(0, len(points), step):
+        x = points[start:start + step, 0:1]
+        y = points[start:start + step, 1:2]
+        # Horizontal edges divide by zero here (NaN/inf), but they never
+        # pass the y tests so their xinters never decides anything.
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            xinters = (y - p1y) * dx / dy + p1x
+            crosses = (y > miny) & (y <= maxy) & (x <= maxx) & (vertical | (x <= xinters))
+        inside[start:start + step] = (numpy.count_nonzero(crosses, axis=1) % 2) == 1
+    return inside
+
+def points_inside_polygons(points, polygons):
+    '''
+    Mask of the points inside any of the polygons.
+    '''
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    mask = numpy.zeros(len(points), dtype=bool)
+    for polygon in polygons:
+        mask |= points_inside_polygon(points, polygon)
+    return mask
+
+def distances(points, destination):
+    '''
+    Array version of distance(): haversine distance in km from every
+    (lat, long) in points to destination.
+    '''
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    lat1 = points[:, 0]
+    lon1 = points[:, 1]
+    lat2, lon2 = destination
+    radius = 6371 # km
+
+    dlat = numpy.radians(lat2-lat1)
+    dlon = numpy.radians(lon2-lon1)
+    a = numpy.sin(dlat/2) * numpy.sin(dlat/2) + numpy.cos(numpy.radians(lat1)) \
+        * numpy.cos(numpy.radians(lat2)) * numpy.sin(dlon/2) * numpy.sin(dlon/2)
+    c = 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1-a))
+    return radius * c
+
+def points_inside_circles(points, circles):
+    '''
+    Mask of the points closer than radius km to the center of any of the
+    (lat, long, radius) circles, the test cap.Alert.checkCoords uses.
+    '''
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    mask = numpy.zeros(len(points), dtype=bool)
+    for lat, long, radius in circles:
+        mask |= distances(points, (lat, long)) < radius
+    return mask
+
+def test_points_inside_polygon():
+    import random
+    polys = [
+             [(0.0, 0.0), (0.0, 4.0), (4.0, 4.0), (4.0, 0.0), (0.0, 0.0)],
+             [(1.0, 1.0), (3.0, 1.0), (2.0, 3.0)],
+             [(random.uniform(-5, 5), random.uniform(-5, 5)) for x in range(40)],
+             ]
+    points = [(random.uniform(-6, 6), random.uniform(-6, 6)) for x in range(3000)]
+    # vertices, edges and grid points exercise the boundary handling
+    points += [(float(x), float(y)) for x in range(-1, 6) for y in range(-1, 6)]
+    points += [(2.0, 1.0), (2.0, 3.0), (1.5, 2.0)]
+    for poly in polys:
+        mask = points_inside_polygon(points, poly)
+        assert list(mask) == [point_inside_polygon(x, y, poly) for x, y in points]
+
+def test_distances():
+    import random
+    points = [(random.uniform(-80, 80), random.uniform(-180, 180)) for x in range(3000)]
+    origin = (38.56513, -121.75156)
+    d = distances(points, origin)
+    expected = [distance(p, origin) for p in points]
+    assert numpy.allclose(d, expected, rtol=1e-12, atol=1e-9)
+    circles = [(38.5, -121.7, 500.0), (-10.0, 30.0, 2000.0)]
+    mask = points_inside_circles(points, circles)
+    assert list(mask) == [any(distance((lat, long), p) < r for lat, long, r in circles) for p in points]
+
+def test_map_pages():
+    import cap
+    polygon = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453), (38.5, -120.2)]
+    page = mapPolygon(polygon, areaDesc="Prince George's\nCounty <MD>")
+    assert page.startswith(readTemplate('poly1.html').replace('ORIGIN', MARKER_COORDS).replace('MARKER_TITLE', ''))
+    assert 'new google.maps.LatLng(38.5, -120.2),\nnew google.maps.LatLng(40.7, -120.95),\n' in page
+    assert 'new google.maps.LatLng(38.5, -120.2)\n    ];' in page
+    assert "'Prince George\\'s<br />County &lt;MD&gt;'" in page
+    page = mapCircle((38.5, -120.2, 1.5), areaDesc='Davis', markerTitle='Home')
+    assert 'title:"Home"' in page and 'radius: 1500.0' in page and 'LatLng(38.5, -120.2)' in page
+    assert '<br />Davis"' in page
+    for page in (mapPolygon(polygon), mapCircle((38.5, -120.2, 1.5))):
+        for placeholder in ('ORIGIN', 'MARKER_TITLE', 'COORDINATES', 'CENTER', 'RADIUSMETERS', 'INFOWINDOW_CONTENT'):
+            assert placeholder not in page
+
+    areas = list()
+    for n, desc in enumerate((u'North', u'South – coast')):
+        area = cap.Area()
+        area.areaDesc = desc
+        area.addPolygon(' '.join('{0},{1}'.format(x + n, y) for x, y in polygon))
+        area.addCircle('38.5,-120.2 {0}'.format(n + 1))
+        areas.append(area)
+    empty = cap.Area()
+    empty.areaDesc = u'Nowhere'
+    page = mapAreas(areas + [empty] + areas)
+    assert page.count("addLayer('") == 2 and page.count("addPolygon('") == 2 and page.count('addCircle(3') == 2
+    encoded = glineenc.encode_pairs(areas[1].polygons[0])[0]
+    assert '\\' in encoded
+    assert "addPolygon('" + encoded.replace('\\', '\\\\') + "', 'South \xe2\x80\x93 coast');" in page
+    assert "addCircle(38.5, -120.2, 1000.0, 'North');" in page
+    assert 'SHAPES' not in page
+    page = mapAreas(areas, encode=None)
+    assert "addPolygon('" not in page and page.count("addPath([") == 2
+    assert "addPath([[38.5, -120.2], [40.7, -120.95], [43.252, -126.453], [38.5, -120.2]], 'North');" in page
+    assert mapAreas(areas, encode=lambda polygon: None) == page
@@ -24,7 +24,7 @@ pygtk.require("2.0")
 
 import heapq
 import cap
-import utils
+import metrics
 import logging
 import datetime
 import dateutil
@@ -80,7 +80,36 @@ class KeyTable(gtk.Table):
 
     def __delChild(self, child):
         self.remove(child)
-        
+
+class AlertDetail:
+    '''
+    What populateCap builds for one alert, kept so showing it again is
+    instant: its KeyTable of summary rows, and its notebook pages. Each
+    page starts as an empty holder and build(holder) fills it the first
+    time it is switched to.
+    '''
+    def __init__(self, alert):
+        self.alert = alert
+        self.keyTable = KeyTable()
+        self.pages = list() # [(holder, tab label)] in notebook order
+        self.builders = dict() # holder -> function making its content, until it is built
+        self.mapHolder = None
+
+    def addPage(self, label, builder=None):
+        holder = gtk.Alignment(0.0, 0.0, 1.0, 1.0)
+        holder.show()
+        self.pages.append((holder, gtk.Label(label)))
+        if builder is not None:
+            self.builders[holder] = builder
+        return holder
+
+    def build(self, holder):
+        builder = self.builders.pop(holder, None)
+        if builder is not None:
+            child = builder()
+            holder.add(child)
+            child.show()
+
 class Window:
     __COLOR_BLACK = gtk.gdk.color_parse("black") 
     __COLOR_GREEN = gtk.gdk.color_parse("ForestGreen") 
@@ -289,8 +318,10 @@ class Window:
     def __init__(self, tray):
         self.alerts = dict()
         self.ids = list()
-        self.parents = set()
-        self.parentiters = dict()
+        self.parentiters = dict() # Event -> its top row in treeStore
+        self.rowiters = dict() # alert -> its row in treeStore
+        self.details = dict() # alert.id -> AlertDetail
+        self.detail = None # the AlertDetail shown
         self.tray = tray
         
         self.index = -1
@@ -308,14 +339,32 @@ class Window:
         self.viewport.add(self.keyTable);
         
         self.notebook = builder.get_object("notebook")
+        # One map of every area of the alert shown, in the same WebView
+        # whichever alert that is; it moves to the Map page shown.
+        self.mapView = webkit.WebView()
+        self.mapView.show()
+        self.mapPage = None # html loaded in mapView
         self.window.show_all()
 
         
 
     def changepage_cb(self, notebook, page, page_num, data=None):
-        p = self.notebook.get_nth_page(page_num)
+        if self.detail is not None:
+            self.__showPage(self.detail, self.notebook.get_nth_page(page_num))
         return True
 
+    def __showPage(self, detail, holder):
+        if holder is None:
+            return
+        detail.build(holder)
+        if holder is detail.mapHolder:
+            if self.mapView.get_parent() is None:
+                holder.add(self.mapView)
+            html = self.tray.maps.alertPage(detail.alert)
+            if html is not self.mapPage:
+                self.mapView.load_html_string(html, 'http://localhost/testing')
+                self.mapPage = html
+
     def combobox_changed_cb(self, combobox):
         active = combobox.get_active()
         if active >= 0:
@@ -332,11 +381,78 @@ class Window:
         self.tray.window_quit_cb(self)
 
     def removeCap(self, alert):
-        # TODO: Implement removal
-        pass
-
-    def acceptCap(self, alert):
+        '''
+        Drops an expired or superseded alert from both combo boxes. Alerts
+        filed under it in the tree are filed again as if they had just
+        arrived.
+        '''
+        if alert.id not in self.alerts:
+            return
+        del self.alerts[alert.id]
+        detail = self.details.pop(alert.id, None)
+        if detail is not None and detail is self.detail:
+            self.__clearDetail()
+            self.viewport.add(self.keyTable)
+            self.keyTable.show_all()
+        while alert.id in self.ids:
+            n = self.ids.index(alert.id)
+            del self.ids[n]
+            self.comboBoxListStore.remove(self.comboBoxListStore.get_iter((n,)))
+            if self.index > n:
+                self.index -= 1
+            elif self.index == n:
+                self.index = -1
+
+        for stale in [a for a in self.rowiters if a.id == alert.id]:
+            iter = self.rowiters.pop(stale)
+            orphans = list()
+            child = self.treeStore.iter_children(iter)
+            while child is not None:
+                orphans.append(self.treeStore.get_value(child, 0))
+                child = self.treeStore.iter_next(child)
+            for orphan in orphans:
+                self.rowiters.pop(orphan, None)
+            if self.treeStore.iter_parent(iter) is None:
+                for event, parent in self.parentiters.items():
+                    if self.treeStore.get_path(parent) == self.treeStore.get_path(iter):
+                        del self.parentiters[event]
+            self.treeStore.remove(iter)
+            for orphan in orphans:
+                self.__fileCap(orphan, self.tray.engine.getEvent(orphan))
+
+    def __fileCap(self, alert, event):
+        parent = self.parentiters.get(event)
+        if event is None or parent is None:
+            iter = self.treeStore.append(None, [alert])
+            if event is not None:
+                self.parentiters[event] = iter
+        else:
+            iter = self.treeStore.append(parent, [alert])
+        self.rowiters[alert] = iter
+
+    def acceptCap(self, alert, event=None, absorbed=()):
+        '''
+        Adds alert, filed in the tree under event, the engine's events.Event
+        for it (looked up if not given). absorbed are the Events the engine
+        merged into event on admitting alert. The engine works out what
+        alert supersedes and sends those on to removeCap.
+        '''
+        with metrics.timer('window_accept_seconds'):
+            self.__acceptCap(alert, event, absorbed)
+
+    def __acceptCap(self, alert, event, absorbed):
         if isinstance(alert, cap.Alert):
+            if event is None:
+                event = self.tray.engine.getEvent(alert)
+            for old in absorbed:
+                iter = self.parentiters.pop(old, None)
+                if iter is None:
+                    continue
+                if event not in self.parentiters:
+                    self.parentiters[event] = iter
+                else:
+                    Log.warning("CAP {0} joins two events! Leaving them split...".format(alert.id))
+
             self.alerts[alert.id] = alert
             self.ids.append(alert.id)
             if len(alert.infos) > 0:
@@ -344,21 +460,8 @@ class Window:
             else:
                 self.comboBoxListStore.append((alert.getTitle(), alert.status, alert.msgType, cap.Info.URGENCY_UNKNOWN, cap.Info.SEVERITY_UNKNOWN))
 
-            p = filter(alert.match, self.parents)
-            if len(p) is 0:
-                iter = self.treeStore.append(None, [alert])
-                self.parents.add(alert)
-                self.parentiters[alert] = iter
-            else:
-                if len(p) is 1:
-                    self.treeStore.append(self.parentiters[p[0]], [alert])
-                else:
-                    Log.warning("Multiple parents for CAP {0}! Splitting off...".format(alert.id))
-                    self.treeStore.append(None, [alert])
-                    self.parents.add(alert)
-                    self.parentiters[alert] = iter
-                    
-                    
+            self.__fileCap(alert, event)
+
             if self.comboBox2.get_active() is -1:
                 self.comboBox2.set_active(0)
                 self.comboBox2_changed_cb(self.comboBox2)
@@ -424,10 +527,74 @@ class Window:
                     
         
     def populateCap(self, alert):
+        '''
+        Shows alert: its summary rows, and its info and map pages, each
+        built the first time it is switched to. Everything built is kept
+        until the alert is removed.
+        '''
+        with metrics.timer('window_populate_seconds'):
+            detail = self.details.get(alert.id)
+            if detail is None or detail.alert is not alert:
+                detail = self.__buildDetail(alert)
+                if detail is None:
+                    return
+                self.details[alert.id] = detail
+            if detail is not self.detail:
+                self.__showDetail(detail)
+
+    def __clearDetail(self):
+        '''
+        Takes the alert shown off the window: its summary rows, its pages
+        and the map, leaving an empty KeyTable to be added.
+        '''
+        # No building for the pages switched through while removing them.
+        self.detail = None
+        # Out of the last Map page, which goes with its alert once removed.
+        parent = self.mapView.get_parent()
+        if parent is not None:
+            parent.remove(self.mapView)
+        while self.notebook.get_n_pages() > 0:
+            self.notebook.remove_page(-1)
+        child = self.viewport.get_child()
+        if child is not None:
+            self.viewport.remove(child)
+        self.keyTable = KeyTable()
+
+    def __showDetail(self, detail):
+        self.__clearDetail()
+        self.viewport.add(detail.keyTable)
+        detail.keyTable.show_all()
+        self.keyTable = detail.keyTable
+        for holder, label in detail.pages:
+            self.notebook.append_page(holder, label)
+        self.notebook.show()
+        self.detail = detail
+        self.__showPage(detail, self.notebook.get_nth_page(self.notebook.get_current_page()))
+
+    def __infoPage(self, info):
+        helper = str()
+        if info.headline is not None:
+            helper += info.headline + '\n\n'
+        helper += 'Description:\n\n'
+        if info.description is not None:
+            helper += info.description + '\n\n'
+        helper += 'Instructions:\n\n'
+        if info.instruction is not None:
+            helper += info.instruction
+        tb = gtk.TextBuffer()
+        tb.set_text(helper)
+        tv = gtk.TextView(tb)
+        tv.set_wrap_mode(gtk.WRAP_WORD)
+        tv.set_editable(False)
+        return tv
+
+    def __buildDetail(self, alert):
+        # __alert adds to self.keyTable; the table shown is put back
+        # after, built or not, and __showDetail swaps it when it is shown.
+        shown = self.keyTable
         try:
-            self.keyTable.clear()
-            while self.notebook.get_n_pages() > 0:
-                self.notebook.remove_page(-1)
+            detail = AlertDetail(alert)
+            self.keyTable = detail.keyTable
             self.__alert('Note', alert.note, cap.Alert.aboutNote())
             self.__alert('Message Type', alert.msgType, cap.Alert.aboutMsgType(), cap.Alert.aboutMsgType(alert.msgType))
             self.__alert('Incidents', alert.incidents, cap.Alert.aboutIncidents())
@@ -438,17 +605,7 @@ class Window:
             self.__alert('Source', alert.source, cap.Alert.aboutSource())
             
             for info in alert.infos:
-                tb = gtk.TextBuffer()
-                tv = gtk.TextView(tb)
-                tv.set_wrap_mode(gtk.WRAP_WORD)
-                tv.set_editable(False)
-                
-                
-                label = gtk.Label('Info')
-                pn = self.notebook.append_page(tv, label)
-                self.notebook.set_current_page(pn)
-                self.notebook.show()
-                tv.show()
+                detail.addPage('Info', lambda info=info: self.__infoPage(info))
                 self.__alert('Sender Name', info.senderName, cap.Info.aboutSenderName())
                 for c in info.categories:
                     self.__alert('Category', c, cap.Info.aboutCategory(), cap.Info.aboutCategory(c))
@@ -474,38 +631,9 @@ class Window:
                 self.__alert('Contact', info.contact, cap.Info.aboutContact())
                 for p in info.parameters:
                     self.__alert(p, info.parameters[p], cap.Info.aboutParameter())
-                
-                helper = str()
-                if info.headline is not None:
-                    helper += info.headline + '\n\n'
-                helper += 'Description:\n\n'
-                if info.description is not None:
-                    helper += info.description + '\n\n'
-                helper += 'Instructions:\n\n'
-                if info.instruction is not None:
-                    helper += info.instruction
                 self.__alert('Language', info.language, cap.Info.aboutLanguage())
-
-                tb.set_text(helper)
-                #file = open('../marker-simple.html')
-                
-#                self.webview.load_html_string(file.read(),'http://localhost/testing')
-                for area in info.areas:
-                    for polygon in area.polygons:
-                        webview = webkit.WebView()
-                        label = gtk.Label('Map')
-                        pn = self.notebook.append_page(webview, label)
-                        webview.show()
-                        if hasattr(area,'areaDesc'):
-                            webview.load_html_string(utils.mapPolygon(polygon, areaDesc=area.areaDesc),'http://localhost/testing')
-                        else:
-                            webview.load_html_string(utils.mapPolygon(polygon),'http://localhost/testing')
-                    for circle in area.circles:
-                        webview = webkit.WebView()
-                        label = gtk.Label('Map')
-                        pn = self.notebook.append_page(webview, label)
-                        webview.show()
-                        webview.load_html_string(utils.mapCircle(circle),'http://localhost/testing')
+            if self.tray.maps.hasMap(alert):
+                detail.mapHolder = detail.addPage('Map')
             for code in alert.codes:
                 self.__alert('Code', code, cap.Alert.aboutCode())
             for reference in alert.references:
@@ -515,8 +643,10 @@ class Window:
             self.__alert('Version', alert.version)
             self.__alert('Message ID', alert.id, cap.Alert.aboutId())
             self.__alert('Source CAP URL', alert.url, url=alert.url)
-                        
+            return detail
         except AttributeError:
             Log.error("Attribute error while populating window from CAP {0}.".format(alert.id), exc_info=True)
         except:
-            Log.error("Unexpected error while populating window from CAP {0}".format(alert.id), exc_info=True)            
+            Log.error("Unexpected error while populating window from CAP {0}".format(alert.id), exc_info=True)
+        finally:
+            self.keyTable = shown            